@@ -0,0 +1,356 @@
+import argparse
+import os
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from bar_store import RATE_DTYPE, BarStore
+
+# ===========================
+#      MODELO (mismos parámetros que mt5.py / bot3.py)
+# ===========================
+TIMEFRAME_M5 = 5          # valor de mt5.TIMEFRAME_M5
+TF_MIN = 5
+ATR_LEN = 14
+R_MULT = 2.0
+ATR_SL_MULT = 1.0
+BREAKOUT_LOOKBACK = 12
+BUY_TH = 0.60             # build_recommendation(): compra si p_up >= BUY_TH, si no venta
+PROB_TRADE_TH = 0.75      # mt5.py: auto-BUY real
+W_EMA, W_MOM, W_RSI, W_BRK, BIAS = 1.2, 1.0, 0.8, 1.2, 0.0
+
+# Parámetros ajustables (sweep.py): por defecto, los valores fijos de los scripts
+DEFAULT_PARAMS = {
+    "w_ema": W_EMA, "w_mom": W_MOM, "w_rsi": W_RSI, "w_brk": W_BRK, "bias": BIAS,
+    "buy_th": BUY_TH, "prob_trade_th": PROB_TRADE_TH, "r_mult": R_MULT, "atr_sl_mult": ATR_SL_MULT,
+}
+
+# ===========================
+#      SIMULACIÓN DE OPERACIONES
+# ===========================
+ENTRY_BARS_DEFAULT = 1    # velas durante las que el stop de entrada sigue vivo
+MAX_HOLD_BARS = 48        # cierre a mercado si no toca SL/TP (48 x M5 = 4h)
+CHUNK = 200_000           # señales por bloque (acota la memoria de las ventanas 2D)
+
+DEBUG = True
+
+def log(msg: str):
+    if DEBUG:
+        print(msg, flush=True)
+
+# ===========================
+#      FEATURES EN BLOQUE
+# ===========================
+def feature_matrix(bars, horizon_min: int = 5) -> dict:
+    """
+    Features de feature_bundle() para TODAS las velas en una pasada (índice i = vela evaluada cerrada).
+    EMA/RSI con ewm de pandas (mismo resultado que ema()/rsi() de los scripts), el resto con numpy.
+    """
+    bars_ahead = max(1, horizon_min // TF_MIN)
+    high = np.asarray(bars["high"], dtype=float)
+    low = np.asarray(bars["low"], dtype=float)
+    close = np.asarray(bars["close"], dtype=float)
+    n = len(close)
+
+    s = pd.Series(close)
+    ema20 = s.ewm(span=20, adjust=False).mean().to_numpy()
+    ema50 = s.ewm(span=50, adjust=False).mean().to_numpy()
+    delta = s.diff()
+    roll_up = delta.clip(lower=0).ewm(alpha=1/14, adjust=False).mean().to_numpy()
+    roll_down = (-delta.clip(upper=0)).ewm(alpha=1/14, adjust=False).mean().to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi14 = 100 - (100 / (1 + roll_up / roll_down))
+
+    prev_close = np.concatenate([[np.nan], close[:-1]])
+    tr = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+    csum = np.concatenate([[0.0], np.cumsum(tr)])
+    atr14 = np.full(n, np.nan)
+    atr14[ATR_LEN - 1:] = (csum[ATR_LEN:] - csum[:-ATR_LEN]) / ATR_LEN
+
+    ret_h = np.full(n, np.nan)
+    ret_h[bars_ahead:] = close[bars_ahead:] / close[:-bars_ahead] - 1.0
+    hh_lb = np.full(n, np.nan)
+    ll_lb = np.full(n, np.nan)
+    hh_lb[BREAKOUT_LOOKBACK - 1:] = sliding_window_view(high, BREAKOUT_LOOKBACK).max(axis=1)
+    ll_lb[BREAKOUT_LOOKBACK - 1:] = sliding_window_view(low, BREAKOUT_LOOKBACK).min(axis=1)
+
+    return {
+        "ema_spread": (ema20 - ema50) / (atr14 + 1e-8),
+        "mom_h": ret_h / ((atr14 / close) + 1e-8),
+        "rsi_pos": (rsi14 - 50.0) / 50.0,
+        "breakout_up": (close > hh_lb * 0.999).astype(float),
+        "breakout_dn": (close < ll_lb * 1.001).astype(float),
+        "atr": atr14,
+        "bars_ahead": bars_ahead,
+    }
+
+def predict_up_probability(feat: dict, params: Optional[dict] = None) -> np.ndarray:
+    """Sigmoide de predict_up_probability() aplicada a todo el vector de features."""
+    p = DEFAULT_PARAMS if params is None else {**DEFAULT_PARAMS, **params}
+    x = (p["w_ema"] * feat["ema_spread"] + p["w_mom"] * feat["mom_h"] + p["w_rsi"] * feat["rsi_pos"]
+         + p["w_brk"] * (feat["breakout_up"] - 0.8 * feat["breakout_dn"]) + p["bias"])
+    return 1.0 / (1.0 + np.exp(-x))
+
+def recommendation_levels(bars, feat: dict, p_up: np.ndarray, params: Optional[dict] = None):
+    """build_recommendation() vectorizado: lado (+1 compra / -1 venta / 0 neutral), entrada, stop y TP."""
+    p = DEFAULT_PARAMS if params is None else {**DEFAULT_PARAMS, **params}
+    high = np.asarray(bars["high"], dtype=float)
+    low = np.asarray(bars["low"], dtype=float)
+    atr_v = feat["atr"]
+    buy = p_up >= p["buy_th"]
+    entry = np.where(buy, high, low)
+    stop = np.where(buy,
+                    np.maximum(low - p["atr_sl_mult"] * atr_v, entry - 5 * atr_v),
+                    np.minimum(high + p["atr_sl_mult"] * atr_v, entry + 5 * atr_v))
+    risk = np.where(buy, entry - stop, stop - entry)
+    side = np.where(buy, 1, -1)
+    side[~(risk > 0)] = 0
+    tp = entry + side * p["r_mult"] * risk
+    return side, entry, stop, tp, risk
+
+# ===========================
+#      MOTOR DE BACKTEST
+# ===========================
+def _first_true(mask: np.ndarray) -> np.ndarray:
+    """Índice de la primera columna True por fila (ancho de la fila si no hay ninguna)."""
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), mask.shape[1])
+
+def simulate_trades(bars, side, entry, stop, tp, risk, signal_idx,
+                    entry_bars: int = ENTRY_BARS_DEFAULT, max_hold: int = MAX_HOLD_BARS) -> dict:
+    """
+    Simula la orden stop de cada señal sobre las velas posteriores, en bloques 2D sin bucles por vela:
+    - Entrada si la vela j in (i, i+entry_bars] rompe el nivel (con gap, al precio de apertura).
+    - Salida en el primer SL/TP desde la vela de entrada (si ambos en la misma vela, cuenta el SL)
+      o a cierre tras max_hold velas. Resultado en múltiplos de R.
+    """
+    open_ = np.asarray(bars["open"], dtype=float)
+    high = np.asarray(bars["high"], dtype=float)
+    low = np.asarray(bars["low"], dtype=float)
+    close = np.asarray(bars["close"], dtype=float)
+    n = len(close)
+    # Relleno al final para que todas las ventanas tengan el mismo ancho
+    pad = entry_bars + max_hold + 1
+    hi_p = np.concatenate([high, np.full(pad, np.nan)])
+    lo_p = np.concatenate([low, np.full(pad, np.nan)])
+    op_p = np.concatenate([open_, np.full(pad, np.nan)])
+    cl_p = np.concatenate([close, np.full(pad, np.nan)])
+    hi_w = sliding_window_view(hi_p, max_hold)
+    lo_w = sliding_window_view(lo_p, max_hold)
+
+    filled = np.zeros(len(signal_idx), dtype=bool)
+    r_mult = np.full(len(signal_idx), np.nan)
+    for a in range(0, len(signal_idx), CHUNK):
+        idx = signal_idx[a:a + CHUNK]
+        sd, en, st, tk, rk = side[idx], entry[idx], stop[idx], tp[idx], risk[idx]
+        buy = sd > 0
+
+        # 1) Disparo de la orden stop
+        fwd = idx[:, None] + 1 + np.arange(entry_bars)
+        trig = np.where(buy[:, None], hi_p[fwd] >= en[:, None], lo_p[fwd] <= en[:, None])
+        off = _first_true(trig)
+        ok = (off < entry_bars) & (sd != 0) & (idx + 1 + off + max_hold <= n)
+        f = idx + 1 + np.minimum(off, entry_bars - 1)
+        fill = np.where(buy, np.maximum(en, op_p[f]), np.minimum(en, op_p[f]))
+
+        # 2) Primer SL / TP desde la vela de entrada
+        hw, lw = hi_w[f], lo_w[f]
+        sl_hit = np.where(buy[:, None], lw <= st[:, None], hw >= st[:, None])
+        tp_hit = np.where(buy[:, None], hw >= tk[:, None], lw <= tk[:, None])
+        k_sl, k_tp = _first_true(sl_hit), _first_true(tp_hit)
+
+        exit_px = np.where(k_sl <= k_tp, st, tk)
+        timeout = (k_sl == max_hold) & (k_tp == max_hold)
+        exit_px = np.where(timeout, cl_p[f + max_hold - 1], exit_px)
+        res = np.where(buy, exit_px - fill, fill - exit_px) / rk
+
+        filled[a:a + CHUNK] = ok
+        r_mult[a:a + CHUNK] = np.where(ok, res, np.nan)
+    return {"filled": filled, "r": r_mult}
+
+def _summary(r: np.ndarray, n_signals: int) -> dict:
+    r = r[~np.isnan(r)]
+    if len(r) == 0:
+        return {"signals": n_signals, "trades": 0}
+    equity = np.cumsum(r)
+    drawdown = np.maximum.accumulate(np.concatenate([[0.0], equity]))[1:] - equity
+    gains, losses = float(r[r > 0].sum()), float(-r[r < 0].sum())
+    return {
+        "signals": n_signals,
+        "wins": int((r > 0).sum()),
+        "gains_r": gains,
+        "losses_r": losses,
+        "trades": int(len(r)),
+        "fill_rate": len(r) / n_signals if n_signals else 0.0,
+        "win_rate": float((r > 0).mean()),
+        "total_r": float(r.sum()),
+        "avg_r": float(r.mean()),
+        "profit_factor": float(gains / losses) if losses > 0 else float("inf"),
+        "max_dd_r": float(drawdown.max()),
+    }
+
+def backtest(bars, horizon_min: int = 5, entry_bars: int = ENTRY_BARS_DEFAULT,
+             max_hold: int = MAX_HOLD_BARS, warmup: int = 100, params: Optional[dict] = None,
+             feat: Optional[dict] = None) -> dict:
+    """
+    Backtest del modelo heurístico sobre velas (RATE_DTYPE o dict de columnas open/high/low/close).
+    feat permite reutilizar un feature_matrix() ya calculado (no depende de params).
+    Devuelve métricas por grupo: buy (p>=buy_th), trade (p>=prob_trade_th) y sell (p<buy_th).
+    """
+    p = DEFAULT_PARAMS if params is None else {**DEFAULT_PARAMS, **params}
+    if feat is None:
+        feat = feature_matrix(bars, horizon_min)
+    p_up = predict_up_probability(feat, p)
+    side, entry, stop, tp, risk = recommendation_levels(bars, feat, p_up, p)
+    close = np.asarray(bars["close"], dtype=float)
+    n = len(close)
+    bars_ahead = feat["bars_ahead"]
+
+    # Como el ciclo en vivo: una señal por vela cerrada con >=100 velas de histórico (feature_bundle)
+    valid = np.zeros(n, dtype=bool)
+    valid[max(warmup - 1, ATR_LEN):n - 1] = True
+    valid &= ~np.isnan(p_up)
+
+    # Acierto direccional a horizonte: ¿cierre en i+bars_ahead por encima del cierre en i?
+    fut = np.full(n, np.nan)
+    fut[:-bars_ahead] = close[bars_ahead:]
+    up_later = fut > close
+
+    trades = simulate_trades(bars, side, entry, stop, tp, risk, np.flatnonzero(valid & (side != 0)),
+                             entry_bars=entry_bars, max_hold=max_hold)
+    r_all = np.full(n, np.nan)
+    r_all[np.flatnonzero(valid & (side != 0))] = trades["r"]
+
+    groups = {
+        "buy": valid & (p_up >= p["buy_th"]),
+        "trade": valid & (p_up >= p["prob_trade_th"]),
+        "sell": valid & (p_up < p["buy_th"]),
+    }
+    report = {}
+    for name, mask in groups.items():
+        stats = _summary(r_all[mask], int(mask.sum()))
+        horizon_ok = mask & ~np.isnan(fut)
+        hits = ~up_later[horizon_ok] if name == "sell" else up_later[horizon_ok]
+        stats["hit_rate_h"] = float(hits.mean()) if len(hits) else float("nan")
+        report[name] = stats
+    report["bars"] = n
+    return report
+
+# ===========================
+#      DATOS
+# ===========================
+def load_symbols(root: str, timeframe: int = TIMEFRAME_M5, symbols=None) -> dict:
+    """Lee del BarStore (bars/) las series completas de los símbolos pedidos (o todas las del timeframe)."""
+    store = BarStore(root)
+    if symbols is None:
+        suffix = f"_{timeframe}.bars"
+        symbols = sorted(f[:-len(suffix)] for f in os.listdir(root) if f.endswith(suffix)) \
+            if os.path.isdir(root) else []
+    out = {}
+    for symbol in symbols:
+        bars = store.read(symbol, timeframe)
+        if bars is not None and len(bars) > 0:
+            out[symbol] = bars
+    return out
+
+def synthetic_bars(n: int, seed: int = 0, base: float = 150.0) -> np.ndarray:
+    """Paseo aleatorio M5 para medir rendimiento sin datos grabados."""
+    rng = np.random.default_rng(seed)
+    close = base * np.exp(np.cumsum(rng.normal(0.0, 0.0007, n)))
+    open_ = np.concatenate([[base], close[:-1]])
+    wick = np.abs(rng.normal(0.0, 0.0004, (2, n))) * close
+    bars = np.zeros(n, dtype=RATE_DTYPE)
+    bars["time"] = 1_500_000_000 // 300 * 300 + 300 * np.arange(n)
+    bars["open"] = open_
+    bars["high"] = np.maximum(open_, close) + wick[0]
+    bars["low"] = np.minimum(open_, close) - wick[1]
+    bars["close"] = close
+    return bars
+
+def parity_check(bars, horizon_min: int = 5, samples: int = 20, seed: int = 1) -> float:
+    """
+    Compara feature_matrix()/predict_up_probability() con feature_bundle()/predict_up_probability()
+    de mt5.py en velas al azar (usa mt5sim si el paquete MetaTrader5 no está instalado).
+    """
+    try:
+        import MetaTrader5  # noqa: F401
+    except ImportError:
+        import mt5sim
+        mt5sim.install()
+    import mt5 as live
+
+    feat = feature_matrix(bars, horizon_min)
+    p_up = predict_up_probability(feat)
+    df_all = pd.DataFrame(np.asarray(bars))
+    rng = np.random.default_rng(seed)
+    worst = 0.0
+    for i in rng.integers(150, len(bars) - 2, samples):
+        # feature_bundle evalúa la penúltima fila (última vela cerrada)
+        ref = live.feature_bundle(df_all.iloc[:i + 2].reset_index(drop=True), horizon_min=horizon_min)
+        for key in ("ema_spread", "mom_h", "rsi_pos", "breakout_up", "breakout_dn", "atr"):
+            worst = max(worst, abs(ref[key] - feat[key][i]))
+        worst = max(worst, abs(live.predict_up_probability(ref) - p_up[i]))
+    if worst > 1e-8:
+        raise AssertionError(f"Paridad con mt5.feature_bundle fallida: error máx {worst:.3e}")
+    return worst
+
+# ===========================
+#      INFORME / MAIN
+# ===========================
+def run(series: dict, horizon_min: int, entry_bars: int, max_hold: int) -> dict:
+    results = {}
+    total_bars = 0
+    t0 = time.perf_counter()
+    for symbol, bars in series.items():
+        results[symbol] = backtest(bars, horizon_min=horizon_min, entry_bars=entry_bars, max_hold=max_hold)
+        total_bars += results[symbol]["bars"]
+    elapsed = time.perf_counter() - t0
+
+    labels = {"buy": f"buy p>={BUY_TH:.2f}", "trade": f"buy p>={PROB_TRADE_TH:.2f}", "sell": f"sell p<{BUY_TH:.2f}"}
+    for symbol, rep in results.items():
+        log(f"📊 {symbol} ({rep['bars']} velas)")
+        for name, st in rep.items():
+            if name == "bars":
+                continue
+            name = labels[name]
+            if st["trades"] == 0:
+                log(f"   {name:<12} señales={st['signals']:>7}  sin operaciones")
+                continue
+            log(f"   {name:<12} señales={st['signals']:>7}  acierto_h={st['hit_rate_h'] * 100:5.1f}%  "
+                f"ops={st['trades']:>7}  win={st['win_rate'] * 100:5.1f}%  R={st['total_r']:+9.1f}  "
+                f"R/op={st['avg_r']:+.3f}  PF={st['profit_factor']:.2f}  DD={st['max_dd_r']:.1f}R")
+    log(f"⏱️ {len(results)} símbolo(s), {total_bars} velas en {elapsed:.2f} s "
+        f"({total_bars / max(elapsed, 1e-9) / 1e6:.2f} M velas/s)")
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Backtest vectorizado del modelo heurístico de mt5.py (M5).")
+    parser.add_argument("--root", default="bars", help="Directorio del BarStore (por defecto: bars).")
+    parser.add_argument("--symbols", nargs="*", default=None, help="Símbolos (por defecto: todos los M5 del root).")
+    parser.add_argument("--horizon-min", type=int, default=5, help="Horizonte del modelo en minutos.")
+    parser.add_argument("--entry-bars", type=int, default=ENTRY_BARS_DEFAULT,
+                        help=f"Velas de validez del stop de entrada (por defecto: {ENTRY_BARS_DEFAULT}).")
+    parser.add_argument("--max-hold", type=int, default=MAX_HOLD_BARS,
+                        help=f"Velas máximas en posición (por defecto: {MAX_HOLD_BARS}).")
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N",
+                        help="Benchmark: N símbolos sintéticos en lugar de datos del root.")
+    parser.add_argument("--years", type=float, default=3.0, help="Años de M5 por símbolo sintético.")
+    parser.add_argument("--check", action="store_true",
+                        help="Verifica la paridad con mt5.feature_bundle antes de ejecutar.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.synthetic:
+        n = int(args.years * 365 * 24 * 12)
+        series = {f"SYN{k:02d}": synthetic_bars(n, seed=k) for k in range(args.synthetic)}
+    else:
+        series = load_symbols(args.root, symbols=args.symbols)
+        if not series:
+            raise SystemExit(f"No hay velas M5 en {args.root}/ (usa --synthetic N para un benchmark).")
+    if args.check:
+        first = next(iter(series.values()))
+        log(f"✅ Paridad con mt5.feature_bundle OK (error máx {parity_check(first[:5000], args.horizon_min):.3e})")
+    run(series, args.horizon_min, args.entry_bars, args.max_hold)
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+from typing import Optional
+
+# Mismo layout que el array estructurado que devuelve copy_rates_from_pos
+RATE_DTYPE = np.dtype([
+    ("time", "<i8"),
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("tick_volume", "<u8"),
+    ("spread", "<i4"),
+    ("real_volume", "<u8"),
+])
+
+# ===========================
+#      ALMACÉN LOCAL DE VELAS
+# ===========================
+class BarStore:
+    """
+    Histórico de velas CERRADAS en disco, un fichero por símbolo/timeframe.
+    - Registros de ancho fijo (RATE_DTYPE), solo se añaden al final (append-only).
+    - Lectura por np.memmap: solo se leen del disco las páginas de la ventana pedida
+      (quien la une con velas nuevas, como CandleCache, hace una copia de esa ventana).
+    - Sin huecos: quien añade velas que no enlazan con la última guardada debe reset() antes.
+    """
+
+    def __init__(self, root: str = "bars"):
+        self.root = root
+
+    def path(self, symbol: str, timeframe: int) -> str:
+        return os.path.join(self.root, f"{symbol}_{timeframe}.bars")
+
+    def count(self, symbol: str, timeframe: int) -> int:
+        p = self.path(symbol, timeframe)
+        if not os.path.exists(p):
+            return 0
+        # Un registro a medias (corte durante la escritura) se ignora
+        return os.path.getsize(p) // RATE_DTYPE.itemsize
+
+    def read(self, symbol: str, timeframe: int, n: Optional[int] = None):
+        """Devuelve las últimas n velas guardadas como vista memmap (o None si no hay)."""
+        total = self.count(symbol, timeframe)
+        if total == 0:
+            return None
+        mm = np.memmap(self.path(symbol, timeframe), dtype=RATE_DTYPE, mode="r", shape=(total,))
+        return mm if n is None else mm[-n:]
+
+    def last_time(self, symbol: str, timeframe: int) -> Optional[int]:
+        tail = self.read(symbol, timeframe, 1)
+        return None if tail is None else int(tail["time"][0])
+
+    def reset(self, symbol: str, timeframe: int):
+        """Vacía el histórico del símbolo/timeframe."""
+        p = self.path(symbol, timeframe)
+        if os.path.exists(p):
+            with open(p, "r+b") as f:
+                f.truncate(0)
+
+    def append(self, symbol: str, timeframe: int, bars) -> int:
+        """Añade las velas posteriores a la última guardada. Devuelve cuántas se escribieron."""
+        if bars is None or len(bars) == 0:
+            return 0
+        bars = np.asarray(bars).astype(RATE_DTYPE, copy=False)
+        last = self.last_time(symbol, timeframe)
+        if last is not None:
+            bars = bars[bars["time"] > last]
+        if len(bars) == 0:
+            return 0
+        os.makedirs(self.root, exist_ok=True)
+        p = self.path(symbol, timeframe)
+        total = self.count(symbol, timeframe)
+        with open(p, "ab") as f:
+            # Descarta un posible registro incompleto antes de añadir
+            f.truncate(total * RATE_DTYPE.itemsize)
+            f.write(bars.tobytes())
+        return len(bars)
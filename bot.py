@@ -6,6 +6,13 @@ import time
 import argparse
 from zoneinfo import ZoneInfo
 from typing import Optional
+from mt5_session import MT5Session, TERMINAL_LOCK
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender
+from candle_cache import CandleCache
+from bar_store import BarStore
+from indicators import IndicatorSet, rolling_max, rolling_min
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES (TU SCRIPT)
@@ -29,12 +36,22 @@ BARS_AHEAD = max(1, HORIZON_MIN // 5)  # 6
 # Zona horaria y verbosidad
 TZ = ZoneInfo("Europe/Madrid")
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa y p50/p95/p99 en el log de cada ciclo; False = sin coste
+
+# Histórico local de velas cerradas (memmap); evita re-descargar al reiniciar
+BARS_DIR = "bars"
+
+# Planificador: despertar X ms después de cada cierre de vela (reloj monotónico)
+WAKE_AFTER_CLOSE_MS = 1000
 
 # Gestión de riesgo (para SL/TP si hay compra)
 ATR_LEN = 14
 R_MULT = 2.0            # TP = 2R
 ATR_SL_MULT = 1.0       # SL ~ 1x ATR
 
+# Features sobre el array de MT5 (False = DataFrame + feature_bundle, la versión de referencia)
+LEAN_FEATURES = True
+
 # ===========================
 #      UTILIDADES
 # ===========================
@@ -42,47 +59,46 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+STAGES = StageTimer("bot", enabled=STAGE_TIMING, log=log)
+
+TELEGRAM = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
-    """Envía mensaje a Telegram con las credenciales provistas."""
-    try:
-        import requests
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-        r = requests.post(url, data=data, timeout=15)
-        if r.status_code != 200:
-            log(f"⚠️ Telegram {r.status_code}: {r.text}")
-        else:
-            log("📨 Telegram OK")
-    except Exception as e:
-        log(f"❌ Telegram error: {e}")
+    """Encola el mensaje; el hilo de TELEGRAM lo entrega sin bloquear el ciclo."""
+    TELEGRAM.send(message)
 
+SESSION = MT5Session(mt5, MT5_LOGIN, MT5_PASSWORD, MT5_SERVER, path=PATH_TO_TERMINAL,
+                     symbols=[SYMBOL], log=log)
+CANDLES = CandleCache(mt5, store=BarStore(BARS_DIR))
+INDICATORS = IndicatorSet(ATR_LEN)
+
+@STAGES.timed("init_mt5")
 def init_mt5():
-    log("🔌 Inicializando MetaTrader 5...")
-    ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
-    if not ok:
-        raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
-    # Login con tus credenciales
-    if not mt5.login(login=MT5_LOGIN, password=MT5_PASSWORD, server=MT5_SERVER):
-        raise RuntimeError(f"Login error: {mt5.last_error()}")
-    if not mt5.symbol_select(SYMBOL, True):
-        raise RuntimeError(f"No se pudo suscribir a {SYMBOL}")
-    tick = mt5.symbol_info_tick(SYMBOL)
-    log(f"ℹ️ Tick inicial {SYMBOL}: {tick}")
+    connect_ms = SESSION.ensure()
+    with TERMINAL_LOCK:
+        tick = mt5.symbol_info_tick(SYMBOL)
+    log(f"ℹ️ Tick inicial {SYMBOL}: {tick} (conexión {connect_ms:.1f} ms)")
 
 def shutdown_mt5():
-    try:
-        mt5.shutdown()
-    except Exception:
-        pass
+    SESSION.close()
     log("🔚 MT5 cerrado.")
 
-def copy_rates(symbol, timeframe, n=1000):
-    data = mt5.copy_rates_from_pos(symbol, timeframe, 0, n)
+@STAGES.timed("copy_rates")
+def copy_rates_raw(symbol, timeframe, n=1000) -> np.ndarray:
+    """Array estructurado de MT5 tal cual (time en epoch s), sin DataFrame."""
+    data = CANDLES.get(symbol, timeframe, n)
     if data is None or len(data) == 0:
         raise RuntimeError("No se pudieron obtener datos de velas")
-    df = pd.DataFrame(data)
-    df["time"] = pd.to_datetime(df["time"], unit="s", utc=True).dt.tz_convert(TZ)
-    return df
+    return data
+
+def copy_rates(symbol, timeframe, n=1000):
+    """DataFrame de velas; "time" queda en epoch (s, UTC): se convierte a TZ solo al formatear."""
+    return pd.DataFrame(copy_rates_raw(symbol, timeframe, n))
+
+def local_time(epoch) -> pd.Timestamp:
+    """Epoch (s, UTC) de MT5 -> hora local TZ (mensajes y logs)."""
+    return pd.Timestamp(int(epoch), unit="s", tz="UTC").tz_convert(TZ)
 
 # ===========================
 #      INDICADORES
@@ -111,37 +127,46 @@ def atr(df: pd.DataFrame, length=14):
 # ===========================
 #      MODELO HEURÍSTICO
 # ===========================
-def feature_bundle(df: pd.DataFrame) -> dict:
+@STAGES.timed("feature_bundle")
+def feature_bundle(df: pd.DataFrame, indicators: Optional[IndicatorSet]=None) -> dict:
     """Calcula features en la ÚLTIMA VELA CERRADA (idx = -2)."""
     if len(df) < 100:
         raise ValueError("Histórico insuficiente (<100 velas).")
 
     df = df.copy()
-    df["ema20"] = ema(df["close"], 20)
-    df["ema50"] = ema(df["close"], 50)
-    df["rsi14"] = rsi(df["close"], 14)
-    df["atr14"] = atr(df, ATR_LEN)
+    if indicators is None:
+        df["ema20"] = ema(df["close"], 20)
+        df["ema50"] = ema(df["close"], 50)
+        df["rsi14"] = rsi(df["close"], 14)
+        df["atr14"] = atr(df, ATR_LEN)
     df["ret_6"] = df["close"] / df["close"].shift(6) - 1.0
-    df["hh_12"] = df["high"].rolling(12).max()
-    df["ll_12"] = df["low"].rolling(12).min()
+    if indicators is None:
+        df["hh_12"] = rolling_max(df["high"].to_numpy(), 12)
+        df["ll_12"] = rolling_min(df["low"].to_numpy(), 12)
 
     i = df.index[-2]  # última vela CERRADA
+    if indicators is None:
+        ind = df.loc[i, ["ema20", "ema50", "rsi14", "atr14"]]
+    else:
+        # Motor streaming: solo procesa las velas cerradas nuevas desde el ciclo anterior
+        ind = indicators.evaluate(df["time"].values, df["high"].values, df["low"].values,
+                                  df["close"].values, lookbacks=(12,))
 
     # Tendencia por EMAs (normalizada)
-    ema_spread = (df.loc[i, "ema20"] - df.loc[i, "ema50"]) / (df.loc[i, "atr14"] + 1e-8)
+    ema_spread = (ind["ema20"] - ind["ema50"]) / (ind["atr14"] + 1e-8)
 
     # Momentum 6 velas (horizonte ~30m)
-    mom6 = df.loc[i, "ret_6"] / (((df["atr14"].loc[i] / df["close"].loc[i]) + 1e-8))
+    mom6 = df.loc[i, "ret_6"] / (((ind["atr14"] / df["close"].loc[i]) + 1e-8))
 
     # RSI centrado en 50
-    rsi_pos = (df.loc[i, "rsi14"] - 50.0) / 50.0  # [-1..+1 aprox]
+    rsi_pos = (ind["rsi14"] - 50.0) / 50.0  # [-1..+1 aprox]
 
     # Ruptura reciente
     close_i = df.loc[i, "close"]
     high_i  = df.loc[i, "high"]
     low_i   = df.loc[i, "low"]
-    hh12    = df.loc[i, "hh_12"]
-    ll12    = df.loc[i, "ll_12"]
+    hh12    = df.loc[i, "hh_12"] if indicators is None else ind["hh12"]
+    ll12    = df.loc[i, "ll_12"] if indicators is None else ind["ll12"]
     breakout_up = 1.0 if close_i > hh12 * 0.999 else 0.0
     breakout_dn = 1.0 if close_i < ll12 * 1.001 else 0.0
 
@@ -152,11 +177,46 @@ def feature_bundle(df: pd.DataFrame) -> dict:
         "rsi_pos": float(rsi_pos),
         "breakout_up": float(breakout_up),
         "breakout_dn": float(breakout_dn),
-        "atr": float(df.loc[i, "atr14"]),
+        "atr": float(ind["atr14"]),
         "price_close": float(close_i),
         "price_high": float(high_i),
         "price_low": float(low_i),
-        "time": df.loc[i, "time"],
+        "time": int(df.loc[i, "time"]),
+    }
+
+@STAGES.timed("feature_bundle")
+def feature_bundle_np(rates: np.ndarray, indicators: Optional[IndicatorSet]=None) -> dict:
+    """feature_bundle sobre el array de copy_rates_raw: sin copiar el DataFrame ni crear columnas completas."""
+    n = len(rates)
+    if n < 100:
+        raise ValueError("Histórico insuficiente (<100 velas).")
+
+    if indicators is None:
+        indicators = IndicatorSet(ATR_LEN)
+    close = rates["close"]
+    ind = indicators.evaluate(rates["time"], rates["high"], rates["low"], close, lookbacks=(12,))
+
+    i = n - 2  # última vela CERRADA
+    close_i = float(close[i])
+    atr_i = ind["atr14"]
+    ema_spread = (ind["ema20"] - ind["ema50"]) / (atr_i + 1e-8)
+    mom6 = (close_i / float(close[i - 6]) - 1.0) / ((atr_i / close_i) + 1e-8)
+    rsi_pos = (ind["rsi14"] - 50.0) / 50.0
+    breakout_up = 1.0 if close_i > ind["hh12"] * 0.999 else 0.0
+    breakout_dn = 1.0 if close_i < ind["ll12"] * 1.001 else 0.0
+
+    return {
+        "i": i,
+        "ema_spread": float(ema_spread),
+        "mom6": float(mom6),
+        "rsi_pos": float(rsi_pos),
+        "breakout_up": breakout_up,
+        "breakout_dn": breakout_dn,
+        "atr": float(atr_i),
+        "price_close": close_i,
+        "price_high": float(rates["high"][i]),
+        "price_low": float(rates["low"][i]),
+        "time": int(rates["time"][i]),
     }
 
 def sigmoid(x: float) -> float:
@@ -220,7 +280,7 @@ def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
     """
     Mensaje ES + RU (solo para compra). Incluye niveles y condición.
     """
-    ts = str(rec["time"])
+    ts = str(local_time(rec["time"]))
     p = rec["p_up"] * 100.0
 
     es = (
@@ -253,14 +313,21 @@ def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
 # ===========================
 #       CICLOS / MAIN
 # ===========================
-def run_once():
+def run_once(keep_session: bool=False):
+    STAGES.begin_cycle()
     try:
         init_mt5()
         log(f"📊 Analizando {SYMBOL} M5…")
-        df = copy_rates(SYMBOL, TIMEFRAME, 600)  # ~50h de datos
-        log(f"📈 Últimas 3 velas: {list(df['time'].tail(3))}")
-
-        feat = feature_bundle(df)
+        if LEAN_FEATURES:
+            rates = copy_rates_raw(SYMBOL, TIMEFRAME, 600)  # ~50h de datos
+            if DEBUG:
+                log(f"📈 Últimas 3 velas: {[str(local_time(t)) for t in rates['time'][-3:]]}")
+            feat = feature_bundle_np(rates, indicators=INDICATORS)
+        else:
+            df = copy_rates(SYMBOL, TIMEFRAME, 600)  # ~50h de datos
+            if DEBUG:
+                log(f"📈 Últimas 3 velas: {[str(local_time(t)) for t in df['time'].tail(3)]}")
+            feat = feature_bundle(df, indicators=INDICATORS)
         p_up = predict_up_probability(feat)
         rec  = build_recommendation(feat, p_up)
 
@@ -272,22 +339,22 @@ def run_once():
             log(f"🔕 Sin envío: decisión = {rec['decision']} (p_up={rec['p_up']:.2f})")
 
     finally:
-        shutdown_mt5()
+        STAGES.end_cycle()
+        if not keep_session:
+            shutdown_mt5()
 
 def run_loop(every_minutes: int):
-    sleep_seconds = max(1, int(every_minutes * 60))
+    scheduler = BarCloseScheduler(every_minutes * 60, offset_ms=WAKE_AFTER_CLOSE_MS, timeframe=TIMEFRAME, log=log)
     log(f"♻️ LOOP: comprobación cada {every_minutes} minuto(s).")
-    while True:
-        start_ts = time.time()
-        try:
-            run_once()
-        except Exception as e:
-            log(f"❌ Error en iteración: {e}")
-            shutdown_mt5()
-        elapsed = time.time() - start_ts
-        remaining = max(0, sleep_seconds - int(elapsed))
-        log(f"⏳ Siguiente comprobación en ~{remaining} s.")
-        time.sleep(remaining)
+    try:
+        while True:
+            try:
+                run_once(keep_session=True)
+            except Exception as e:
+                log(f"❌ Error en iteración: {e}")
+            scheduler.wait()
+    finally:
+        shutdown_mt5()
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Predicción USDJPY M5 a 30m (solo envía si es compra, ES+RU).")
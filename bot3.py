@@ -5,6 +5,14 @@ import os
 import time
 import argparse
 from zoneinfo import ZoneInfo
+from typing import Optional
+from mt5_session import MT5Session, TERMINAL_LOCK
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender
+from candle_cache import CandleCache
+from bar_store import BarStore
+from indicators import IndicatorSet, rolling_max, rolling_min
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES (TU SCRIPT)
@@ -28,11 +36,22 @@ HORIZON_MIN_DEFAULT = 5
 # Zona horaria y verbosidad
 TZ = ZoneInfo("Europe/Madrid")
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa y p50/p95/p99 en el log de cada ciclo; False = sin coste
+
+# Histórico local de velas cerradas (memmap); evita re-descargar al reiniciar
+BARS_DIR = "bars"
+
+# Planificador: despertar X ms después de cada cierre de vela (reloj monotónico)
+WAKE_AFTER_CLOSE_MS = 1000
 
 # Gestión de riesgo (para SL/TP)
 ATR_LEN = 14
 R_MULT = 2.0            # TP = 2R
 ATR_SL_MULT = 1.0       # SL ~ 1x ATR
+BREAKOUT_LOOKBACK = 12  # velas para máximos/mínimos de ruptura (≈ 60m)
+
+# Features sobre el array de MT5 (False = DataFrame + feature_bundle, la versión de referencia)
+LEAN_FEATURES = True
 
 # ===========================
 #      UTILIDADES
@@ -41,55 +60,54 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+STAGES = StageTimer("bot3", enabled=STAGE_TIMING, log=log)
+
+TELEGRAM = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
-    """Envía mensaje a Telegram con las credenciales provistas."""
+    """Encola el mensaje; el hilo de TELEGRAM lo entrega sin bloquear el ciclo."""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         log("⚠️ Telegram desactivado: faltan TELEGRAM_BOT_TOKEN o TELEGRAM_CHAT_ID")
         return
-    try:
-        import requests
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-        r = requests.post(url, data=data, timeout=15)
-        if r.status_code != 200:
-            log(f"⚠️ Telegram {r.status_code}: {r.text}")
-        else:
-            log("📨 Telegram OK")
-    except Exception as e:
-        log(f"❌ Telegram error: {e}")
+    TELEGRAM.send(message)
 
 def require_env_creds():
     if not MT5_LOGIN or not MT5_PASSWORD or not MT5_SERVER:
         raise RuntimeError("Faltan credenciales MT5 en variables de entorno (MT5_LOGIN, MT5_PASSWORD, MT5_SERVER).")
 
+SESSION = MT5Session(mt5, MT5_LOGIN, MT5_PASSWORD, MT5_SERVER, path=PATH_TO_TERMINAL,
+                     symbols=[SYMBOL], log=log)
+CANDLES = CandleCache(mt5, store=BarStore(BARS_DIR))
+INDICATORS = IndicatorSet(ATR_LEN)
+
+@STAGES.timed("init_mt5")
 def init_mt5():
     require_env_creds()
-    log("🔌 Inicializando MetaTrader 5...")
-    ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
-    if not ok:
-        raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
-    # Login con tus credenciales
-    if not mt5.login(login=MT5_LOGIN, password=MT5_PASSWORD, server=MT5_SERVER):
-        raise RuntimeError(f"Login error: {mt5.last_error()}")
-    if not mt5.symbol_select(SYMBOL, True):
-        raise RuntimeError(f"No se pudo suscribir a {SYMBOL}")
-    tick = mt5.symbol_info_tick(SYMBOL)
-    log(f"ℹ️ Tick inicial {SYMBOL}: {tick}")
+    connect_ms = SESSION.ensure()
+    with TERMINAL_LOCK:
+        tick = mt5.symbol_info_tick(SYMBOL)
+    log(f"ℹ️ Tick inicial {SYMBOL}: {tick} (conexión {connect_ms:.1f} ms)")
 
 def shutdown_mt5():
-    try:
-        mt5.shutdown()
-    except Exception:
-        pass
+    SESSION.close()
     log("🔚 MT5 cerrado.")
 
-def copy_rates(symbol, timeframe, n=1000):
-    data = mt5.copy_rates_from_pos(symbol, timeframe, 0, n)
+@STAGES.timed("copy_rates")
+def copy_rates_raw(symbol, timeframe, n=1000) -> np.ndarray:
+    """Array estructurado de MT5 tal cual (time en epoch s), sin DataFrame."""
+    data = CANDLES.get(symbol, timeframe, n)
     if data is None or len(data) == 0:
         raise RuntimeError("No se pudieron obtener datos de velas")
-    df = pd.DataFrame(data)
-    df["time"] = pd.to_datetime(df["time"], unit="s", utc=True).dt.tz_convert(TZ)
-    return df
+    return data
+
+def copy_rates(symbol, timeframe, n=1000):
+    """DataFrame de velas; "time" queda en epoch (s, UTC): se convierte a TZ solo al formatear."""
+    return pd.DataFrame(copy_rates_raw(symbol, timeframe, n))
+
+def local_time(epoch) -> pd.Timestamp:
+    """Epoch (s, UTC) de MT5 -> hora local TZ (mensajes y logs)."""
+    return pd.Timestamp(int(epoch), unit="s", tz="UTC").tz_convert(TZ)
 
 # ===========================
 #      INDICADORES
@@ -118,7 +136,9 @@ def atr(df: pd.DataFrame, length=14):
 # ===========================
 #      MODELO HEURÍSTICO
 # ===========================
-def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=False) -> dict:
+@STAGES.timed("feature_bundle")
+def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=False,
+                   indicators: Optional[IndicatorSet]=None) -> dict:
     """Calcula features sobre la vela seleccionada.
     - Si use_live_candle=False: usa la ÚLTIMA VELA CERRADA (idx = -2) [recomendado].
     - Si use_live_candle=True: usa la vela EN FORMACIÓN (idx = -1) [más reactivo, más ruido].
@@ -129,48 +149,55 @@ def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=Fal
     bars_ahead = max(1, horizon_min // 5)
 
     df = df.copy()
-    df["ema20"] = ema(df["close"], 20)
-    df["ema50"] = ema(df["close"], 50)
-    df["rsi14"] = rsi(df["close"], 14)
-    df["atr14"] = atr(df, ATR_LEN)
+    if indicators is None:
+        df["ema20"] = ema(df["close"], 20)
+        df["ema50"] = ema(df["close"], 50)
+        df["rsi14"] = rsi(df["close"], 14)
+        df["atr14"] = atr(df, ATR_LEN)
 
     # Retorno a horizonte dinámico (antes ret_6 fijo ≈ 30m)
     df["ret_h"] = df["close"] / df["close"].shift(bars_ahead) - 1.0
 
-    # Lookback para rupturas: por defecto 12 (≈ 60m). Puede ajustarse.
-    lookback = 12
-    df["hh_lb"] = df["high"].rolling(lookback).max()
-    df["ll_lb"] = df["low"].rolling(lookback).min()
+    # Lookback para rupturas: BREAKOUT_LOOKBACK (12 ≈ 60m). Extremos en O(n) / streaming.
+    lookback = BREAKOUT_LOOKBACK
+    if indicators is None:
+        df["hh_lb"] = rolling_max(df["high"].to_numpy(), lookback)
+        df["ll_lb"] = rolling_min(df["low"].to_numpy(), lookback)
 
     # Índice de vela
     i = df.index[-1] if use_live_candle else df.index[-2]
+    if indicators is None:
+        ind = df.loc[i, ["ema20", "ema50", "rsi14", "atr14"]]
+    else:
+        # Motor streaming: solo procesa las velas cerradas nuevas desde el ciclo anterior
+        ind = indicators.evaluate(df["time"].values, df["high"].values, df["low"].values,
+                                  df["close"].values, use_live_candle=use_live_candle, lookbacks=(lookback,))
 
     # Tendencia por EMAs (normalizada)
-    ema_spread = (df.loc[i, "ema20"] - df.loc[i, "ema50"]) / (df.loc[i, "atr14"] + 1e-8)
+    ema_spread = (ind["ema20"] - ind["ema50"]) / (ind["atr14"] + 1e-8)
 
     # Momentum a horizonte HORIZON_MIN
-    mom_h = df.loc[i, "ret_h"] / (((df["atr14"].loc[i] / df["close"].loc[i]) + 1e-8))
+    mom_h = df.loc[i, "ret_h"] / (((ind["atr14"] / df["close"].loc[i]) + 1e-8))
 
     # RSI centrado en 50
-    rsi_pos = (df.loc[i, "rsi14"] - 50.0) / 50.0  # [-1..+1 aprox]
+    rsi_pos = (ind["rsi14"] - 50.0) / 50.0  # [-1..+1 aprox]
 
     # Ruptura reciente
     close_i = df.loc[i, "close"]
     high_i  = df.loc[i, "high"]
     low_i   = df.loc[i, "low"]
-    hh_lb   = df.loc[i, "hh_lb"]
-    ll_lb   = df.loc[i, "ll_lb"]
+    hh_lb   = df.loc[i, "hh_lb"] if indicators is None else ind[f"hh{lookback}"]
+    ll_lb   = df.loc[i, "ll_lb"] if indicators is None else ind[f"ll{lookback}"]
     breakout_up = 1.0 if close_i > hh_lb * 0.999 else 0.0
     breakout_dn = 1.0 if close_i < ll_lb * 1.001 else 0.0
 
     # Hora de apertura y cierre de la vela evaluada
     tf_min = 5  # TIMEFRAME = M5
-    candle_open  = df.loc[i, "time"]
-    candle_close = candle_open + pd.Timedelta(minutes=tf_min)
+    candle_open  = int(df.loc[i, "time"])
+    candle_close = candle_open + tf_min * 60
 
-    # Detección de datos "viejos"
-    now = pd.Timestamp.now(tz=TZ)
-    age_min = (now - candle_close).total_seconds() / 60.0
+    # Detección de datos "viejos" (epoch en segundos, sin zona horaria)
+    age_min = (int(time.time()) - candle_close) / 60.0
 
     return {
         "ema_spread": float(ema_spread),
@@ -178,7 +205,7 @@ def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=Fal
         "rsi_pos": float(rsi_pos),
         "breakout_up": float(breakout_up),
         "breakout_dn": float(breakout_dn),
-        "atr": float(df.loc[i, "atr14"]),
+        "atr": float(ind["atr14"]),
         "price_close": float(close_i),
         "price_high": float(high_i),
         "price_low": float(low_i),
@@ -191,6 +218,57 @@ def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=Fal
         "age_min": float(age_min),
     }
 
+@STAGES.timed("feature_bundle")
+def feature_bundle_np(rates: np.ndarray, horizon_min: int, use_live_candle: bool=False,
+                      indicators: Optional[IndicatorSet]=None) -> dict:
+    """feature_bundle sobre el array de copy_rates_raw: sin copiar el DataFrame ni crear columnas completas.
+    EMA/RSI/ATR y extremos salen del IndicatorSet (exactos en la vela evaluada); ret_h de dos cierres.
+    """
+    n = len(rates)
+    if n < 100:
+        raise ValueError("Histórico insuficiente (<100 velas).")
+
+    bars_ahead = max(1, horizon_min // 5)
+    lookback = BREAKOUT_LOOKBACK
+    if indicators is None:
+        indicators = IndicatorSet(ATR_LEN)
+    close = rates["close"]
+    ind = indicators.evaluate(rates["time"], rates["high"], rates["low"], close,
+                              use_live_candle=use_live_candle, lookbacks=(lookback,))
+
+    i = n - 1 if use_live_candle else n - 2
+    close_i = float(close[i])
+    atr_i = ind["atr14"]
+    ema_spread = (ind["ema20"] - ind["ema50"]) / (atr_i + 1e-8)
+    mom_h = (close_i / float(close[i - bars_ahead]) - 1.0) / ((atr_i / close_i) + 1e-8)
+    rsi_pos = (ind["rsi14"] - 50.0) / 50.0
+    breakout_up = 1.0 if close_i > ind[f"hh{lookback}"] * 0.999 else 0.0
+    breakout_dn = 1.0 if close_i < ind[f"ll{lookback}"] * 1.001 else 0.0
+
+    tf_min = 5  # TIMEFRAME = M5
+    candle_open  = int(rates["time"][i])
+    candle_close = candle_open + tf_min * 60
+    age_min = (int(time.time()) - candle_close) / 60.0
+
+    return {
+        "ema_spread": float(ema_spread),
+        "mom_h": float(mom_h),
+        "rsi_pos": float(rsi_pos),
+        "breakout_up": breakout_up,
+        "breakout_dn": breakout_dn,
+        "atr": float(atr_i),
+        "price_close": close_i,
+        "price_high": float(rates["high"][i]),
+        "price_low": float(rates["low"][i]),
+        "time_open": candle_open,
+        "time_close": candle_close,
+        "time": candle_close,
+        "horizon_min": horizon_min,
+        "bars_ahead": bars_ahead,
+        "use_live_candle": use_live_candle,
+        "age_min": float(age_min),
+    }
+
 def sigmoid(x: float) -> float:
     return 1.0 / (1.0 + np.exp(-x))
 
@@ -265,8 +343,8 @@ def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
     """
     Mensaje ES + RU (para compra o venta). Incluye niveles y condición.
     """
-    ts_close = str(rec["time"])  # hora de cierre de la vela evaluada
-    ts_open  = str(feat.get("time_open"))
+    ts_close = str(local_time(rec["time"]))  # hora de cierre de la vela evaluada
+    ts_open  = str(local_time(feat["time_open"]))
     p = rec["p_up"] * 100.0
     horizon = rec.get("horizon_min", HORIZON_MIN_DEFAULT)
     age_min = rec.get("age_min", None)
@@ -338,14 +416,23 @@ def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
 # ===========================
 #       CICLOS / MAIN
 # ===========================
-def run_once(horizon_min: int, use_live_candle: bool=False):
+def run_once(horizon_min: int, use_live_candle: bool=False, keep_session: bool=False):
+    STAGES.begin_cycle()
     try:
         init_mt5()
         log(f"📊 Analizando {SYMBOL} M5…")
-        df = copy_rates(SYMBOL, TIMEFRAME, 600)  # ~50h de datos
-        log(f"📈 Últimas 3 velas: {list(df['time'].tail(3))}")
-
-        feat = feature_bundle(df, horizon_min=horizon_min, use_live_candle=use_live_candle)
+        if LEAN_FEATURES:
+            rates = copy_rates_raw(SYMBOL, TIMEFRAME, 600)  # ~50h de datos
+            if DEBUG:
+                log(f"📈 Últimas 3 velas: {[str(local_time(t)) for t in rates['time'][-3:]]}")
+            feat = feature_bundle_np(rates, horizon_min=horizon_min, use_live_candle=use_live_candle,
+                                     indicators=INDICATORS)
+        else:
+            df = copy_rates(SYMBOL, TIMEFRAME, 600)  # ~50h de datos
+            if DEBUG:
+                log(f"📈 Últimas 3 velas: {[str(local_time(t)) for t in df['time'].tail(3)]}")
+            feat = feature_bundle(df, horizon_min=horizon_min, use_live_candle=use_live_candle,
+                                  indicators=INDICATORS)
         if feat["age_min"] > 10 and not use_live_candle:
             log(f"⚠️ Datos retrasados {feat['age_min']:.1f} min; revisa conexión/mercado.")
 
@@ -358,22 +445,22 @@ def run_once(horizon_min: int, use_live_candle: bool=False):
         send_telegram(message)
 
     finally:
-        shutdown_mt5()
+        STAGES.end_cycle()
+        if not keep_session:
+            shutdown_mt5()
 
 def run_loop(every_minutes: int, horizon_min: int, use_live_candle: bool=False):
-    sleep_seconds = max(1, int(every_minutes * 60))
+    scheduler = BarCloseScheduler(every_minutes * 60, offset_ms=WAKE_AFTER_CLOSE_MS, timeframe=TIMEFRAME, log=log)
     log(f"♻️ LOOP: comprobación cada {every_minutes} minuto(s). Horizonte={horizon_min}m. Live={use_live_candle}.")
-    while True:
-        start_ts = time.time()
-        try:
-            run_once(horizon_min=horizon_min, use_live_candle=use_live_candle)
-        except Exception as e:
-            log(f"❌ Error en iteración: {e}")
-            shutdown_mt5()
-        elapsed = time.time() - start_ts
-        remaining = max(0, sleep_seconds - int(elapsed))
-        log(f"⏳ Siguiente comprobación en ~{remaining} s.")
-        time.sleep(remaining)
+    try:
+        while True:
+            try:
+                run_once(horizon_min=horizon_min, use_live_candle=use_live_candle, keep_session=True)
+            except Exception as e:
+                log(f"❌ Error en iteración: {e}")
+            scheduler.wait()
+    finally:
+        shutdown_mt5()
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Predicción USDJPY M5 a horizonte ajustable (envía compra o venta, ES+RU).")
@@ -0,0 +1,116 @@
+import numpy as np
+from mt5_session import TERMINAL_LOCK
+
+# Ventana máxima que pedimos "hacia delante" desde la última vela cacheada.
+# MT5 solo devuelve las velas existentes, así que basta con un margen amplio.
+INCREMENTAL_LOOKAHEAD_S = 366 * 24 * 3600
+
+# ===========================
+#      CACHÉ INCREMENTAL DE VELAS
+# ===========================
+class CandleCache:
+    """
+    Caché en memoria por (símbolo, timeframe) del array estructurado de velas de MT5.
+    - Primera petición (miss): copy_rates_from_pos(symbol, tf, 0, n) completo.
+    - Siguientes (hit): copy_rates_range desde la hora de la última vela cacheada;
+      esa vela (aún en formación) se reemplaza y las nuevas se añaden al final.
+    - Con store (BarStore): la primera ventana tras un reinicio sale del disco y
+      solo se pide a MT5 el hueco desde la última vela guardada (la ventana leída del
+      memmap se copia una vez a memoria al unirla con ese hueco). Si el hueco no se puede
+      cubrir, la descarga completa no solapa lo guardado y el store de ese símbolo se vacía.
+    Cada llamada a MT5 va bajo terminal_lock (compartido con órdenes, llenados y riesgo).
+    """
+
+    def __init__(self, api, max_bars: int = 5000, store=None, terminal_lock=TERMINAL_LOCK):
+        self.api = api
+        self.terminal_lock = terminal_lock
+        self.max_bars = max_bars
+        self.store = store
+        self._bars = {}
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.store_resets = 0
+        self.rows_fetched = 0
+
+    def _persist(self, symbol: str, timeframe: int, bars):
+        # La última vela puede estar en formación: solo se guardan las cerradas
+        if self.store is not None and len(bars) > 1:
+            self.store.append(symbol, timeframe, bars[:-1])
+
+    def _fetch_since(self, symbol: str, timeframe: int, last_time: int):
+        with self.terminal_lock:
+            return self.api.copy_rates_range(symbol, timeframe, last_time, last_time + INCREMENTAL_LOOKAHEAD_S)
+
+    def _from_disk(self, symbol: str, timeframe: int, n: int):
+        if self.store is None:
+            return None
+        disk = self.store.read(symbol, timeframe, n)
+        if disk is None:
+            return None
+        last_time = int(disk["time"][-1])
+        gap = self._fetch_since(symbol, timeframe, last_time)
+        if gap is None or len(gap) == 0 or int(gap["time"][0]) > last_time:
+            return None
+        bars = np.concatenate([disk[disk["time"] < gap["time"][0]], np.asarray(gap, dtype=disk.dtype)])
+        if len(bars) < n:
+            return None
+        self.disk_hits += 1
+        self.rows_fetched += len(gap)
+        self._persist(symbol, timeframe, gap)
+        self._bars[(symbol, timeframe)] = bars
+        return bars
+
+    def _full_fetch(self, symbol: str, timeframe: int, n: int):
+        with self.terminal_lock:
+            data = self.api.copy_rates_from_pos(symbol, timeframe, 0, n)
+        if data is None or len(data) == 0:
+            return None
+        self.misses += 1
+        self.rows_fetched += len(data)
+        bars = np.array(data)
+        if self.store is not None:
+            last = self.store.last_time(symbol, timeframe)
+            if last is not None and int(bars["time"][0]) > last:
+                # Sin solape con lo guardado: añadir dejaría un hueco permanente en el store
+                self.store.reset(symbol, timeframe)
+                self.store_resets += 1
+        self._persist(symbol, timeframe, bars)
+        self._bars[(symbol, timeframe)] = bars
+        return bars
+
+    def get(self, symbol: str, timeframe: int, n: int):
+        """Devuelve las últimas n velas (array estructurado de MT5) o None si no hay datos."""
+        bars = self._bars.get((symbol, timeframe))
+        if bars is None or len(bars) < n:
+            bars = self._from_disk(symbol, timeframe, n)
+            if bars is None:
+                bars = self._full_fetch(symbol, timeframe, n)
+            return None if bars is None else bars[-n:]
+
+        last_time = int(bars["time"][-1])
+        new = self._fetch_since(symbol, timeframe, last_time)
+        if new is None or len(new) == 0 or int(new["time"][0]) > last_time:
+            # Hueco o historial reescrito por el terminal: recarga completa
+            bars = self._full_fetch(symbol, timeframe, n)
+            return None if bars is None else bars[-n:]
+
+        self.hits += 1
+        self.rows_fetched += len(new)
+        self._persist(symbol, timeframe, new)
+        keep = bars[bars["time"] < new["time"][0]]
+        bars = np.concatenate([keep, np.asarray(new, dtype=bars.dtype)])
+        limit = max(self.max_bars, n)
+        if len(bars) > limit:
+            bars = bars[-limit:]
+        self._bars[(symbol, timeframe)] = bars
+        return bars[-n:]
+
+    def invalidate(self, symbol: str = None, timeframe: int = None):
+        for key in list(self._bars):
+            if (symbol is None or key[0] == symbol) and (timeframe is None or key[1] == timeframe):
+                del self._bars[key]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                "store_resets": self.store_resets, "rows_fetched": self.rows_fetched}
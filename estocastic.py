@@ -1,13 +1,20 @@
 import MetaTrader5 as mt5
 import pandas as pd
 import numpy as np
-import requests
 import json
 import os
 import time
 import argparse
 from typing import Optional
 from zoneinfo import ZoneInfo
+from mt5_session import MT5Session, TERMINAL_LOCK
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender
+from candle_cache import CandleCache
+from bar_store import BarStore
+from signal_store import SignalStore
+from indicators import rolling_max, rolling_min
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES (TU SCRIPT)
@@ -38,14 +45,23 @@ ATR_LEN = 14
 # A) Señal reciente: últimas N velas cerradas
 MAX_CLOSED_BARS_AGE = 6
 
-# B) Archivo de estado
-STATE_FILE = "last_signal.json"
+# B) Estado de señales enviadas (SQLite compartido; cada estrategia con su clave)
+STATE_DB = "signals.db"
+STRATEGY_NAME = "estocastic"
+LEGACY_STATE_FILE = "last_signal.json"  # estado anterior (una sola señal): se importa en el primer arranque
 
 # C) Zona horaria
 TZ = ZoneInfo("Europe/Madrid")
 
 # Verbosidad
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa y p50/p95/p99 en el log de cada ciclo; False = sin coste
+
+# Histórico local de velas cerradas (memmap); evita re-descargar al reiniciar
+BARS_DIR = "bars"
+
+# Planificador: despertar X ms después de cada cierre de vela (reloj monotónico)
+WAKE_AFTER_CLOSE_MS = 1000
 
 # ===========================
 #      UTILIDADES
@@ -54,68 +70,89 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+STAGES = StageTimer("estocastic", enabled=STAGE_TIMING, log=log)
+
+TELEGRAM = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
-    """Envía un único mensaje a Telegram (ES + RU)."""
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-        resp = requests.post(url, data=data, timeout=15)
-        if resp.status_code != 200:
-            log(f"⚠️ Telegram {resp.status_code}: {resp.text}")
-        else:
-            log("📨 Telegram OK")
-    except Exception as e:
-        log(f"❌ Telegram error: {e}")
+    """Encola el mensaje; el hilo de TELEGRAM lo entrega sin bloquear el ciclo."""
+    TELEGRAM.send(message)
 
+SESSION = MT5Session(mt5, MT5_LOGIN, MT5_PASSWORD, MT5_SERVER, path=PATH_TO_TERMINAL,
+                     symbols=[SYMBOL], log=log)
+CANDLES = CandleCache(mt5, store=BarStore(BARS_DIR))
+
+@STAGES.timed("init_mt5")
 def init_mt5():
     """Inicializa MT5, loguea, suscribe símbolo y fuerza datos (D)."""
-    log("🔌 Inicializando MetaTrader 5...")
-    ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
-    if not ok:
-        raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
-    if not mt5.login(login=MT5_LOGIN, password=MT5_PASSWORD, server=MT5_SERVER):
-        raise RuntimeError(f"Login error: {mt5.last_error()}")
-    if not mt5.symbol_select(SYMBOL, True):
-        raise RuntimeError(f"No se pudo suscribir a {SYMBOL}")
-    tick = mt5.symbol_info_tick(SYMBOL)
-    log(f"ℹ️ Tick inicial {SYMBOL}: {tick}")
+    connect_ms = SESSION.ensure()
+    with TERMINAL_LOCK:
+        tick = mt5.symbol_info_tick(SYMBOL)
+    log(f"ℹ️ Tick inicial {SYMBOL}: {tick} (conexión {connect_ms:.1f} ms)")
+
+def shutdown_mt5():
+    SESSION.close()
+    log("🔚 MT5 cerrado.")
 
+@STAGES.timed("copy_rates")
 def copy_rates(symbol, timeframe, n=500):
-    """Obtiene velas y las convierte a Europe/Madrid (C)."""
-    data = mt5.copy_rates_from_pos(symbol, timeframe, 0, n)
+    """Obtiene velas; "time" queda en epoch (s, UTC) y se convierte a Europe/Madrid solo al formatear (C)."""
+    data = CANDLES.get(symbol, timeframe, n)
     if data is None or len(data) == 0:
         raise RuntimeError("No se pudieron obtener datos de velas")
-    df = pd.DataFrame(data)
-    # MT5 da epoch UTC; localizamos y convertimos
-    df["time"] = pd.to_datetime(df["time"], unit="s", utc=True).dt.tz_convert(TZ)
-    return df
+    return pd.DataFrame(data)
+
+def local_time(epoch) -> pd.Timestamp:
+    """Epoch (s, UTC) de MT5 -> hora local TZ (mensajes y logs)."""
+    return pd.Timestamp(int(epoch), unit="s", tz="UTC").tz_convert(TZ)
 
+def signal_key(signal_time) -> str:
+    """Clave de deduplicación: la hora local de la vela, como la guardaba last_signal.json."""
+    return str(local_time(signal_time))
+
+SIGNALS = SignalStore(STATE_DB, strategy=STRATEGY_NAME, log=log)
+
+def import_legacy_state():
+    """
+    Primer arranque con signals.db: la última señal de last_signal.json se registra para esta
+    estrategia si aún no tiene ninguna, así el primer ciclo tras el despliegue no la reenvía.
+    """
+    if not os.path.exists(LEGACY_STATE_FILE):
+        return
+    try:
+        with open(LEGACY_STATE_FILE, "r", encoding="utf-8") as f:
+            last = json.load(f).get("last_time")
+        if last and SIGNALS.seed(SYMBOL, TIMEFRAME_SIGNAL, [last]):
+            log(f"ℹ️ Importada de {LEGACY_STATE_FILE} la última señal enviada: {last}")
+    except Exception as e:
+        log(f"⚠️ No se pudo importar {LEGACY_STATE_FILE}: {e}")
+
+@STAGES.timed("signal_store")
 def already_sent(signal_time) -> bool:
-    """True si ya enviamos una señal con ese timestamp (B)."""
-    if not os.path.exists(STATE_FILE):
-        return False
+    """True si ya enviamos una señal con ese timestamp para este símbolo/timeframe (B)."""
+    import_legacy_state()
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data.get("last_time") == str(signal_time)
+        return SIGNALS.already_sent(SYMBOL, TIMEFRAME_SIGNAL, signal_key(signal_time))
     except Exception as e:
-        log(f"⚠️ No se pudo leer {STATE_FILE}: {e}")
+        log(f"⚠️ No se pudo leer {STATE_DB}: {e}")
         return False
 
+@STAGES.timed("signal_store")
 def mark_sent(signal_time):
-    """Guarda el timestamp de la última señal enviada (B)."""
+    """Registra la señal enviada (transacción atómica; no reescribe el resto) (B)."""
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump({"last_time": str(signal_time)}, f)
+        SIGNALS.mark_sent(SYMBOL, TIMEFRAME_SIGNAL, signal_key(signal_time))
     except Exception as e:
-        log(f"⚠️ No se pudo guardar {STATE_FILE}: {e}")
+        log(f"⚠️ No se pudo guardar {STATE_DB}: {e}")
 
 # ===========================
 #      INDICADORES
 # ===========================
+@STAGES.timed("indicators")
 def stochastic(df, k=14, d=3, smooth=3):
-    low_min = df["low"].rolling(k).min()
-    high_max = df["high"].rolling(k).max()
+    low_min = pd.Series(rolling_min(df["low"].to_numpy(), k), index=df.index)
+    high_max = pd.Series(rolling_max(df["high"].to_numpy(), k), index=df.index)
     rng = (high_max - low_min).replace(0, np.nan)
     sto_k = 100 * (df["close"] - low_min) / rng
     sto_k = sto_k.rolling(smooth).mean()
@@ -123,6 +160,7 @@ def stochastic(df, k=14, d=3, smooth=3):
     df["sto_k"], df["sto_d"] = sto_k, sto_d
     return df
 
+@STAGES.timed("indicators")
 def atr(df, length=14):
     prev_close = df["close"].shift(1)
     tr = pd.concat([
@@ -135,13 +173,28 @@ def atr(df, length=14):
 # ===========================
 #      LÓGICA DE SEÑAL
 # ===========================
-def find_stochastic_signal(df):
+def find_stochastic_signal(df, last_n: Optional[int]=None):
     """
     Señal de compra:
     - %K < 20 y %D < 20 en la vela anterior
     - %K cruza %D al alza en la vela actual
     - %K actual > 20 (confirmación)
+    Escaneo vectorizado (máscara booleana sobre arrays desplazados). Con last_n solo
+    se revisan las últimas last_n velas (ruta rápida para la comprobación de recencia).
     """
+    k = df["sto_k"].to_numpy(dtype=float)
+    d = df["sto_d"].to_numpy(dtype=float)
+    start = 2 if last_n is None else max(2, len(k) - last_n)
+    if start >= len(k):
+        return []
+    k1, d1 = k[start-1:-1], d[start-1:-1]
+    k2, d2 = k[start:], d[start:]
+    # Las comparaciones con NaN son False: equivale al pd.notna del bucle original
+    mask = (k1 < d1) & (k2 > d2) & (k2 > 20) & (k1 < 20) & (d1 < 20)
+    return (np.flatnonzero(mask) + start).tolist()
+
+def find_stochastic_signal_loop(df):
+    """Versión original con bucle Python; solo se usa como referencia en --bench."""
     sig = []
     for i in range(2, len(df)):
         k1, d1 = df["sto_k"].iloc[i-1], df["sto_d"].iloc[i-1]
@@ -151,8 +204,10 @@ def find_stochastic_signal(df):
                 sig.append(i)
     return sig
 
-def get_trade_setup(df, atr_val) -> Optional[dict]:
-    sig_idx = find_stochastic_signal(df)
+@STAGES.timed("signal_scan")
+def get_trade_setup(df, atr_val, recent_bars: Optional[int]=None) -> Optional[dict]:
+    """recent_bars: si se indica, solo busca señales en esa ventana final (ruta rápida)."""
+    sig_idx = find_stochastic_signal(df, last_n=recent_bars)
     log(f"🔎 Señales encontradas (índices): {sig_idx}")
     if not sig_idx:
         log("ℹ️ No hay señales válidas aún.")
@@ -165,7 +220,7 @@ def get_trade_setup(df, atr_val) -> Optional[dict]:
     take_profit = float(entry_price + 2 * risk)  # 2R
 
     setup = {
-        "signal_time": df["time"].iloc[i],
+        "signal_time": int(df["time"].iloc[i]),
         "entry": entry_price,
         "stop": stop_price,
         "tp": take_profit,
@@ -189,7 +244,7 @@ def is_recent_signal(df, signal_index, max_closed_bars_age=2) -> bool:
     return ok
 
 def build_message(setup, atr_val) -> str:
-    sig_time_str = str(setup["signal_time"])
+    sig_time_str = str(local_time(setup["signal_time"]))
     mensaje = (
         "📊 Señal USDJPY detectada / Обнаружен сигнал USDJPY\n\n"
         "🇪🇸 ES\n"
@@ -212,13 +267,15 @@ def build_message(setup, atr_val) -> str:
 # ===========================
 #       CICLOS / MAIN
 # ===========================
-def run_once():
+def run_once(keep_session: bool=False):
+    STAGES.begin_cycle()
     try:
         init_mt5()
         log(f"📊 Analizando {SYMBOL} H1...")
 
         df = copy_rates(SYMBOL, TIMEFRAME_SIGNAL, 300)
-        log(f"📈 Últimas 3 velas: {list(df['time'].tail(3))}")
+        if DEBUG:
+            log(f"📈 Últimas 3 velas: {[str(local_time(t)) for t in df['time'].tail(3)]}")
 
         df = stochastic(df, STO_K, STO_D, STO_SMOOTH)
 
@@ -230,7 +287,9 @@ def run_once():
             log("ℹ️ ATR insuficiente (NaN).")
             return
 
-        setup = get_trade_setup(df, atr_val)
+        # Ruta rápida: solo interesan señales dentro de las últimas MAX_CLOSED_BARS_AGE velas
+        # cerradas (+ la vela en formación); is_recent_signal las valida igualmente.
+        setup = get_trade_setup(df, atr_val, recent_bars=MAX_CLOSED_BARS_AGE + 1)
         if setup is None:
             log("❌ Ninguna señal activa por ahora (criterios no cumplidos).")
             return
@@ -249,27 +308,58 @@ def run_once():
         mark_sent(setup["signal_time"])
 
     finally:
-        mt5.shutdown()
-        log("🔚 MT5 cerrado.")
+        STAGES.end_cycle()
+        if not keep_session:
+            shutdown_mt5()
 
 def run_loop(every_minutes: int):
-    sleep_seconds = max(1, int(every_minutes * 60))
+    scheduler = BarCloseScheduler(every_minutes * 60, offset_ms=WAKE_AFTER_CLOSE_MS, timeframe=TIMEFRAME_SIGNAL, log=log)
     log(f"♻️ Modo LOOP: comprobación cada {every_minutes} minuto(s).")
-    while True:
-        start_ts = time.time()
-        try:
-            run_once()
-        except Exception as e:
-            log(f"❌ Error en iteración: {e}")
+    try:
+        while True:
             try:
-                mt5.shutdown()
-            except Exception:
-                pass
-        # Dormir exactamente hasta completar el intervalo parametrizado
-        elapsed = time.time() - start_ts
-        remaining = max(0, sleep_seconds - int(elapsed))
-        log(f"⏳ Siguiente comprobación en ~{remaining} s.")
-        time.sleep(remaining)
+                run_once(keep_session=True)
+            except Exception as e:
+                log(f"❌ Error en iteración: {e}")
+            # Dormir hasta el siguiente cierre de vela (+WAKE_AFTER_CLOSE_MS); si hubo retraso, se salta el turno
+            scheduler.wait()
+    finally:
+        shutdown_mt5()
+
+# ===========================
+#       BENCHMARK
+# ===========================
+def benchmark_signal_scan(sizes=(10_000, 100_000, 1_000_000), loop_max: int=100_000, seed: int=7):
+    """Compara el escaneo vectorizado con el bucle original sobre históricos sintéticos."""
+    rng = np.random.default_rng(seed)
+    for n in sizes:
+        close = 150.0 + np.cumsum(rng.normal(0, 0.05, n))
+        df = pd.DataFrame({
+            "high": close + rng.uniform(0, 0.08, n),
+            "low": close - rng.uniform(0, 0.08, n),
+            "close": close,
+        })
+        df = stochastic(df, STO_K, STO_D, STO_SMOOTH)
+
+        t0 = time.perf_counter()
+        fast = find_stochastic_signal(df)
+        t_fast = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        find_stochastic_signal(df, last_n=MAX_CLOSED_BARS_AGE + 1)
+        t_recent = time.perf_counter() - t0
+
+        if n <= loop_max:
+            t0 = time.perf_counter()
+            slow = find_stochastic_signal_loop(df)
+            t_loop = time.perf_counter() - t0
+            if slow != fast:
+                raise AssertionError(f"n={n}: el escaneo vectorizado no coincide con el bucle")
+            loop_txt = f"bucle {t_loop*1000:9.1f} ms | x{t_loop / max(t_fast, 1e-9):7.0f}"
+        else:
+            loop_txt = "bucle (omitido)"
+        print(f"n={n:>9,} | señales={len(fast):>6} | vectorizado {t_fast*1000:7.2f} ms | "
+              f"ventana reciente {t_recent*1000:6.3f} ms | {loop_txt}", flush=True)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Detector de señales USDJPY (Stochastic + ATR) con alertas Telegram.")
@@ -277,11 +367,15 @@ def parse_args():
                         help="Intervalo de comprobación en minutos (por defecto: 5).")
     parser.add_argument("--once", action="store_true",
                         help="Ejecuta una sola vez y termina.")
+    parser.add_argument("--bench", action="store_true",
+                        help="Benchmark del escaneo de señales (10k-1M velas sintéticas) y termina.")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
-    if args.once:
+    if args.bench:
+        benchmark_signal_scan()
+    elif args.once:
         run_once()
     else:
         run_loop(args.every_min)
@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Iterable, Optional
+from mt5_session import TERMINAL_LOCK
+
+# Solapamiento al releer el historial desde la marca (s): los deals con el mismo
+# segundo que la marca se vuelven a pedir y se descartan por (time_msc, ticket).
+OVERLAP_S = 2
+# Margen hacia delante: la hora del servidor puede ir por delante de la local.
+LOOKAHEAD_S = 2 * 24 * 3600
+
+DEAL_SIDES = {0: "BUY", 1: "SELL"}             # DEAL_TYPE_BUY / DEAL_TYPE_SELL
+DEAL_ENTRIES = {0: "IN", 1: "OUT", 2: "INOUT", 3: "OUT_BY"}
+
+def parse_comment_field(comment: str, key: str) -> Optional[str]:
+    """Valor de 'key=...' en un comentario tipo 'HMv1|side=BUY|layer=2'."""
+    for part in (comment or "").split("|"):
+        if part.startswith(f"{key}="):
+            return part.split("=", 1)[1]
+    return None
+
+def fill_event(deal) -> dict:
+    layer = parse_comment_field(deal.comment, "layer")
+    return {
+        "ticket": deal.ticket,
+        "order": deal.order,
+        "position": deal.position_id,
+        "symbol": deal.symbol,
+        "side": DEAL_SIDES.get(deal.type, str(deal.type)),
+        "entry": DEAL_ENTRIES.get(deal.entry, str(deal.entry)),
+        "layer": int(layer) if layer is not None and layer.isdigit() else None,
+        "volume": deal.volume,
+        "price": deal.price,
+        "profit": deal.profit,
+        "comment": deal.comment,
+        "time_msc": deal.time_msc,
+    }
+
+# ===========================
+#      VIGILANTE DE LLENADOS
+# ===========================
+class FillWatcher:
+    """
+    Detecta llenados consultando history_deals_get desde una marca (time_msc, ticket):
+    - poll(): una consulta incremental; devuelve los eventos nuevos y avisa a los callbacks.
+    - start()/stop(): hilo que hace poll() cada interval_s (sub-segundo).
+    - La marca se guarda en state_path: tras un reinicio no se repiten ni se pierden eventos.
+    Filtra por símbolos y, opcionalmente, por prefijo de comentario (la etiqueta del bot).
+    """
+
+    def __init__(self, api, symbols: Iterable[str] = (), state_path: Optional[str] = None,
+                 interval_s: float = 0.25, comment_prefix: Optional[str] = None,
+                 on_fill: Optional[Callable[[dict], None]] = None, log: Callable[[str], None] = print,
+                 terminal_lock=TERMINAL_LOCK):
+        self.api = api
+        self.symbols = set(symbols)
+        self.state_path = state_path
+        self.interval_s = interval_s
+        self.comment_prefix = comment_prefix
+        self.log = log
+        self.callbacks = [on_fill] if on_fill else []
+        self.terminal_lock = terminal_lock
+        self.mark = self._load()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.polls = 0
+        self.events = 0
+        self.errors = 0
+        self.last_poll_ms = 0.0
+
+    def subscribe(self, fn: Callable[[dict], None]):
+        self.callbacks.append(fn)
+
+    # ---------- marca persistente ----------
+    def _load(self) -> Optional[tuple]:
+        if not self.state_path or not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return int(data["time_msc"]), int(data["ticket"])
+        except Exception as e:
+            self.log(f"⚠️ No se pudo leer {self.state_path}: {e}")
+            return None
+
+    def _save(self):
+        if not self.state_path or self.mark is None:
+            return
+        try:
+            tmp = f"{self.state_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"time_msc": self.mark[0], "ticket": self.mark[1]}, f)
+            os.replace(tmp, self.state_path)
+        except Exception as e:
+            self.log(f"⚠️ No se pudo guardar {self.state_path}: {e}")
+
+    # ---------- consulta ----------
+    def _wanted(self, deal) -> bool:
+        if deal.type not in DEAL_SIDES:
+            return False
+        if self.symbols and deal.symbol not in self.symbols:
+            return False
+        if self.comment_prefix and not (deal.comment or "").startswith(self.comment_prefix):
+            return False
+        return True
+
+    def poll(self) -> list:
+        with self._lock:
+            t0 = time.perf_counter()
+            self.polls += 1
+            now = int(time.time())
+            # Sin marca: se lee todo una vez solo para fijarla (no se reenvía el pasado)
+            date_from = 0 if self.mark is None else max(0, self.mark[0] // 1000 - OVERLAP_S)
+            with self.terminal_lock:
+                deals = self.api.history_deals_get(date_from, now + LOOKAHEAD_S)
+            self.last_poll_ms = (time.perf_counter() - t0) * 1000.0
+            if deals is None:
+                self.errors += 1
+                return []
+            deals = sorted(deals, key=lambda d: (d.time_msc, d.ticket))
+            if self.mark is None:
+                self.mark = (deals[-1].time_msc, deals[-1].ticket) if deals else (0, 0)
+                self._save()
+                return []
+            new = [d for d in deals if (d.time_msc, d.ticket) > self.mark]
+            if not new:
+                return []
+            self.mark = (new[-1].time_msc, new[-1].ticket)
+            self._save()
+            events = [fill_event(d) for d in new if self._wanted(d)]
+            self.events += len(events)
+        for event in events:
+            for fn in self.callbacks:
+                try:
+                    fn(event)
+                except Exception as e:
+                    self.log(f"❌ Callback de llenado: {e}")
+        return events
+
+    # ---------- hilo ----------
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.errors += 1
+                self.log(f"⚠️ FillWatcher: {e}")
+            self._stop.wait(self.interval_s)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="fill-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(1.0, 2 * self.interval_s))
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {"polls": self.polls, "events": self.events, "errors": self.errors,
+                "last_poll_ms": self.last_poll_ms, "mark": self.mark}
@@ -1,13 +1,19 @@
 import MetaTrader5 as mt5
 import pandas as pd
 import numpy as np
-import requests
 import json
 import os
 import time
 import argparse
 from typing import Optional
 from zoneinfo import ZoneInfo
+from mt5_session import MT5Session, TERMINAL_LOCK
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender
+from candle_cache import CandleCache
+from bar_store import BarStore
+from signal_store import SignalStore
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES (TU SCRIPT)
@@ -40,14 +46,23 @@ RSI_OVERBOUGHT = 70
 # A) Señal reciente: últimas N velas cerradas
 MAX_CLOSED_BARS_AGE = 2
 
-# B) Archivo de estado
-STATE_FILE = "last_signal.json"
+# B) Estado de señales enviadas (SQLite compartido; cada estrategia con su clave)
+STATE_DB = "signals.db"
+STRATEGY_NAME = "gold_forecast"
+LEGACY_STATE_FILE = "last_signal.json"  # estado anterior (una sola señal): se importa en el primer arranque
 
 # C) Zona horaria
 TZ = ZoneInfo("Europe/Madrid")
 
 # Verbosidad
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa y p50/p95/p99 en el log de cada ciclo; False = sin coste
+
+# Histórico local de velas cerradas (memmap); evita re-descargar al reiniciar
+BARS_DIR = "bars"
+
+# Planificador: despertar X ms después de cada cierre de vela (reloj monotónico)
+WAKE_AFTER_CLOSE_MS = 1000
 
 # ===========================
 #      UTILIDADES
@@ -56,65 +71,86 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+STAGES = StageTimer("gold_forecast", enabled=STAGE_TIMING, log=log)
+
+TELEGRAM = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
-    """Envía un único mensaje a Telegram (ES + RU)."""
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-        resp = requests.post(url, data=data, timeout=15)
-        if resp.status_code != 200:
-            log(f"⚠️ Telegram {resp.status_code}: {resp.text}")
-        else:
-            log("📨 Telegram OK")
-    except Exception as e:
-        log(f"❌ Telegram error: {e}")
+    """Encola el mensaje; el hilo de TELEGRAM lo entrega sin bloquear el ciclo."""
+    TELEGRAM.send(message)
+
+SESSION = MT5Session(mt5, MT5_LOGIN, MT5_PASSWORD, MT5_SERVER, path=PATH_TO_TERMINAL,
+                     symbols=[SYMBOL], log=log)
+CANDLES = CandleCache(mt5, store=BarStore(BARS_DIR))
 
+@STAGES.timed("init_mt5")
 def init_mt5():
     """Inicializa MT5, loguea, suscribe símbolo y fuerza datos (D)."""
-    log("🔌 Inicializando MetaTrader 5...")
-    ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
-    if not ok:
-        raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
-    if not mt5.login(login=MT5_LOGIN, password=MT5_PASSWORD, server=MT5_SERVER):
-        raise RuntimeError(f"Login error: {mt5.last_error()}")
-    if not mt5.symbol_select(SYMBOL, True):
-        raise RuntimeError(f"No se pudo suscribir a {SYMBOL}")
-    tick = mt5.symbol_info_tick(SYMBOL)
-    log(f"ℹ️ Tick inicial {SYMBOL}: {tick}")
+    connect_ms = SESSION.ensure()
+    with TERMINAL_LOCK:
+        tick = mt5.symbol_info_tick(SYMBOL)
+    log(f"ℹ️ Tick inicial {SYMBOL}: {tick} (conexión {connect_ms:.1f} ms)")
+
+def shutdown_mt5():
+    SESSION.close()
+    log("🔚 MT5 cerrado.")
 
+@STAGES.timed("copy_rates")
 def copy_rates(symbol, timeframe, n=500):
-    """Obtiene velas y las convierte a Europe/Madrid (C)."""
-    data = mt5.copy_rates_from_pos(symbol, timeframe, 0, n)
+    """Obtiene velas; "time" queda en epoch (s, UTC) y se convierte a Europe/Madrid solo al formatear (C)."""
+    data = CANDLES.get(symbol, timeframe, n)
     if data is None or len(data) == 0:
         raise RuntimeError("No se pudieron obtener datos de velas")
-    df = pd.DataFrame(data)
-    # MT5 da epoch UTC; localizamos y convertimos
-    df["time"] = pd.to_datetime(df["time"], unit="s", utc=True).dt.tz_convert(TZ)
-    return df
+    return pd.DataFrame(data)
+
+def local_time(epoch) -> pd.Timestamp:
+    """Epoch (s, UTC) de MT5 -> hora local TZ (mensajes y logs)."""
+    return pd.Timestamp(int(epoch), unit="s", tz="UTC").tz_convert(TZ)
+
+def signal_key(signal_time) -> str:
+    """Clave de deduplicación: la hora local de la vela, como la guardaba last_signal.json."""
+    return str(local_time(signal_time))
 
+SIGNALS = SignalStore(STATE_DB, strategy=STRATEGY_NAME, log=log)
+
+def import_legacy_state():
+    """
+    Primer arranque con signals.db: la última señal de last_signal.json se registra para esta
+    estrategia si aún no tiene ninguna, así el primer ciclo tras el despliegue no la reenvía.
+    """
+    if not os.path.exists(LEGACY_STATE_FILE):
+        return
+    try:
+        with open(LEGACY_STATE_FILE, "r", encoding="utf-8") as f:
+            last = json.load(f).get("last_time")
+        if last and SIGNALS.seed(SYMBOL, TIMEFRAME_SIGNAL, [last]):
+            log(f"ℹ️ Importada de {LEGACY_STATE_FILE} la última señal enviada: {last}")
+    except Exception as e:
+        log(f"⚠️ No se pudo importar {LEGACY_STATE_FILE}: {e}")
+
+@STAGES.timed("signal_store")
 def already_sent(signal_time) -> bool:
-    """True si ya enviamos una señal con ese timestamp (B)."""
-    if not os.path.exists(STATE_FILE):
-        return False
+    """True si ya enviamos una señal con ese timestamp para este símbolo/timeframe (B)."""
+    import_legacy_state()
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data.get("last_time") == str(signal_time)
+        return SIGNALS.already_sent(SYMBOL, TIMEFRAME_SIGNAL, signal_key(signal_time))
     except Exception as e:
-        log(f"⚠️ No se pudo leer {STATE_FILE}: {e}")
+        log(f"⚠️ No se pudo leer {STATE_DB}: {e}")
         return False
 
+@STAGES.timed("signal_store")
 def mark_sent(signal_time):
-    """Guarda el timestamp de la última señal enviada (B)."""
+    """Registra la señal enviada (transacción atómica; no reescribe el resto) (B)."""
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump({"last_time": str(signal_time)}, f)
+        SIGNALS.mark_sent(SYMBOL, TIMEFRAME_SIGNAL, signal_key(signal_time))
     except Exception as e:
-        log(f"⚠️ No se pudo guardar {STATE_FILE}: {e}")
+        log(f"⚠️ No se pudo guardar {STATE_DB}: {e}")
 
 # ===========================
 #      INDICADORES
 # ===========================
+@STAGES.timed("indicators")
 def atr(df, length=14):
     prev_close = df["close"].shift(1)
     tr = pd.concat([
@@ -124,6 +160,7 @@ def atr(df, length=14):
     ], axis=1).max(axis=1)
     return tr.rolling(length).mean()
 
+@STAGES.timed("indicators")
 def rsi(close: pd.Series, length=14):
     delta = close.diff()
     up = delta.clip(lower=0)
@@ -157,6 +194,7 @@ def find_rsi_signal(df) -> Optional[tuple]:
         return (i, "short")
     return None
 
+@STAGES.timed("signal_scan")
 def get_trade_setup(df, atr_val) -> Optional[dict]:
     """
     Construye setup LONG/SHORT según RSI extremo en la vela cerrada.
@@ -185,7 +223,7 @@ def get_trade_setup(df, atr_val) -> Optional[dict]:
         cond_ru = "дождаться пробоя минимума сигнальной свечи."
 
     setup = {
-        "signal_time": df["time"].iloc[i],
+        "signal_time": int(df["time"].iloc[i]),
         "entry": entry_price,
         "stop": stop_price,
         "tp": take_profit,
@@ -216,7 +254,7 @@ def build_message(setup, atr_val) -> str:
     Mantiene EXACTAMENTE la estructura del mensaje original de Telegram.
     Solo cambia dinámicamente la línea de 'Condición' según LONG/SHORT por RSI.
     """
-    sig_time_str = str(setup["signal_time"])
+    sig_time_str = str(local_time(setup["signal_time"]))
     mensaje = (
         "📊 Señal USDJPY detectada / Обнаружен сигнал USDJPY\n\n"
         "🇪🇸 ES\n"
@@ -239,14 +277,16 @@ def build_message(setup, atr_val) -> str:
 # ===========================
 #       CICLOS / MAIN
 # ===========================
-def run_once():
+def run_once(keep_session: bool=False):
+    STAGES.begin_cycle()
     try:
         init_mt5()
         log(f"📊 Analizando {SYMBOL} H1...")
 
         # Datos para la señal
         df = copy_rates(SYMBOL, TIMEFRAME_SIGNAL, 300)
-        log(f"📈 Últimas 3 velas: {list(df['time'].tail(3))}")
+        if DEBUG:
+            log(f"📈 Últimas 3 velas: {[str(local_time(t)) for t in df['time'].tail(3)]}")
 
         # --- RSI para señal ---
         df["rsi"] = rsi(df["close"], RSI_LEN)
@@ -280,27 +320,23 @@ def run_once():
         mark_sent(setup["signal_time"])
 
     finally:
-        mt5.shutdown()
-        log("🔚 MT5 cerrado.")
+        STAGES.end_cycle()
+        if not keep_session:
+            shutdown_mt5()
 
 def run_loop(every_minutes: int):
-    sleep_seconds = max(1, int(every_minutes * 60))
+    scheduler = BarCloseScheduler(every_minutes * 60, offset_ms=WAKE_AFTER_CLOSE_MS, timeframe=TIMEFRAME_SIGNAL, log=log)
     log(f"♻️ Modo LOOP: comprobación cada {every_minutes} minuto(s).")
-    while True:
-        start_ts = time.time()
-        try:
-            run_once()
-        except Exception as e:
-            log(f"❌ Error en iteración: {e}")
+    try:
+        while True:
             try:
-                mt5.shutdown()
-            except Exception:
-                pass
-        # Dormir exactamente hasta completar el intervalo parametrizado
-        elapsed = time.time() - start_ts
-        remaining = max(0, sleep_seconds - int(elapsed))
-        log(f"⏳ Siguiente comprobación en ~{remaining} s.")
-        time.sleep(remaining)
+                run_once(keep_session=True)
+            except Exception as e:
+                log(f"❌ Error en iteración: {e}")
+            # Dormir hasta el siguiente cierre de vela (+WAKE_AFTER_CLOSE_MS); si hubo retraso, se salta el turno
+            scheduler.wait()
+    finally:
+        shutdown_mt5()
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Detector de señales USDJPY (RSI + ATR) con alertas Telegram.")
@@ -0,0 +1,373 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+from typing import Optional
+
+import numpy as np
+
+from bar_store import BarStore
+
+# ===========================
+#      PARÁMETROS (mismos valores por defecto que martingala.py)
+# ===========================
+DEFAULT_PARAMS = {
+    "base_lot": 0.01,           # BASE_LOT
+    "marti_mult": 1.6,          # MARTI_MULT
+    "step_pips": 12,            # STEP_PIPS
+    "max_layers": 5,            # MAX_LAYERS_PER_SIDE
+    "basket_tp_money": 2.50,    # BASKET_TP_MONEY (None = desactivado)
+    "basket_tp_pct": 0.15,      # BASKET_TP_PCT (None = desactivado)
+    "max_total_volume": 0.50,   # MAX_TOTAL_VOLUME
+    "max_drawdown_pct": 10.0,   # MAX_DRAWDOWN_PCT
+    "rebuild_on_flat": True,    # REBUILD_ON_FLAT
+    # Símbolo (USDJPY): pip = 10 * point, P/L en JPY convertido a la divisa de la cuenta (/precio)
+    "pip": 0.01,
+    "contract_size": 100000.0,
+    "spread_pips": 1.0,
+    "quote_to_account": True,
+    # Cuenta / simulación
+    "balance": 1000.0,
+    "every_min": 1,             # --every-min de martingala.py (un ciclo cada N velas M1)
+    "ruin_pct": 50.0,           # ruina: equity <= balance inicial * (1 - ruin_pct/100)
+}
+
+TIMEFRAME_M1 = 1            # valor de mt5.TIMEFRAME_M1
+MINUTES_PER_YEAR = 365 * 24 * 60
+BLOCK = 1440                # velas generadas por bloque (acota memoria: P x BLOCK)
+DEBUG = True
+
+def log(msg: str):
+    if DEBUG:
+        print(msg, flush=True)
+
+def lot_for_layer(layer: int, p: dict) -> float:
+    return round(p["base_lot"] * (p["marti_mult"] ** layer), 2)
+
+# ===========================
+#      GENERADORES DE CAMINOS (bloques P x B de velas M1: open/high/low/close en bid)
+# ===========================
+def gbm_paths(n_paths: int, n_steps: int, p0: float, sigma_annual: float = 0.10, mu_annual: float = 0.0,
+              seed: int = 0, block: int = BLOCK):
+    """Movimiento browniano geométrico por minuto; máximos/mínimos con el rango esperado del puente browniano."""
+    rng = np.random.default_rng(seed)
+    sigma = sigma_annual / np.sqrt(MINUTES_PER_YEAR)
+    drift = mu_annual / MINUTES_PER_YEAR - 0.5 * sigma ** 2
+    last = np.full(n_paths, float(p0))
+    for start in range(0, n_steps, block):
+        b = min(block, n_steps - start)
+        steps = drift + sigma * rng.standard_normal((n_paths, b))
+        close = last[:, None] * np.exp(np.cumsum(steps, axis=1))
+        open_ = np.concatenate([last[:, None], close[:, :-1]], axis=1)
+        wick = np.abs(rng.standard_normal((2, n_paths, b))) * sigma * 0.6 * close
+        yield open_, np.maximum(open_, close) + wick[0], np.minimum(open_, close) - wick[1], close
+        last = close[:, -1]
+
+def relative_bars(bars) -> np.ndarray:
+    """(N-1, 4) movimientos open/high/low/close de cada vela relativos al cierre anterior."""
+    prev = np.asarray(bars["close"][:-1], dtype=float)
+    return np.column_stack([np.asarray(bars[f][1:], dtype=float) / prev for f in ("open", "high", "low", "close")])
+
+def bootstrap_paths(rel: np.ndarray, n_paths: int, n_steps: int, p0: float, block_len: int = 60,
+                    seed: int = 0, block: int = BLOCK):
+    """Bootstrap por bloques de velas históricas (conserva volatilidad intradía y rachas cortas)."""
+    rng = np.random.default_rng(seed)
+    n = len(rel) - block_len
+    if n <= 0:
+        raise ValueError("Histórico insuficiente para el bootstrap.")
+    last = np.full(n_paths, float(p0))
+    offs = np.arange(block_len)
+    for start in range(0, n_steps, block):
+        b = min(block, n_steps - start)
+        k = -(-b // block_len)
+        idx = (rng.integers(0, n, (n_paths, k))[:, :, None] + offs).reshape(n_paths, -1)[:, :b]
+        r = rel[idx]                                   # (P, b, 4)
+        close = last[:, None] * np.cumprod(r[:, :, 3], axis=1)
+        prev = np.concatenate([last[:, None], close[:, :-1]], axis=1)
+        yield prev * r[:, :, 0], prev * r[:, :, 1], prev * r[:, :, 2], close
+        last = close[:, -1]
+
+def history_path(bars, block: int = BLOCK):
+    """Reproduce una serie real (un único camino)."""
+    cols = [np.asarray(bars[f], dtype=float)[None, :] for f in ("open", "high", "low", "close")]
+    for start in range(0, cols[0].shape[1], block):
+        yield tuple(c[:, start:start + block] for c in cols)
+
+def ticks_to_m1(ticks):
+    """Agrega ticks (formato copy_ticks / mt5sim.TICK_DTYPE) a velas M1 de bid + spread máximo por minuto."""
+    minute = ticks["time_msc"] // 60000
+    starts = np.flatnonzero(np.concatenate([[True], minute[1:] != minute[:-1]]))
+    ends = np.concatenate([starts[1:], [len(ticks)]]) - 1
+    bid = np.asarray(ticks["bid"], dtype=float)
+    spread = np.asarray(ticks["ask"], dtype=float) - bid
+    return {
+        "time": minute[starts] * 60,
+        "open": bid[starts],
+        "high": np.maximum.reduceat(bid, starts),
+        "low": np.minimum.reduceat(bid, starts),
+        "close": bid[ends],
+        "spread_px": np.maximum.reduceat(spread, starts),
+    }
+
+# ===========================
+#      MOTOR (vectorizado sobre caminos)
+# ===========================
+def simulate(blocks, n_paths: int, params: Optional[dict] = None) -> dict:
+    """
+    Reproduce run_once() de martingala.py sobre cada vela M1 de todos los caminos a la vez.
+    Entre ciclos: las órdenes stop se llenan si el ask/bid de la vela cruza el nivel (con gap, a la apertura).
+    En cada ciclo (cierre de vela, cada every_min), en el mismo orden que run_once():
+      1) enforce_limits(): DD >= max_drawdown_pct -> cierra todo y borra pendientes;
+         volumen > max_total_volume -> borra pendientes. En ambos casos termina el ciclo.
+      2) try_close_basket(): P/L >= basket_tp_money o >= basket_tp_pct% del balance -> cierra todo.
+      3) ensure_grid(): sin posiciones (REBUILD_ON_FLAT) o sin nada -> rejilla nueva anclada al precio medio.
+    """
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    L = int(p["max_layers"])
+    is_buy = np.array([True] * L + [False] * L)
+    sign = np.where(is_buy, 1.0, -1.0)
+    offs = sign * (np.tile(np.arange(1, L + 1), 2) * p["step_pips"] * p["pip"])
+    lots = np.array([lot_for_layer(k, p) for k in range(L)] * 2)
+    spread_default = p["spread_pips"] * p["pip"]
+    cs = p["contract_size"]
+    tp_money = p["basket_tp_money"]
+    tp_pct = p["basket_tp_pct"]
+    every = max(1, int(p["every_min"]))
+    ruin_equity = p["balance"] * (1.0 - p["ruin_pct"] / 100.0)
+
+    P = n_paths
+    ord_act = np.zeros((P, 2 * L), dtype=bool)
+    ord_px = np.zeros((P, 2 * L))
+    pos_open = np.zeros((P, 2 * L), dtype=bool)
+    pos_px = np.zeros((P, 2 * L))
+    balance = np.full(P, float(p["balance"]))
+    peak = balance.copy()
+    max_dd = np.zeros(P)
+    min_equity = balance.copy()
+    alive = np.ones(P, dtype=bool)
+    t_ruin = np.full(P, -1)
+    ruin_eq = np.zeros(P)       # equity al arruinarse (el camino queda cerrado y congelado)
+    kills = np.zeros(P, dtype=int)
+    baskets = np.zeros(P, dtype=int)
+    vol_limits = np.zeros(P, dtype=int)
+    max_volume = np.zeros(P)
+
+    def floating(bid, ask, open_mask):
+        # P/L por posición: compras a bid, ventas a ask
+        px = np.where(is_buy, bid[:, None], ask[:, None])
+        pl = np.where(open_mask, sign * (px - pos_px) * lots * cs, 0.0).sum(axis=1)
+        return pl / bid if p["quote_to_account"] else pl
+
+    t = 0
+    for block in blocks:
+        o_b, h_b, l_b, c_b = block[:4]
+        spread_b = block[4] if len(block) > 4 else None
+        for k in range(o_b.shape[1]):
+            o, h, l, c = o_b[:, k], h_b[:, k], l_b[:, k], c_b[:, k]
+            spread = spread_default if spread_b is None else spread_b[:, k]
+
+            # Llenado de stops durante la vela
+            trig = np.where(is_buy, (h + spread)[:, None] >= ord_px, l[:, None] <= ord_px)
+            fill = ord_act & trig & alive[:, None]
+            if fill.any():
+                gap_px = np.where(is_buy, np.maximum(ord_px, (o + spread)[:, None]), np.minimum(ord_px, o[:, None]))
+                pos_px = np.where(fill, gap_px, pos_px)
+                pos_open |= fill
+                ord_act &= ~fill
+
+            # Peor equity dentro de la vela: el P/L es lineal en el precio, así que el peor caso
+            # está en el mínimo o en el máximo (todas las posiciones valoradas al mismo precio)
+            if pos_open.any():
+                worst = balance + np.minimum(floating(l, l + spread, pos_open), floating(h, h + spread, pos_open))
+                min_equity = np.minimum(min_equity, np.where(alive, worst, min_equity))
+                max_dd = np.maximum(max_dd, np.where(alive, (peak - worst) / peak * 100.0, 0.0))
+                ruined = alive & (worst <= ruin_equity)
+                if ruined.any():
+                    # Se liquida a esa equity: sin posiciones ni órdenes, no se revalora después
+                    t_ruin[ruined] = t
+                    ruin_eq[ruined] = worst[ruined]
+                    balance = np.where(ruined, worst, balance)
+                    pos_open[ruined] = False
+                    ord_act[ruined] = False
+                    alive &= ~ruined
+
+            t += 1
+            if t % every:
+                continue
+
+            # ---------- ciclo run_once() al cierre de la vela ----------
+            bid, ask = c, c + spread
+            pl = floating(bid, ask, pos_open)
+            equity = balance + pl
+            peak = np.where(alive, np.maximum(peak, equity), peak)
+
+            # 1) enforce_limits()
+            dd_pct = np.maximum(0.0, balance - equity) / balance * 100.0
+            kill = alive & (dd_pct >= p["max_drawdown_pct"])
+            vol = (pos_open * lots).sum(axis=1)
+            max_volume = np.maximum(max_volume, vol)
+            vlim = alive & ~kill & (vol > p["max_total_volume"])
+            # 2) try_close_basket()
+            acted = kill | vlim
+            basket = alive & ~acted & (((tp_money is not None) & (pl >= (tp_money or 0.0)))
+                                       | ((tp_pct is not None) & (balance > 0) & (pl >= balance * (tp_pct or 0.0) / 100.0)))
+            close_all = kill | basket
+            if close_all.any():
+                balance = np.where(close_all, balance + pl, balance)
+                pos_open[close_all] = False
+                ord_act[close_all] = False
+                kills += kill
+                baskets += basket
+            if vlim.any():
+                ord_act[vlim] = False
+                vol_limits += vlim
+
+            # 3) ensure_grid()
+            have_pos = pos_open.any(axis=1)
+            have_ord = ord_act.any(axis=1)
+            rebuild = alive & ~acted & (~(have_pos | have_ord) | (bool(p["rebuild_on_flat"]) & ~have_pos))
+            if rebuild.any():
+                anchor = (bid + ask) / 2.0
+                ord_px[rebuild] = anchor[rebuild, None] + offs
+                ord_act[rebuild] = True
+
+    # Cierre contable al final (equity a mercado)
+    final_equity = balance + floating(c, c + (spread_default if spread_b is None else spread_b[:, -1]), pos_open)
+    final_equity = np.where(alive, final_equity, ruin_eq)
+    return {
+        "final_equity": final_equity,
+        "max_dd_pct": max_dd,
+        "min_equity": min_equity,
+        "t_ruin": t_ruin,
+        "kills": kills,
+        "baskets": baskets,
+        "vol_limits": vol_limits,
+        "max_volume": max_volume,
+        "steps": t,
+    }
+
+# ===========================
+#      MONTE CARLO EN PARALELO
+# ===========================
+def _run_chunk(job: dict) -> dict:
+    if job["mode"] == "gbm":
+        blocks = gbm_paths(job["paths"], job["steps"], job["p0"], job["sigma"], job["mu"], seed=job["seed"])
+    else:
+        blocks = bootstrap_paths(job["rel"], job["paths"], job["steps"], job["p0"], job["block_len"], seed=job["seed"])
+    return simulate(blocks, job["paths"], job["params"])
+
+def monte_carlo(n_paths: int, n_steps: int, p0: float, mode: str = "gbm", params: Optional[dict] = None,
+                sigma: float = 0.10, mu: float = 0.0, rel: Optional[np.ndarray] = None, block_len: int = 60,
+                seed: int = 0, workers: int = 1) -> dict:
+    """Reparte los caminos en trozos (uno por proceso); cada trozo va vectorizado sobre sus caminos."""
+    workers = max(1, min(workers, n_paths))
+    sizes = [n_paths // workers + (1 if k < n_paths % workers else 0) for k in range(workers)]
+    jobs = [{"mode": mode, "paths": s, "steps": n_steps, "p0": p0, "sigma": sigma, "mu": mu, "rel": rel,
+             "block_len": block_len, "seed": seed + k, "params": params} for k, s in enumerate(sizes)]
+    if workers == 1:
+        parts = [_run_chunk(jobs[0])]
+    else:
+        with Pool(workers) as pool:
+            parts = pool.map(_run_chunk, jobs)
+    out = {key: np.concatenate([part[key] for part in parts]) for key in parts[0] if key != "steps"}
+    out["steps"] = n_steps
+    return out
+
+def summarize(res: dict, params: Optional[dict] = None) -> dict:
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    start = p["balance"]
+    ret = (res["final_equity"] / start - 1.0) * 100.0
+    ruined = res["t_ruin"] >= 0
+    q = (5, 50, 95, 99)
+    return {
+        "paths": len(ret),
+        "ret_pct": dict(zip(q, np.percentile(ret, q))),
+        "max_dd_pct": dict(zip(q, np.percentile(res["max_dd_pct"], q))),
+        "p_loss": float((ret < 0).mean()),
+        "p_ruin": float(ruined.mean()),
+        "ruin_days_p50": float(np.median(res["t_ruin"][ruined]) / 1440.0) if ruined.any() else float("nan"),
+        "ruin_days_p05": float(np.percentile(res["t_ruin"][ruined], 5) / 1440.0) if ruined.any() else float("nan"),
+        "kills_mean": float(res["kills"].mean()),
+        "baskets_mean": float(res["baskets"].mean()),
+        "vol_limit_paths": float((res["vol_limits"] > 0).mean()),
+        "max_volume": float(res["max_volume"].max()),
+    }
+
+def print_summary(s: dict, days: float, params: Optional[dict] = None):
+    p = {**DEFAULT_PARAMS, **(params or {})}
+    fmt = lambda d: "  ".join(f"p{k}={v:+7.2f}%" for k, v in d.items())
+    log(f"🎲 {s['paths']} caminos x {days:g} días | balance {p['balance']:.0f} | "
+        f"lote {p['base_lot']} x{p['marti_mult']} | paso {p['step_pips']} pips | capas {p['max_layers']}")
+    log(f"   Retorno:      {fmt(s['ret_pct'])}")
+    log(f"   DD máx:       {fmt(s['max_dd_pct'])}")
+    log(f"   P(pérdida)={s['p_loss'] * 100:.1f}%  P(ruina {p['ruin_pct']:.0f}%)={s['p_ruin'] * 100:.2f}%  "
+        f"días a ruina p5/p50={s['ruin_days_p05']:.1f}/{s['ruin_days_p50']:.1f}")
+    log(f"   Kill-switch/camino={s['kills_mean']:.2f}  cestas TP/camino={s['baskets_mean']:.1f}  "
+        f"límite volumen en {s['vol_limit_paths'] * 100:.1f}% caminos  volumen máx={s['max_volume']:.2f}")
+
+# ===========================
+#      MAIN
+# ===========================
+def load_m1(root: str, symbol: str):
+    """M1 del BarStore (bars/ o datos de mt5sim) o, si existe, ticks {symbol}.ticks agregados a M1."""
+    tick_path = os.path.join(root, f"{symbol}.ticks")
+    if os.path.exists(tick_path):
+        from mt5sim import TICK_DTYPE
+        return ticks_to_m1(np.fromfile(tick_path, dtype=TICK_DTYPE))
+    bars = BarStore(root).read(symbol, TIMEFRAME_M1)
+    if bars is None:
+        raise SystemExit(f"No hay M1 ni ticks de {symbol} en {root}/")
+    return {f: np.asarray(bars[f]) for f in ("time", "open", "high", "low", "close")}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulador Monte Carlo de la rejilla hedging+martingala (martingala.py).")
+    parser.add_argument("--mode", choices=("gbm", "bootstrap", "replay"), default="gbm",
+                        help="gbm: caminos sintéticos; bootstrap: bloques de M1 históricos; replay: la serie real.")
+    parser.add_argument("--paths", type=int, default=2000)
+    parser.add_argument("--days", type=float, default=30.0)
+    parser.add_argument("--price", type=float, default=150.0, help="Precio inicial (gbm/bootstrap).")
+    parser.add_argument("--sigma", type=float, default=0.10, help="Volatilidad anual (gbm).")
+    parser.add_argument("--mu", type=float, default=0.0, help="Deriva anual (gbm).")
+    parser.add_argument("--root", default="bars", help="Directorio con M1/ticks (bootstrap/replay).")
+    parser.add_argument("--symbol", default="USDJPY")
+    parser.add_argument("--block-len", type=int, default=60, help="Longitud de bloque del bootstrap (velas).")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--set", nargs="*", default=[], metavar="NAME=VALUE",
+                        help=f"Sobrescribe parámetros ({', '.join(DEFAULT_PARAMS)}).")
+    return parser.parse_args()
+
+def parse_overrides(items) -> dict:
+    out = {}
+    for item in items:
+        name, _, value = item.partition("=")
+        if name not in DEFAULT_PARAMS:
+            raise SystemExit(f"Parámetro desconocido: {name}")
+        default = DEFAULT_PARAMS[name]
+        if value.lower() == "none":
+            out[name] = None
+        elif isinstance(default, bool):
+            out[name] = value.lower() in ("1", "true", "yes", "si", "sí")
+        else:
+            out[name] = type(default)(float(value)) if isinstance(default, int) else float(value)
+    return out
+
+if __name__ == "__main__":
+    args = parse_args()
+    params = parse_overrides(args.set)
+    steps = int(args.days * 1440)
+    t0 = time.perf_counter()
+    if args.mode == "replay":
+        m1 = load_m1(args.root, args.symbol)
+        blocks = history_path(m1)
+        if "spread_px" in m1:
+            blocks = (b + (m1["spread_px"][None, k * BLOCK:(k + 1) * BLOCK],) for k, b in enumerate(blocks))
+        res = simulate(blocks, 1, params)
+        days = res["steps"] / 1440.0
+    else:
+        rel = relative_bars(load_m1(args.root, args.symbol)) if args.mode == "bootstrap" else None
+        res = monte_carlo(args.paths, steps, args.price, mode=args.mode, params=params, sigma=args.sigma,
+                          mu=args.mu, rel=rel, block_len=args.block_len, seed=args.seed, workers=args.workers)
+        days = args.days
+    print_summary(summarize(res, params), days, params)
+    log(f"⏱️ {time.perf_counter() - t0:.2f} s")
@@ -0,0 +1,399 @@
+import math
+import threading
+from collections import deque
+
+import numpy as np
+
+# ===========================
+#      INDICADORES EN STREAMING
+# ===========================
+# Mismas fórmulas que ema()/rsi()/atr() de los scripts (pandas), pero con estado:
+# cada vela cerrada nueva se procesa en O(1) en lugar de recalcular toda la ventana.
+
+class StreamingEMA:
+    """EMA equivalente a series.ewm(span=length, adjust=False).mean()."""
+
+    def __init__(self, length: int):
+        self.length = length
+        self.alpha = 2.0 / (length + 1.0)
+        self.value = math.nan
+
+    def peek(self, x: float) -> float:
+        if math.isnan(self.value):
+            return float(x)
+        return self.value + self.alpha * (x - self.value)
+
+    def update(self, x: float) -> float:
+        self.value = self.peek(x)
+        return self.value
+
+
+class StreamingRSI:
+    """RSI de Wilder equivalente a rsi(close, length) (ewm alpha=1/length, adjust=False)."""
+
+    def __init__(self, length: int = 14):
+        self.length = length
+        self.alpha = 1.0 / length
+        self.prev_close = math.nan
+        self.avg_up = math.nan
+        self.avg_down = math.nan
+        self.value = math.nan
+
+    @staticmethod
+    def _rsi(avg_up: float, avg_down: float) -> float:
+        if math.isnan(avg_up) or math.isnan(avg_down):
+            return math.nan
+        if avg_down == 0.0:
+            # pandas: rs = inf -> 100; 0/0 -> NaN
+            return 100.0 if avg_up > 0.0 else math.nan
+        return 100.0 - 100.0 / (1.0 + avg_up / avg_down)
+
+    def _step(self, close: float):
+        if math.isnan(self.prev_close):
+            return math.nan, math.nan
+        delta = close - self.prev_close
+        up = delta if delta > 0.0 else 0.0
+        down = -delta if delta < 0.0 else 0.0
+        if math.isnan(self.avg_up):
+            return up, down
+        a = self.alpha
+        return self.avg_up + a * (up - self.avg_up), self.avg_down + a * (down - self.avg_down)
+
+    def peek(self, close: float) -> float:
+        return self._rsi(*self._step(close))
+
+    def update(self, close: float) -> float:
+        self.avg_up, self.avg_down = self._step(close)
+        self.prev_close = float(close)
+        self.value = self._rsi(self.avg_up, self.avg_down)
+        return self.value
+
+
+class StreamingATR:
+    """ATR equivalente a atr(df, length): media simple (rolling) del true range."""
+
+    RESUM_EVERY = 1000  # re-suma periódica para evitar deriva numérica de la suma móvil
+
+    def __init__(self, length: int = 14):
+        self.length = length
+        self.prev_close = math.nan
+        self._trs = deque()
+        self._sum = 0.0
+        self._n = 0
+        self.value = math.nan
+
+    def _true_range(self, high: float, low: float) -> float:
+        if math.isnan(self.prev_close):
+            return high - low
+        return max(high - low, abs(high - self.prev_close), abs(low - self.prev_close))
+
+    def peek(self, high: float, low: float, close: float) -> float:
+        if len(self._trs) + 1 < self.length:
+            return math.nan
+        tr = self._true_range(high, low)
+        oldest = self._trs[0] if len(self._trs) == self.length else 0.0
+        return (self._sum - oldest + tr) / self.length
+
+    def update(self, high: float, low: float, close: float) -> float:
+        tr = self._true_range(high, low)
+        self._trs.append(tr)
+        self._sum += tr
+        if len(self._trs) > self.length:
+            self._sum -= self._trs.popleft()
+        self._n += 1
+        if self._n % self.RESUM_EVERY == 0:
+            self._sum = math.fsum(self._trs)
+        self.prev_close = float(close)
+        self.value = self._sum / self.length if len(self._trs) == self.length else math.nan
+        return self.value
+
+
+class StreamingExtreme:
+    """
+    Máximo (o mínimo) de las últimas `window` velas, equivalente a series.rolling(window).max()/min().
+    Deque monotónico de (índice, valor): cada vela entra y sale una sola vez -> O(1) amortizado.
+    """
+
+    def __init__(self, window: int, mode: str = "max"):
+        if window < 1:
+            raise ValueError("window debe ser >= 1")
+        self.window = window
+        self._better = (lambda a, b: a >= b) if mode == "max" else (lambda a, b: a <= b)
+        self._pick = max if mode == "max" else min
+        self._deque = deque()
+        self._n = 0
+        self._last_nan = -window   # índice del último NaN (pandas: NaN en la ventana -> NaN)
+        self.value = math.nan
+
+    def _front(self, n: int) -> float:
+        """Extremo de la ventana que termina en la vela n-1 (sin contar NaN)."""
+        while self._deque and self._deque[0][0] <= n - 1 - self.window:
+            self._deque.popleft()
+        return self._deque[0][1] if self._deque else math.nan
+
+    def peek(self, x: float) -> float:
+        n = self._n + 1
+        if n < self.window or n - 1 - self._last_nan < self.window or math.isnan(x):
+            return math.nan
+        front = self._front(n)
+        return float(x) if math.isnan(front) else self._pick(front, float(x))
+
+    def update(self, x: float) -> float:
+        x = float(x)
+        k = self._n
+        self._n += 1
+        if math.isnan(x):
+            self._last_nan = k
+        else:
+            while self._deque and self._better(x, self._deque[-1][1]):
+                self._deque.pop()
+            self._deque.append((k, x))
+        front = self._front(self._n)
+        ok = self._n >= self.window and k - self._last_nan >= self.window
+        self.value = front if ok else math.nan
+        return self.value
+
+
+def _rolling_extreme(values, window: int, op, fill: float) -> np.ndarray:
+    """
+    Extremo móvil en O(n) independiente de la ventana (van Herk / Gil-Werman):
+    acumulados por bloques de tamaño window hacia delante y hacia atrás; cada ventana
+    es la unión del final de un bloque y el principio del siguiente.
+    """
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    out = np.full(n, np.nan)
+    if window < 1:
+        raise ValueError("window debe ser >= 1")
+    if n < window:
+        return out
+    if window == 1:
+        return x.copy()
+    pad = (-n) % window
+    blocks = np.concatenate([x, np.full(pad, fill)]).reshape(-1, window)
+    prefix = op.accumulate(blocks, axis=1).ravel()
+    suffix = op.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    out[window - 1:] = op(suffix[:n - window + 1], prefix[window - 1:n])
+    return out
+
+
+def rolling_max(values, window: int) -> np.ndarray:
+    """Como pd.Series(values).rolling(window).max(): NaN en las primeras window-1 y si hay NaN en la ventana."""
+    return _rolling_extreme(values, window, np.maximum, -np.inf)
+
+
+def rolling_min(values, window: int) -> np.ndarray:
+    """Como pd.Series(values).rolling(window).min()."""
+    return _rolling_extreme(values, window, np.minimum, np.inf)
+
+
+class IndicatorSet:
+    """
+    EMA20/EMA50/RSI14/ATR de un símbolo alimentados SOLO con velas cerradas.
+    - La primera llamada siembra el estado con todo el histórico recibido.
+    - Las siguientes procesan únicamente las velas cerradas posteriores a last_time.
+    - La vela en formación (si se evalúa) se calcula con peek(), sin tocar el estado.
+    - Extremos móviles opcionales (evaluate(..., lookbacks=(12,)) -> "hh12"/"ll12"):
+      un lookback nuevo resiembra el estado una vez (varias estrategias comparten el set).
+    """
+
+    def __init__(self, atr_len: int = 14, lookbacks=()):
+        self.atr_len = atr_len
+        self.lookbacks = tuple(sorted(set(lookbacks)))
+        self.reset()
+
+    def reset(self):
+        self.ema20 = StreamingEMA(20)
+        self.ema50 = StreamingEMA(50)
+        self.rsi14 = StreamingRSI(14)
+        self.atr = StreamingATR(self.atr_len)
+        self.highs = {n: StreamingExtreme(n, "max") for n in self.lookbacks}
+        self.lows = {n: StreamingExtreme(n, "min") for n in self.lookbacks}
+        self.last_time = None
+        self.updates = 0
+
+    def _push(self, high: float, low: float, close: float):
+        self.ema20.update(close)
+        self.ema50.update(close)
+        self.rsi14.update(close)
+        self.atr.update(high, low, close)
+        for n in self.lookbacks:
+            self.highs[n].update(high)
+            self.lows[n].update(low)
+        self.updates += 1
+
+    def update(self, times, high, low, close):
+        """Procesa las velas (cerradas) recibidas que aún no forman parte del estado."""
+        if len(times) == 0:
+            return
+        times = np.asarray(times)
+        if times.dtype.kind == "M":
+            # Columna datetime64 de un DataFrame: misma marca que el epoch (s) del array de MT5
+            times = times.astype("datetime64[s]").astype(np.int64)
+        start = 0
+        if self.last_time is not None:
+            start = int(np.searchsorted(times, self.last_time, side="right"))
+            if start == 0 or times[start - 1] != self.last_time:
+                # La ventana ya no contiene la última vela procesada (hueco): resembrar
+                self.reset()
+                start = 0
+        for k in range(start, len(times)):
+            self._push(float(high[k]), float(low[k]), float(close[k]))
+        self.last_time = times[-1]
+
+    def evaluate(self, times, high, low, close, use_live_candle: bool = False, lookbacks=()) -> dict:
+        """
+        Valores en la última vela cerrada (índice -2) o en la vela en formación (-1).
+        Los arrays incluyen la vela en formación al final, como copy_rates_from_pos.
+        """
+        if not set(lookbacks) <= set(self.lookbacks):
+            self.lookbacks = tuple(sorted(set(self.lookbacks) | set(lookbacks)))
+            self.reset()
+        self.update(times[:-1], high[:-1], low[:-1], close[:-1])
+        if not use_live_candle:
+            out = {
+                "ema20": self.ema20.value,
+                "ema50": self.ema50.value,
+                "rsi14": self.rsi14.value,
+                "atr14": self.atr.value,
+            }
+            for n in self.lookbacks:
+                out[f"hh{n}"] = self.highs[n].value
+                out[f"ll{n}"] = self.lows[n].value
+            return out
+        h, l, c = float(high[-1]), float(low[-1]), float(close[-1])
+        out = {
+            "ema20": self.ema20.peek(c),
+            "ema50": self.ema50.peek(c),
+            "rsi14": self.rsi14.peek(c),
+            "atr14": self.atr.peek(h, l, c),
+        }
+        for n in self.lookbacks:
+            out[f"hh{n}"] = self.highs[n].peek(h)
+            out[f"ll{n}"] = self.lows[n].peek(l)
+        return out
+
+
+class IndicatorCache:
+    """
+    IndicatorSet compartidos por (símbolo, timeframe, atr_len).
+    Varias estrategias sobre la misma serie (p. ej. USDJPY M5) alimentan un único estado.
+    """
+
+    def __init__(self):
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    def get(self, symbol: str, timeframe: int, atr_len: int = 14) -> IndicatorSet:
+        key = (symbol, timeframe, atr_len)
+        with self._lock:
+            if key not in self._sets:
+                self._sets[key] = IndicatorSet(atr_len)
+            return self._sets[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"series": len(self._sets), "updates": sum(s.updates for s in self._sets.values())}
+
+# ===========================
+#      PARIDAD CON PANDAS
+# ===========================
+def _parity_check(n: int = 5000, seed: int = 7) -> float:
+    """Compara el motor streaming con las versiones pandas de los scripts; devuelve el error máximo."""
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    close = 150.0 + np.cumsum(rng.normal(0, 0.05, n))
+    high = close + rng.uniform(0, 0.08, n)
+    low = close - rng.uniform(0, 0.08, n)
+    df = pd.DataFrame({"high": high, "low": low, "close": close})
+
+    ref_ema20 = df["close"].ewm(span=20, adjust=False).mean()
+    ref_ema50 = df["close"].ewm(span=50, adjust=False).mean()
+    delta = df["close"].diff()
+    roll_up = delta.clip(lower=0).ewm(alpha=1/14, adjust=False).mean()
+    roll_down = (-delta.clip(upper=0)).ewm(alpha=1/14, adjust=False).mean()
+    ref_rsi = 100 - (100 / (1 + roll_up / roll_down))
+    prev_close = df["close"].shift(1)
+    tr = pd.concat([
+        df["high"] - df["low"],
+        (df["high"] - prev_close).abs(),
+        (df["low"] - prev_close).abs()
+    ], axis=1).max(axis=1)
+    ref_atr = tr.rolling(14).mean()
+
+    ema20, ema50, rsi14, atr14 = StreamingEMA(20), StreamingEMA(50), StreamingRSI(14), StreamingATR(14)
+    out = np.empty((n, 4))
+    for k in range(n):
+        out[k] = (ema20.update(close[k]), ema50.update(close[k]), rsi14.update(close[k]),
+                  atr14.update(high[k], low[k], close[k]))
+    ref = np.column_stack([ref_ema20, ref_ema50, ref_rsi, ref_atr])
+
+    if not np.array_equal(np.isnan(out), np.isnan(ref)):
+        raise AssertionError("Los NaN iniciales no coinciden con pandas")
+    err = float(np.nanmax(np.abs(out - ref)))
+    if err > 1e-9:
+        raise AssertionError(f"Paridad con pandas fallida: error máx {err:.3e}")
+    return err
+
+
+def _extremes_parity_check(n: int = 20000, seed: int = 11) -> int:
+    """rolling_max/min y StreamingExtreme frente a pandas rolling (con NaN sueltos); devuelve ventanas probadas."""
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    x = 150.0 + np.cumsum(rng.normal(0, 0.05, n))
+    x[rng.choice(n, 20, replace=False)] = np.nan
+    windows = (1, 2, 12, 14, 96, 1000)
+    for w in windows:
+        for mode, batch in (("max", rolling_max), ("min", rolling_min)):
+            ref = getattr(pd.Series(x).rolling(w), mode)().to_numpy()
+            if not np.array_equal(batch(x, w), ref, equal_nan=True):
+                raise AssertionError(f"rolling_{mode}({w}) no coincide con pandas")
+            tracker = StreamingExtreme(w, mode)
+            streamed = np.array([tracker.update(v) for v in x])
+            if not np.array_equal(streamed, ref, equal_nan=True):
+                raise AssertionError(f"StreamingExtreme({w}, {mode}) no coincide con pandas")
+            tracker = StreamingExtreme(w, mode)
+            for v in x[:-1]:
+                tracker.update(v)
+            peeked = tracker.peek(x[-1])
+            if not (peeked == ref[-1] or (math.isnan(peeked) and math.isnan(ref[-1]))):
+                raise AssertionError(f"StreamingExtreme({w}, {mode}).peek no coincide con pandas")
+    return len(windows)
+
+
+def _bench_extremes(n: int = 1_000_000, windows=(12, 96, 1000, 10000), repeat: int = 5):
+    """Tiempos de rolling max: pandas vs rolling_max vs StreamingExtreme (por vela)."""
+    import time
+    import pandas as pd
+
+    x = 150.0 + np.cumsum(np.random.default_rng(3).normal(0, 0.05, n))
+    series = pd.Series(x)
+
+    def best(fn):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        return min(times) * 1000.0
+
+    print(f"Extremos móviles sobre {n} velas (mejor de {repeat}):")
+    for w in windows:
+        t_pd = best(lambda: series.rolling(w).max())
+        t_np = best(lambda: rolling_max(x, w))
+        tracker = StreamingExtreme(w, "max")
+        t0 = time.perf_counter()
+        for v in x[:200_000]:
+            tracker.update(v)
+        per_bar_us = (time.perf_counter() - t0) / min(n, 200_000) * 1e6
+        print(f"  window={w:>6}: pandas {t_pd:7.3f} ms | rolling_max {t_np:7.3f} ms "
+              f"(x{t_pd / t_np:.1f}) | streaming {per_bar_us:.2f} µs/vela")
+
+
+if __name__ == "__main__":
+    print(f"✅ Paridad streaming vs pandas OK (error máx {_parity_check():.3e})")
+    print(f"✅ Extremos móviles vs pandas OK ({_extremes_parity_check()} ventanas)")
+    _bench_extremes()
+    _bench_extremes(n=600, windows=(12, 96), repeat=200)   # tamaño de ventana de los scripts
@@ -4,8 +4,17 @@ import numpy as np
 import os
 import time
 import argparse
+import threading
 from zoneinfo import ZoneInfo
 from typing import Optional, Tuple
+from mt5_session import MT5Session, TERMINAL_LOCK
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender
+from symbol_specs import SymbolSpecCache
+from order_batch import OrderBatch, is_transient
+from fill_watcher import FillWatcher
+from risk_loop import TickRiskLoop
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES (TU SCRIPT)
@@ -25,6 +34,10 @@ SYMBOL = "USDJPY"
 TIMEFRAME = mt5.TIMEFRAME_M5
 TZ = ZoneInfo("Europe/Madrid")
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa y p50/p95/p99 en el log de cada ciclo; False = sin coste
+
+# Planificador: despertar X ms después de cada cierre de vela (reloj monotónico)
+WAKE_AFTER_CLOSE_MS = 1000
 
 # ===========================
 #   PARÁMETROS HEDGING+MARTINGALE
@@ -46,6 +59,20 @@ MAX_DRAWDOWN_PCT  = 10.0          # cierra todo si equity cae >10% desde el bala
 REBUILD_ON_FLAT   = True          # si no hay posiciones, volver a sembrar rejilla
 COMMENT_TAG       = "HMv1"        # etiqueta para comentar órdenes/posiciones del bot
 
+# Envío de órdenes por lotes (rejilla, cierre y borrado en una sola ráfaga)
+ORDER_RETRIES     = 2             # reintentos ante requote/timeout/precio cambiado
+GRID_RETRY_S      = 60            # espera tras una rejilla fallida (se duplica en cada fallo seguido)
+GRID_RETRY_MAX_S  = 900           # tope de esa espera
+
+# Detección de llenados (history_deals_get incremental, en un hilo aparte)
+FILL_POLL_S       = 0.25          # intervalo de sondeo del historial de deals
+FILLS_STATE_FILE  = "martingala_fills.json"   # marca persistente del último deal visto
+CHECK_ON_FILL     = True          # límites + TP de cesta en cuanto se llena una capa
+
+# Bucle rápido de riesgo: DD y TP de cesta con cada tick, sin esperar a --every-min
+FAST_RISK         = True
+RISK_POLL_S       = 0.1           # cadencia de symbol_info_tick (s)
+
 # ===========================
 #      UTILIDADES
 # ===========================
@@ -53,51 +80,88 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+STAGES = StageTimer("martingala", enabled=STAGE_TIMING, log=log)
+
+TELEGRAM = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
-    """Envía mensaje a Telegram con las credenciales provistas."""
-    try:
-        import requests
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-        r = requests.post(url, data=data, timeout=15)
-        if r.status_code != 200:
-            log(f"⚠️ Telegram {r.status_code}: {r.text}")
-        else:
-            log("📨 Telegram OK")
-    except Exception as e:
-        log(f"❌ Telegram error: {e}")
+    """Encola el mensaje; el hilo de TELEGRAM lo entrega sin bloquear el ciclo."""
+    TELEGRAM.send(message)
+
+SESSION = MT5Session(mt5, MT5_LOGIN, MT5_PASSWORD, MT5_SERVER, path=PATH_TO_TERMINAL,
+                     symbols=[SYMBOL], log=log)
+SPECS = SymbolSpecCache(mt5, log=log)
+ORDERS = OrderBatch(mt5, specs=SPECS, retries=ORDER_RETRIES, log=log)
+
+class CycleSnapshot:
+    """
+    Estado del símbolo leído una sola vez por ciclo: posiciones, órdenes, tick y cuenta.
+    Los helpers leen de aquí en lugar de consultar al terminal cada vez. Tras un order_send
+    se invalida solo la parte que cambia y se vuelve a pedir en la siguiente lectura.
+    """
+    PARTS = ("positions", "orders", "tick", "account")
+
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.reset()
+
+    def reset(self):
+        """Inicio de ciclo: olvida todo lo leído."""
+        self._data = {}
+        self.calls = 0
+
+    def invalidate(self, *parts):
+        for part in parts or self.PARTS:
+            self._data.pop(part, None)
+
+    def update(self, part: str, value):
+        """Guarda un valor ya leído del terminal (p. ej. la lista de la conciliación)."""
+        if value is not None:
+            self._data[part] = value
+
+    def _get(self, part: str, fetch):
+        if part not in self._data:
+            self.calls += 1
+            with TERMINAL_LOCK:
+                self._data[part] = fetch()
+        return self._data[part]
+
+    def positions(self) -> list:
+        return self._get("positions", lambda: list(mt5.positions_get(symbol=self.symbol) or []))
+
+    def orders(self) -> list:
+        return self._get("orders", lambda: list(mt5.orders_get(symbol=self.symbol) or []))
 
+    def tick(self):
+        return self._get("tick", lambda: mt5.symbol_info_tick(self.symbol))
+
+    def account(self):
+        return self._get("account", mt5.account_info)
+
+SNAPSHOT = CycleSnapshot(SYMBOL)
+GRID_BACKOFF = {"failures": 0, "until": 0.0}  # rejillas fallidas seguidas y monotonic hasta el próximo intento
+GRID_SKIP = {}  # comentario de capa -> monotonic hasta el que no se reenvía (rechazo definitivo del bróker)
+
+@STAGES.timed("init_mt5")
 def init_mt5():
-    log("🔌 Inicializando MetaTrader 5...")
-    ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
-    if not ok:
-        raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
-    if not mt5.login(login=MT5_LOGIN, password=MT5_PASSWORD, server=MT5_SERVER):
-        raise RuntimeError(f"Login error: {mt5.last_error()}")
-    if not mt5.symbol_select(SYMBOL, True):
-        raise RuntimeError(f"No se pudo suscribir a {SYMBOL}")
-    tick = mt5.symbol_info_tick(SYMBOL)
-    log(f"ℹ️ Tick inicial {SYMBOL}: {tick}")
+    # Solo la conexión: el tick del ciclo lo lee SNAPSHOT después de reset(), bajo CYCLE_LOCK
+    connect_ms = SESSION.ensure()
+    log(f"🔌 Sesión MT5 lista ({connect_ms:.1f} ms)")
 
 def shutdown_mt5():
-    try:
-        mt5.shutdown()
-    except Exception:
-        pass
+    SESSION.close()
     log("🔚 MT5 cerrado.")
 
 def symbol_meta(symbol: str):
-    info = mt5.symbol_info(symbol)
-    if info is None:
+    spec = SPECS.get(symbol)
+    if spec is None:
         raise RuntimeError("No symbol info")
-    point = info.point
-    digits = info.digits
-    # pip genérico: en la mayoría de FX con 5/3 dígitos, 1 pip = 10*point
-    pip = 10 * point
-    return info, point, pip, digits
+    # pip genérico: en la mayoría de FX con 5/3 dígitos, 1 pip = 10*point (spec.pip)
+    return spec, spec.point, spec.pip, spec.digits
 
 def account_info():
-    acc = mt5.account_info()
+    acc = SNAPSHOT.account()
     if acc is None:
         raise RuntimeError("No account info")
     return acc
@@ -109,13 +173,19 @@ def now_local():
 #    ÓRDENES / POSICIONES
 # ===========================
 def total_symbol_positions(symbol: str):
-    poss = mt5.positions_get(symbol=symbol)
+    if symbol == SNAPSHOT.symbol:
+        return SNAPSHOT.positions()
+    with TERMINAL_LOCK:
+        poss = mt5.positions_get(symbol=symbol)
     if poss is None:
         return []
     return list(poss)
 
 def total_symbol_orders(symbol: str):
-    ords = mt5.orders_get(symbol=symbol)
+    if symbol == SNAPSHOT.symbol:
+        return SNAPSHOT.orders()
+    with TERMINAL_LOCK:
+        ords = mt5.orders_get(symbol=symbol)
     if ords is None:
         return []
     return list(ords)
@@ -169,86 +239,96 @@ def parse_layer(comment: str) -> int:
 def lot_for_layer(layer: int) -> float:
     return round(BASE_LOT * (MARTI_MULT ** layer), 2)
 
-def place_stop(side: str, price: float, layer: int):
+def stop_request(side: str, price: float, layer: int) -> Optional[dict]:
     """
-    Coloca BUY STOP o SELL STOP con comentario etiquetado para trazar capas.
+    Petición de BUY STOP o SELL STOP con comentario etiquetado para trazar capas.
     Sin SL/TP; la gestión es por cesta.
     """
-    _, _, _, digits = symbol_meta(SYMBOL)
-    volume = lot_for_layer(layer)
+    spec, _, _, _ = symbol_meta(SYMBOL)
+    volume = spec.normalize_volume(lot_for_layer(layer))
     if volume <= 0:
-        return False, "invalid volume"
+        return None
 
     if side == "BUY":
         order_type = mt5.ORDER_TYPE_BUY_STOP
     else:
         order_type = mt5.ORDER_TYPE_SELL_STOP
 
-    request = {
+    return {
         "action": mt5.TRADE_ACTION_PENDING,
         "symbol": SYMBOL,
         "volume": volume,
         "type": order_type,
-        "price": round(price, digits),
+        "price": spec.round_price(price),
         "deviation": 20,
         "type_time": mt5.ORDER_TIME_GTC,
         "type_filling": mt5.ORDER_FILLING_RETURN,
         "comment": f"{COMMENT_TAG}|side={side}|layer={layer}",
     }
-    res = mt5.order_send(request)
-    if res is None:
-        return False, "order_send None"
-    if res.retcode != mt5.TRADE_RETCODE_DONE:
-        return False, f"retcode={res.retcode}"
-    return True, "OK"
-
-def close_all_symbol_positions(symbol: str):
-    info = mt5.symbol_info(symbol)
-    if info is None:
-        return
-    tick = mt5.symbol_info_tick(symbol)
+
+def symbol_ticks(symbol: str) -> dict:
+    """Tick del ciclo para validar el lote sin otra consulta al terminal."""
+    return {symbol: SNAPSHOT.tick()} if symbol == SNAPSHOT.symbol else {}
+
+def close_all_symbol_positions(symbol: str) -> bool:
+    """Cierra en un solo lote todas las posiciones del símbolo. True si quedaron todas cerradas."""
+    spec = SPECS.get(symbol)
+    if spec is None:
+        return False
+    if symbol == SNAPSHOT.symbol:
+        tick = SNAPSHOT.tick()
+    else:
+        with TERMINAL_LOCK:
+            tick = mt5.symbol_info_tick(symbol)
     if tick is None:
-        return
-    digits = info.digits
+        return False
+    requests = []
     for p in total_symbol_positions(symbol):
         if p.symbol != symbol:
             continue
-        if p.type == mt5.POSITION_TYPE_BUY:
-            price = tick.bid
-            req = {
-                "action": mt5.TRADE_ACTION_DEAL,
-                "symbol": symbol,
-                "volume": p.volume,
-                "type": mt5.ORDER_TYPE_SELL,
-                "position": p.ticket,
-                "price": round(price, digits),
-                "deviation": 30,
-                "comment": f"{COMMENT_TAG}|close_basket",
-            }
-        else:
-            price = tick.ask
-            req = {
-                "action": mt5.TRADE_ACTION_DEAL,
-                "symbol": symbol,
-                "volume": p.volume,
-                "type": mt5.ORDER_TYPE_BUY,
-                "position": p.ticket,
-                "price": round(price, digits),
-                "deviation": 30,
-                "comment": f"{COMMENT_TAG}|close_basket",
-            }
-        mt5.order_send(req)
-
-def delete_all_symbol_orders(symbol: str):
-    for o in total_symbol_orders(symbol):
-        if o.symbol != symbol:
-            continue
-        mt5.order_send({
-            "action": mt5.TRADE_ACTION_REMOVE,
-            "order": o.ticket,
+        buy = p.type == mt5.POSITION_TYPE_BUY
+        requests.append({
+            "action": mt5.TRADE_ACTION_DEAL,
             "symbol": symbol,
-            "comment": f"{COMMENT_TAG}|remove",
+            "volume": p.volume,
+            "type": mt5.ORDER_TYPE_SELL if buy else mt5.ORDER_TYPE_BUY,
+            "position": p.ticket,
+            "price": spec.round_price(tick.bid if buy else tick.ask),
+            "deviation": 30,
+            "comment": f"{COMMENT_TAG}|close_basket",
         })
+    if not requests:
+        return True
+    with STAGES.span("order_send"):
+        results = ORDERS.submit(requests, ticks=symbol_ticks(symbol))
+        rec = ORDERS.reconcile(symbol, results)
+    # Cerrar posiciones cambia posiciones y cuenta (las pendientes no se tocan)
+    SNAPSHOT.invalidate("positions", "account")
+    if symbol == SNAPSHOT.symbol:
+        SNAPSHOT.update("positions", rec["positions"])
+    if not rec["ok"]:
+        log(f"⚠️ {symbol}: {len(rec['missing'])}/{len(requests)} posiciones siguen abiertas tras el cierre.")
+    return rec["ok"]
+
+def delete_all_symbol_orders(symbol: str) -> bool:
+    """Borra en un solo lote todas las pendientes del símbolo. True si no queda ninguna."""
+    requests = [{
+        "action": mt5.TRADE_ACTION_REMOVE,
+        "order": o.ticket,
+        "symbol": symbol,
+        "comment": f"{COMMENT_TAG}|remove",
+    } for o in total_symbol_orders(symbol) if o.symbol == symbol]
+    if not requests:
+        return True
+    with STAGES.span("order_send"):
+        results = ORDERS.submit(requests)
+        rec = ORDERS.reconcile(symbol, results)
+    SNAPSHOT.invalidate("orders")
+    if symbol == SNAPSHOT.symbol:
+        SNAPSHOT.update("orders", rec["orders"])
+    if not rec["ok"]:
+        log(f"⚠️ {symbol}: {len(rec['missing'])}/{len(requests)} órdenes pendientes no se pudieron borrar.")
+    return rec["ok"]
 
 # ===========================
 #    LÓGICA DE REJILLA
@@ -259,26 +339,61 @@ def build_grid(anchor_price: float):
     Capas: 0..MAX_LAYERS_PER_SIDE-1
     """
     info, point, pip, digits = symbol_meta(SYMBOL)
-    placed = 0
+    requests = []
     for layer in range(MAX_LAYERS_PER_SIDE):
         offs = (layer + 1) * STEP_PIPS * pip
-        buy_price = anchor_price + offs
-        sell_price = anchor_price - offs
-        ok1, m1 = place_stop("BUY", buy_price, layer)
-        ok2, m2 = place_stop("SELL", sell_price, layer)
-        if ok1:
-            placed += 1
-        if ok2:
-            placed += 1
-    if placed > 0:
-        ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
-        msg = (
-            "🧭 Rejilla colocada (Hedging+Martingale)\n\n"
-            f"🇪🇸 Ancla: {anchor_price:.5f} | Capas por lado: {MAX_LAYERS_PER_SIDE} | Paso: {STEP_PIPS} pips | Lote base: {BASE_LOT}\n"
-            f"🇷🇺 Якорь: {anchor_price:.5f} | Слоёв на сторону: {MAX_LAYERS_PER_SIDE} | Шаг: {STEP_PIPS} пипсов | Базовый лот: {BASE_LOT}\n"
-            f"⏰ {ts}"
-        )
-        send_telegram(msg)
+        for side, price in (("BUY", anchor_price + offs), ("SELL", anchor_price - offs)):
+            request = stop_request(side, price, layer)
+            if request is not None and time.monotonic() >= GRID_SKIP.get(request["comment"], 0.0):
+                requests.append(request)
+    if not requests:
+        return
+    # Toda la rejilla en una ráfaga; luego se confirma contra orders_get
+    with STAGES.span("order_send"):
+        results = ORDERS.submit(requests, ticks=symbol_ticks(SYMBOL))
+        rec = ORDERS.reconcile(SYMBOL, results)
+    SNAPSHOT.invalidate("orders")
+    SNAPSHOT.update("orders", rec["orders"])
+    if any(res.get("filled") for res in results):
+        # Alguna capa se llenó antes de conciliar: cuenta como colocada, ya es posición
+        SNAPSHOT.invalidate("positions", "account")
+    placed = sum(1 for res in results if res["confirmed"])
+    transient = [res for res in results if is_transient(res)]
+    if transient and placed > 0:
+        # Rejilla a medias por el precio en movimiento (requote/timeout): se retira y se resiembra
+        log(f"⚠️ Rejilla incompleta ({placed}/{len(requests)} órdenes en {ORDERS.last_ms:.0f} ms, "
+            f"{len(transient)} fallo(s) transitorio(s)); se retira.")
+        delete_all_symbol_orders(SYMBOL)
+        grid_failed()
+        return
+    if placed == 0:
+        log(f"⚠️ Ninguna capa colocada ({results[0]['error']}).")
+        grid_failed()
+        return
+    GRID_BACKOFF["failures"] = 0
+    skipped = [res for res in results if not res["confirmed"] and res["error"]]
+    if skipped:
+        # Rechazos definitivos (validación, stops_level, volumen…): la capa se omite, el resto se queda;
+        # las que rechazó el bróker no se reenvían hasta pasados GRID_RETRY_MAX_S
+        for res in skipped:
+            if res["attempts"] > 0:
+                GRID_SKIP[res["request"]["comment"]] = time.monotonic() + GRID_RETRY_MAX_S
+        log(f"ℹ️ Rejilla sin {len(skipped)} capa(s) rechazada(s): {skipped[0]['error']}")
+    ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
+    msg = (
+        "🧭 Rejilla colocada (Hedging+Martingale)\n\n"
+        f"🇪🇸 Ancla: {anchor_price:.5f} | Capas por lado: {MAX_LAYERS_PER_SIDE} | Paso: {STEP_PIPS} pips | Lote base: {BASE_LOT}\n"
+        f"🇷🇺 Якорь: {anchor_price:.5f} | Слоёв на сторону: {MAX_LAYERS_PER_SIDE} | Шаг: {STEP_PIPS} пипсов | Базовый лот: {BASE_LOT}\n"
+        f"⏰ {ts}"
+    )
+    send_telegram(msg)
+
+def grid_failed():
+    """Rejilla fallida: la siguiente espera GRID_RETRY_S, el doble tras cada fallo seguido (hasta GRID_RETRY_MAX_S)."""
+    GRID_BACKOFF["failures"] += 1
+    wait_s = min(GRID_RETRY_S * 2 ** (GRID_BACKOFF["failures"] - 1), GRID_RETRY_MAX_S)
+    GRID_BACKOFF["until"] = time.monotonic() + wait_s
+    log(f"⏸️ Rejilla: {GRID_BACKOFF['failures']} fallo(s) seguido(s); próximo intento en {wait_s:.0f} s.")
 
 def ensure_grid():
     """
@@ -290,7 +405,9 @@ def ensure_grid():
 
     have_any = (len(poss) + len(ords)) > 0
     if not have_any or (REBUILD_ON_FLAT and len(poss) == 0):
-        tick = mt5.symbol_info_tick(SYMBOL)
+        if time.monotonic() < GRID_BACKOFF["until"]:
+            return
+        tick = SNAPSHOT.tick()
         if not tick:
             return
         anchor = (tick.ask + tick.bid) / 2.0
@@ -306,17 +423,12 @@ def enforce_limits():
     equity = acc.equity
 
     # Kill switch por DD
-    dd_pct = 0.0 if balance <= 0 else (max(0.0, balance - equity) / balance) * 100.0
+    dd_pct = drawdown_pct(balance, equity)
     if dd_pct >= MAX_DRAWDOWN_PCT:
         # Cierra todo y borra pendientes
         close_all_symbol_positions(SYMBOL)
         delete_all_symbol_orders(SYMBOL)
-        msg = (
-            "🛑 Protección activada\n\n"
-            f"🇪🇸 Drawdown {dd_pct:.2f}% ≥ {MAX_DRAWDOWN_PCT:.2f}% → se cierran posiciones y órdenes.\n"
-            f"🇷🇺 Просадка {dd_pct:.2f}% ≥ {MAX_DRAWDOWN_PCT:.2f}% → закрываем все позиции и ордера."
-        )
-        send_telegram(msg)
+        notify_kill_switch(dd_pct)
         return True
 
     # Límite de volumen
@@ -333,79 +445,188 @@ def enforce_limits():
         return True
     return False
 
-def basket_take_profit_reached() -> bool:
-    pl = current_floating_pl(SYMBOL)
-    acc = account_info()
+def drawdown_pct(balance: float, equity: float) -> float:
+    return 0.0 if balance <= 0 else (max(0.0, balance - equity) / balance) * 100.0
+
+def notify_kill_switch(dd_pct: float):
+    msg = (
+        "🛑 Protección activada\n\n"
+        f"🇪🇸 Drawdown {dd_pct:.2f}% ≥ {MAX_DRAWDOWN_PCT:.2f}% → se cierran posiciones y órdenes.\n"
+        f"🇷🇺 Просадка {dd_pct:.2f}% ≥ {MAX_DRAWDOWN_PCT:.2f}% → закрываем все позиции и ордера."
+    )
+    send_telegram(msg)
+
+def basket_tp_hit(pl: float, balance: float) -> bool:
     cond_money = (BASKET_TP_MONEY is not None) and (pl >= float(BASKET_TP_MONEY))
     cond_pct = False
-    if BASKET_TP_PCT is not None and acc and acc.balance > 0:
-        cond_pct = (pl >= (acc.balance * (BASKET_TP_PCT / 100.0)))
+    if BASKET_TP_PCT is not None and balance > 0:
+        cond_pct = (pl >= (balance * (BASKET_TP_PCT / 100.0)))
     return cond_money or cond_pct
 
+def basket_take_profit_reached() -> bool:
+    pl = current_floating_pl(SYMBOL)
+    acc = account_info()
+    return basket_tp_hit(pl, acc.balance)
+
+def notify_basket_closed(pl: float):
+    ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
+    msg = (
+        "✅ Cesta cerrada (beneficio alcanzado)\n\n"
+        f"🇪🇸 P/L flotante alcanzado: {pl:.2f}. Se cierra todo y se resembrará la rejilla.\n"
+        f"🇷🇺 Достигнута цель по прибыли: {pl:.2f}. Все позиции закрыты, сетка будет создана заново.\n"
+        f"⏰ {ts}"
+    )
+    send_telegram(msg)
+
 def try_close_basket():
     if basket_take_profit_reached():
         pl = current_floating_pl(SYMBOL)
         close_all_symbol_positions(SYMBOL)
         delete_all_symbol_orders(SYMBOL)
-        ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
-        msg = (
-            "✅ Cesta cerrada (beneficio alcanzado)\n\n"
-            f"🇪🇸 P/L flotante alcanzado: {pl:.2f}. Se cierra todo y se resembrará la rejilla.\n"
-            f"🇷🇺 Достигнута цель по прибыли: {pl:.2f}. Все позиции закрыты, сетка будет создана заново.\n"
-            f"⏰ {ts}"
-        )
-        send_telegram(msg)
+        notify_basket_closed(pl)
         return True
     return False
 
+def on_fill(event: dict):
+    """
+    Callback del FillWatcher: avisa de cada capa llenada y, sin esperar al siguiente
+    ciclo, revisa límites y TP de cesta (el volumen y el P/L acaban de cambiar).
+    """
+    if event["entry"] != "IN":
+        return
+    log(f"📥 Llenado {event['side']} capa {event['layer']} vol={event['volume']} @ {event['price']}")
+    ts = now_local().strftime("%Y-%m-%d %H:%M:%S")
+    msg = (
+        "📥 Capa llenada (Hedging+Martingale)\n\n"
+        f"🇪🇸 {event['symbol']} {event['side']} capa {event['layer']} | Volumen: {event['volume']} | Precio: {event['price']}\n"
+        f"🇷🇺 {event['symbol']} {event['side']} слой {event['layer']} | Объём: {event['volume']} | Цена: {event['price']}\n"
+        f"⏰ {ts}"
+    )
+    send_telegram(msg)
+    if CHECK_ON_FILL:
+        with CYCLE_LOCK:
+            SNAPSHOT.reset()
+            try:
+                if enforce_limits():
+                    return
+                if try_close_basket():
+                    ensure_grid()
+            finally:
+                sync_risk()
+
+FILLS = FillWatcher(mt5, symbols=[SYMBOL], state_path=FILLS_STATE_FILE, interval_s=FILL_POLL_S,
+                    comment_prefix=f"{COMMENT_TAG}|", on_fill=on_fill, log=log)
+# Un ciclo a la vez: run_once y las reacciones a llenados comparten SNAPSHOT y órdenes
+CYCLE_LOCK = threading.RLock()
+
+@STAGES.timed("fills")
 def notify_new_fills():
     """
-    Revisa el historial de posiciones recientes del símbolo y envía aviso de nueva capa (opcional simple).
+    Sin hilo vigilante (--once o supervisor): sondea el historial de deals una vez
+    desde la marca guardada y procesa los llenados nuevos.
     """
-    # MT5 Python no da push inmediato de llenado. Como opción ligera:
-    # resumimos el número de posiciones por lado y lo anunciamos si cambia.
-    # (Para algo persistente, guardaríamos estado en disco.)
-    pass  # mantener simple para ejemplo
+    if not FILLS.running:
+        FILLS.poll()
+
+# ===========================
+#    BUCLE RÁPIDO DE RIESGO
+# ===========================
+def risk_check(pl: float, equity: float, balance: float) -> Optional[str]:
+    """Mismas reglas que enforce_limits (DD) y try_close_basket (TP), con el P/L del último tick."""
+    if drawdown_pct(balance, equity) >= MAX_DRAWDOWN_PCT:
+        return "dd"
+    if basket_tp_hit(pl, balance):
+        return "tp"
+    return None
+
+def sync_risk():
+    """Pasa al bucle rápido las posiciones, órdenes y cuenta del ciclo (las ya leídas en SNAPSHOT)."""
+    try:
+        RISK.update(SNAPSHOT.positions(), SNAPSHOT.orders(), SNAPSHOT.account())
+    except Exception as e:
+        log(f"⚠️ No se pudo actualizar el bucle de riesgo: {e}")
+
+def refresh_risk():
+    with CYCLE_LOCK:
+        SNAPSHOT.reset()
+        sync_risk()
+
+def on_risk_trigger(reason: str, tick, pl: float, balance: float, positions: list, orders: list):
+    """Cierra con las posiciones cacheadas y el tick que disparó la regla, sin lecturas previas."""
+    with CYCLE_LOCK:
+        SNAPSHOT.reset()
+        SNAPSHOT.update("tick", tick)
+        SNAPSHOT.update("positions", positions)
+        SNAPSHOT.update("orders", orders)
+        try:
+            close_all_symbol_positions(SYMBOL)
+            delete_all_symbol_orders(SYMBOL)
+            if reason == "dd":
+                notify_kill_switch(drawdown_pct(balance, RISK.last_equity))
+            else:
+                notify_basket_closed(pl)
+                ensure_grid()
+        finally:
+            SNAPSHOT.invalidate("tick")
+            sync_risk()
+
+RISK = TickRiskLoop(mt5, SYMBOL, SPECS, check=risk_check, on_trigger=on_risk_trigger, refresh=refresh_risk,
+                    interval_s=RISK_POLL_S, log=log)
 
 # ===========================
 #       LOOP PRINCIPAL
 # ===========================
-def run_once():
+def run_once(keep_session: bool=False):
+    STAGES.begin_cycle()
     try:
         init_mt5()
-        # 1) Protección y límites
-        if enforce_limits():
-            return
-        # 2) TP de cesta
-        if try_close_basket():
-            # opcional: resembrar rejilla
-            ensure_grid()
-            return
-        # 3) Asegurar rejilla
-        ensure_grid()
-        # 4) (Opcional) anunciar nuevas capas llenadas, etc.
-        # notify_new_fills()
-        # 5) Log informativo
-        acc = account_info()
-        pl = current_floating_pl(SYMBOL)
-        log(f"ℹ️ Balance={acc.balance:.2f} Equity={acc.equity:.2f} PL_flotante({SYMBOL})={pl:.2f}")
+        # 0) Llenados desde el último ciclo (si no hay hilo vigilante)
+        notify_new_fills()
+        with CYCLE_LOCK:
+            SNAPSHOT.reset()
+            try:
+                # 1) Protección y límites
+                if enforce_limits():
+                    return
+                # 2) TP de cesta
+                if try_close_basket():
+                    # opcional: resembrar rejilla
+                    ensure_grid()
+                    return
+                # 3) Asegurar rejilla
+                ensure_grid()
+                # 4) Log informativo
+                acc = account_info()
+                pl = current_floating_pl(SYMBOL)
+                log(f"ℹ️ Balance={acc.balance:.2f} Equity={acc.equity:.2f} PL_flotante({SYMBOL})={pl:.2f} "
+                    f"(consultas al terminal en el ciclo: {SNAPSHOT.calls})")
+            finally:
+                # 5) Estado del ciclo para el bucle rápido de riesgo
+                sync_risk()
     finally:
-        shutdown_mt5()
+        STAGES.end_cycle()
+        if not keep_session:
+            shutdown_mt5()
 
 def run_loop(every_minutes: int):
-    sleep_seconds = max(1, int(every_minutes * 60))
+    scheduler = BarCloseScheduler(every_minutes * 60, offset_ms=WAKE_AFTER_CLOSE_MS, timeframe=TIMEFRAME, log=log)
     log(f"♻️ LOOP: comprobación cada {every_minutes} minuto(s).")
-    while True:
-        start_ts = time.time()
-        try:
-            run_once()
-        except Exception as e:
-            log(f"❌ Error en iteración: {e}")
-            shutdown_mt5()
-        elapsed = time.time() - start_ts
-        remaining = max(0, sleep_seconds - int(elapsed))
-        log(f"⏳ Siguiente comprobación en ~{remaining} s.")
-        time.sleep(remaining)
+    try:
+        while True:
+            try:
+                run_once(keep_session=True)
+                # Con la sesión ya abierta, llenados y riesgo se vigilan entre ciclos
+                FILLS.start()
+                if FAST_RISK:
+                    RISK.start()
+            except Exception as e:
+                log(f"❌ Error en iteración: {e}")
+            scheduler.wait()
+    finally:
+        RISK.stop()
+        FILLS.stop()
+        log(f"ℹ️ Riesgo: {RISK.stats()}")
+        shutdown_mt5()
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Hedging+Martingale MT5 (rejilla simétrica con TP por cesta, ES+RU).")
@@ -3,7 +3,19 @@ import pandas as pd
 import numpy as np
 import time
 import argparse
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from zoneinfo import ZoneInfo
+from typing import Optional, Tuple
+from mt5_session import MT5Session, TERMINAL_LOCK
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender, pack_messages
+from candle_cache import CandleCache
+from bar_store import BarStore
+from indicators import IndicatorSet, rolling_max, rolling_min
+from symbol_specs import SymbolSpecCache
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES
@@ -43,11 +55,19 @@ HORIZON_MIN_DEFAULT = 5
 
 TZ = ZoneInfo("Europe/Madrid")
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa (init, velas, rasgos, Telegram, órdenes) y p50/p95/p99; False = sin coste
+
+# Histórico local de velas cerradas (memmap); evita re-descargar al reiniciar
+BARS_DIR = "bars"
+
+# Planificador: despertar X ms después de cada cierre de vela (reloj monotónico)
+WAKE_AFTER_CLOSE_MS = 1000
 
 # Gestión de riesgo
 ATR_LEN = 14
 R_MULT = 2.0
 ATR_SL_MULT = 1.0
+BREAKOUT_LOOKBACK = 12      # velas para máximos/mínimos de ruptura (≈ 60m en M5)
 
 # Trading automático
 TRADE_VOLUME     = 0.10     # lotes por operación
@@ -55,6 +75,21 @@ MAX_SPREAD_PIPS  = 3        # no entrar si spread > X pips aprox (para forex 5 d
 PROB_TRADE_TH    = 0.75     # umbral de probabilidad para ejecutar BUY
 AVOID_DUP_BUY    = True     # no abrir nueva BUY si ya existe una abierta en el símbolo
 
+# Modelo heurístico: pesos de la sigmoide (por símbolo y en lote)
+W_EMA, W_MOM, W_RSI, W_BRK, BIAS = 1.2, 1.0, 0.8, 1.2, 0.0
+FEATURE_COLS = ("ema_spread", "mom_h", "rsi_pos", "breakout_up", "breakout_dn")
+FEATURE_WEIGHTS = np.array([W_EMA, W_MOM, W_RSI, W_BRK, -0.8 * W_BRK])
+BATCH_MODEL = True          # rasgos y p_up de todos los símbolos en una pasada NumPy (False = por símbolo)
+LEAN_FEATURES = True        # por símbolo: rasgos sobre el array de MT5 (False = DataFrame + feature_bundle)
+
+# Concurrencia (análisis multi-símbolo)
+ANALYSIS_WORKERS = 4        # hilos por ciclo (1 = secuencial, como antes)
+MT5_LOCK = TERMINAL_LOCK     # la API de MT5 no admite llamadas concurrentes: lock compartido del proceso
+
+# Alertas Telegram
+BATCH_ALERTS         = True  # agrupa las alertas del ciclo en el mínimo de mensajes (<= 4096 caracteres)
+ALERT_ONLY_ON_CHANGE = True  # en modo agrupado: solo símbolos cuya decisión cambió desde el ciclo anterior
+
 # ===========================
 #      UTILIDADES
 # ===========================
@@ -62,35 +97,44 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+def serialized(fn):
+    """Ejecuta fn bajo MT5_LOCK (acceso al terminal de uno en uno)."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with MT5_LOCK:
+            return fn(*args, **kwargs)
+    return wrapper
+
+STAGES = StageTimer("mt5", enabled=STAGE_TIMING, log=log)
+
+TELEGRAM = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
+    """Encola el mensaje; el hilo de TELEGRAM lo entrega sin bloquear el ciclo."""
     if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID:
         log("⚠️ Telegram desactivado: faltan TELEGRAM_BOT_TOKEN o TELEGRAM_CHAT_ID")
         return
-    try:
-        import requests
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-        r = requests.post(url, data=data, timeout=15)
-        if r.status_code != 200:
-            log(f"⚠️ Telegram {r.status_code}: {r.text}")
-        else:
-            log("📨 Telegram OK")
-    except Exception as e:
-        log(f"❌ Telegram error: {e}")
+    TELEGRAM.send(message)
 
 def require_env_creds():
     if not MT5_LOGIN or not MT5_PASSWORD or not MT5_SERVER:
         raise RuntimeError("Faltan credenciales MT5 en variables de entorno (MT5_LOGIN, MT5_PASSWORD, MT5_SERVER).")
 
+SESSION = MT5Session(mt5, MT5_LOGIN, MT5_PASSWORD, MT5_SERVER, path=PATH_TO_TERMINAL, log=log)
+CANDLES = CandleCache(mt5, store=BarStore(BARS_DIR))
+SPECS = SymbolSpecCache(mt5, log=log)
+INDICATORS = {}  # símbolo -> IndicatorSet (estado streaming por símbolo)
+LAST_DECISIONS = {}  # símbolo -> última decisión notificada (modo agrupado)
+
+@STAGES.timed("init_mt5")
 def init_mt5():
     require_env_creds()
-    log("🔌 Inicializando MetaTrader 5...")
-    ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
-    if not ok:
-        raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
-    if not mt5.login(login=MT5_LOGIN, password=MT5_PASSWORD, server=MT5_SERVER):
-        raise RuntimeError(f"Login error: {mt5.last_error()}")
+    connect_ms = SESSION.ensure()
+    log(f"🔌 Sesión MT5 lista ({connect_ms:.1f} ms)")
 
+@STAGES.timed("ensure_symbol_ready")
+@serialized
 def ensure_symbol_ready(symbol: str):
     if not mt5.symbol_select(symbol, True):
         raise RuntimeError(f"No se pudo suscribir a {symbol}")
@@ -100,19 +144,25 @@ def ensure_symbol_ready(symbol: str):
     log(f"ℹ️ Tick inicial {symbol}: {tick}")
 
 def shutdown_mt5():
-    try:
-        mt5.shutdown()
-    except Exception:
-        pass
+    SESSION.close()
     log("🔚 MT5 cerrado.")
 
-def copy_rates(symbol, timeframe, n=1000):
-    data = mt5.copy_rates_from_pos(symbol, timeframe, 0, n)
+@STAGES.timed("copy_rates")
+def copy_rates_raw(symbol, timeframe, n=1000) -> np.ndarray:
+    """Array estructurado de MT5 tal cual (time en epoch s), sin DataFrame ni conversión de zona."""
+    with MT5_LOCK:
+        data = CANDLES.get(symbol, timeframe, n)
     if data is None or len(data) == 0:
         raise RuntimeError(f"No se pudieron obtener datos de velas para {symbol}")
-    df = pd.DataFrame(data)
-    df["time"] = pd.to_datetime(df["time"], unit="s", utc=True).dt.tz_convert(TZ)
-    return df
+    return data
+
+def copy_rates(symbol, timeframe, n=1000):
+    """DataFrame de velas; "time" queda en epoch (s, UTC): se convierte a TZ solo al formatear."""
+    return pd.DataFrame(copy_rates_raw(symbol, timeframe, n))
+
+def local_time(epoch) -> pd.Timestamp:
+    """Epoch (s, UTC) de MT5 -> hora local TZ (mensajes y logs)."""
+    return pd.Timestamp(int(epoch), unit="s", tz="UTC").tz_convert(TZ)
 
 # ===========================
 #      INDICADORES
@@ -138,47 +188,60 @@ def atr(df: pd.DataFrame, length=14):
     ], axis=1).max(axis=1)
     return tr.rolling(length).mean()
 
+def indicator_set(symbol: str) -> IndicatorSet:
+    if symbol not in INDICATORS:
+        INDICATORS[symbol] = IndicatorSet(ATR_LEN)
+    return INDICATORS[symbol]
+
 # ===========================
 #      MODELO HEURÍSTICO
 # ===========================
-def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=False) -> dict:
+@STAGES.timed("feature_bundle")
+def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=False,
+                   indicators: Optional[IndicatorSet]=None) -> dict:
     if len(df) < 100:
         raise ValueError("Histórico insuficiente (<100 velas).")
 
     bars_ahead = max(1, horizon_min // 5)
 
     df = df.copy()
-    df["ema20"] = ema(df["close"], 20)
-    df["ema50"] = ema(df["close"], 50)
-    df["rsi14"] = rsi(df["close"], 14)
-    df["atr14"] = atr(df, ATR_LEN)
+    if indicators is None:
+        df["ema20"] = ema(df["close"], 20)
+        df["ema50"] = ema(df["close"], 50)
+        df["rsi14"] = rsi(df["close"], 14)
+        df["atr14"] = atr(df, ATR_LEN)
 
     df["ret_h"] = df["close"] / df["close"].shift(bars_ahead) - 1.0
 
-    lookback = 12
-    df["hh_lb"] = df["high"].rolling(lookback).max()
-    df["ll_lb"] = df["low"].rolling(lookback).min()
+    lookback = BREAKOUT_LOOKBACK
+    if indicators is None:
+        df["hh_lb"] = rolling_max(df["high"].to_numpy(), lookback)
+        df["ll_lb"] = rolling_min(df["low"].to_numpy(), lookback)
 
     i = df.index[-1] if use_live_candle else df.index[-2]
+    if indicators is None:
+        ind = df.loc[i, ["ema20", "ema50", "rsi14", "atr14"]]
+    else:
+        # Motor streaming: solo procesa las velas cerradas nuevas desde el ciclo anterior
+        ind = indicators.evaluate(df["time"].values, df["high"].values, df["low"].values,
+                                  df["close"].values, use_live_candle=use_live_candle, lookbacks=(lookback,))
 
-    ema_spread = (df.loc[i, "ema20"] - df.loc[i, "ema50"]) / (df.loc[i, "atr14"] + 1e-8)
-    mom_h = df.loc[i, "ret_h"] / (((df["atr14"].loc[i] / df["close"].loc[i]) + 1e-8))
-    rsi_pos = (df.loc[i, "rsi14"] - 50.0) / 50.0
+    ema_spread = (ind["ema20"] - ind["ema50"]) / (ind["atr14"] + 1e-8)
+    mom_h = df.loc[i, "ret_h"] / (((ind["atr14"] / df["close"].loc[i]) + 1e-8))
+    rsi_pos = (ind["rsi14"] - 50.0) / 50.0
 
     close_i = df.loc[i, "close"]
     high_i  = df.loc[i, "high"]
     low_i   = df.loc[i, "low"]
-    hh_lb   = df.loc[i, "hh_lb"]
-    ll_lb   = df.loc[i, "ll_lb"]
+    hh_lb   = df.loc[i, "hh_lb"] if indicators is None else ind[f"hh{lookback}"]
+    ll_lb   = df.loc[i, "ll_lb"] if indicators is None else ind[f"ll{lookback}"]
     breakout_up = 1.0 if close_i > hh_lb * 0.999 else 0.0
     breakout_dn = 1.0 if close_i < ll_lb * 1.001 else 0.0
 
     tf_min = 5
-    candle_open  = df.loc[i, "time"]
-    candle_close = candle_open + pd.Timedelta(minutes=tf_min)
-
-    now = pd.Timestamp.now(tz=TZ)
-    age_min = (now - candle_close).total_seconds() / 60.0
+    candle_open  = int(df.loc[i, "time"])
+    candle_close = candle_open + tf_min * 60
+    age_min = (int(time.time()) - candle_close) / 60.0
 
     return {
         "ema_spread": float(ema_spread),
@@ -186,7 +249,7 @@ def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=Fal
         "rsi_pos": float(rsi_pos),
         "breakout_up": float(breakout_up),
         "breakout_dn": float(breakout_dn),
-        "atr": float(df.loc[i, "atr14"]),
+        "atr": float(ind["atr14"]),
         "price_close": float(close_i),
         "price_high": float(high_i),
         "price_low": float(low_i),
@@ -199,24 +262,186 @@ def feature_bundle(df: pd.DataFrame, horizon_min: int, use_live_candle: bool=Fal
         "age_min": float(age_min),
     }
 
+@STAGES.timed("feature_bundle")
+def feature_bundle_np(rates: np.ndarray, horizon_min: int, use_live_candle: bool=False,
+                      indicators: Optional[IndicatorSet]=None) -> dict:
+    """
+    feature_bundle sobre el array de copy_rates_raw, sin DataFrame ni columnas completas:
+    EMA/RSI/ATR y extremos salen del IndicatorSet (exactos en la vela evaluada; solo procesa
+    las velas nuevas) y ret_h de dos cierres. Sin indicators se siembra uno con todo el histórico.
+    """
+    n = len(rates)
+    if n < 100:
+        raise ValueError("Histórico insuficiente (<100 velas).")
+
+    bars_ahead = max(1, horizon_min // 5)
+    lookback = BREAKOUT_LOOKBACK
+    if indicators is None:
+        indicators = IndicatorSet(ATR_LEN)
+    close = rates["close"]
+    ind = indicators.evaluate(rates["time"], rates["high"], rates["low"], close,
+                              use_live_candle=use_live_candle, lookbacks=(lookback,))
+
+    i = n - 1 if use_live_candle else n - 2
+    close_i = float(close[i])
+    high_i = float(rates["high"][i])
+    low_i = float(rates["low"][i])
+    atr_i = ind["atr14"]
+
+    ema_spread = (ind["ema20"] - ind["ema50"]) / (atr_i + 1e-8)
+    mom_h = (close_i / float(close[i - bars_ahead]) - 1.0) / ((atr_i / close_i) + 1e-8)
+    rsi_pos = (ind["rsi14"] - 50.0) / 50.0
+    breakout_up = 1.0 if close_i > ind[f"hh{lookback}"] * 0.999 else 0.0
+    breakout_dn = 1.0 if close_i < ind[f"ll{lookback}"] * 1.001 else 0.0
+
+    tf_min = 5
+    candle_open  = int(rates["time"][i])
+    candle_close = candle_open + tf_min * 60
+    age_min = (int(time.time()) - candle_close) / 60.0
+
+    return {
+        "ema_spread": float(ema_spread),
+        "mom_h": float(mom_h),
+        "rsi_pos": float(rsi_pos),
+        "breakout_up": breakout_up,
+        "breakout_dn": breakout_dn,
+        "atr": float(atr_i),
+        "price_close": close_i,
+        "price_high": high_i,
+        "price_low": low_i,
+        "time_open": candle_open,
+        "time_close": candle_close,
+        "time": candle_close,
+        "horizon_min": horizon_min,
+        "bars_ahead": bars_ahead,
+        "use_live_candle": use_live_candle,
+        "age_min": float(age_min),
+    }
+
 def sigmoid(x: float) -> float:
     return 1.0 / (1.0 + np.exp(-x))
 
 def predict_up_probability(feat: dict) -> float:
-    w_ema   = 1.2
-    w_mom   = 1.0
-    w_rsi   = 0.8
-    w_brk   = 1.2
-    bias    = 0.0
     x = (
-            w_ema  * feat["ema_spread"] +
-            w_mom  * feat["mom_h"] +
-            w_rsi  * feat["rsi_pos"] +
-            w_brk  * (feat["breakout_up"] - 0.8 * feat["breakout_dn"]) +
-            bias
+            W_EMA  * feat["ema_spread"] +
+            W_MOM  * feat["mom_h"] +
+            W_RSI  * feat["rsi_pos"] +
+            W_BRK  * (feat["breakout_up"] - 0.8 * feat["breakout_dn"]) +
+            BIAS
     )
     return float(sigmoid(x))
 
+# ===========================
+#      MODELO EN LOTE (todos los símbolos)
+# ===========================
+def stack_rates(symbols, timeframe, n=600, workers: int=ANALYSIS_WORKERS):
+    """
+    Últimas n velas de cada símbolo apiladas en arrays (símbolos × n), alineadas a la derecha
+    por índice de vela: cada fila conserva su propia última vela (los mercados no abren a la vez).
+    Las filas con menos de n velas se rellenan con NaN por la izquierda. Las velas salen de
+    CANDLES (solo las nuevas se piden a MT5), en el pool de hilos si workers > 1.
+    Devuelve (símbolos válidos, {time, high, low, close}, {símbolo: error}, {símbolo: ms de descarga}).
+    """
+    def fetch(symbol):
+        t0 = time.perf_counter()
+        try:
+            ensure_symbol_ready(symbol)
+            data = copy_rates_raw(symbol, timeframe, n)
+            if len(data) < 100:
+                raise ValueError("Histórico insuficiente (<100 velas).")
+            error = None
+        except Exception as e:
+            data, error = None, e
+        return symbol, data, error, (time.perf_counter() - t0) * 1000.0
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sym") as pool:
+            fetched = list(pool.map(fetch, symbols))
+    else:
+        fetched = [fetch(s) for s in symbols]
+
+    ok, rows, errors, fetch_ms = [], [], {}, {}
+    for symbol, data, error, ms in fetched:
+        fetch_ms[symbol] = ms
+        if error is not None:
+            errors[symbol] = error
+        else:
+            ok.append(symbol)
+            rows.append(data)
+
+    rates = {key: np.full((len(ok), n), np.nan) for key in ("high", "low", "close")}
+    rates["time"] = np.zeros((len(ok), n), dtype=np.int64)
+    for k, data in enumerate(rows):
+        m = min(len(data), n)
+        for key in rates:
+            rates[key][k, n - m:] = data[key][-m:]
+    return ok, rates, errors, fetch_ms
+
+@STAGES.timed("feature_bundle")
+def feature_matrix(rates: dict, horizon_min: int, use_live_candle: bool=False) -> Tuple[np.ndarray, dict]:
+    """
+    Mismos rasgos que feature_bundle, calculados a lo largo del eje temporal para todas las filas a la vez.
+    Devuelve X (símbolos × FEATURE_COLS) en la vela evaluada y los valores auxiliares (arrays por símbolo).
+    """
+    close, high, low = rates["close"], rates["high"], rates["low"]
+    n = close.shape[1]
+    i = n - 1 if use_live_candle else n - 2
+    bars_ahead = max(1, horizon_min // 5)
+
+    # EMA/RSI: ewm sobre las columnas de un único DataFrame (tiempo × símbolos)
+    frame = pd.DataFrame(close[:, :i + 1].T)
+    ema20 = ema(frame, 20).to_numpy()[-1]
+    ema50 = ema(frame, 50).to_numpy()[-1]
+    rsi14 = rsi(frame, 14).to_numpy()[-1]
+
+    # ATR: media del true range de las ATR_LEN velas hasta i (fmax ignora el NaN de la primera vela, como pandas)
+    lo = i - ATR_LEN + 1
+    prev_close = close[:, lo - 1:i] if lo > 0 else np.column_stack([np.full(len(close), np.nan), close[:, :i]])
+    h, l = high[:, lo:i + 1], low[:, lo:i + 1]
+    tr = np.fmax(np.fmax(h - l, np.abs(h - prev_close)), np.abs(l - prev_close))
+    atr14 = tr.mean(axis=1)
+
+    lookback = BREAKOUT_LOOKBACK
+    close_i, high_i, low_i = close[:, i], high[:, i], low[:, i]
+    ret_h = close_i / close[:, i - bars_ahead] - 1.0
+    hh_lb = high[:, i - lookback + 1:i + 1].max(axis=1)
+    ll_lb = low[:, i - lookback + 1:i + 1].min(axis=1)
+
+    X = np.column_stack([
+        (ema20 - ema50) / (atr14 + 1e-8),
+        ret_h / ((atr14 / close_i) + 1e-8),
+        (rsi14 - 50.0) / 50.0,
+        (close_i > hh_lb * 0.999).astype(float),
+        (close_i < ll_lb * 1.001).astype(float),
+    ])
+
+    tf_min = 5
+    candle_open = rates["time"][:, i]
+    candle_close = candle_open + tf_min * 60
+    age_min = (int(time.time()) - candle_close) / 60.0
+    extra = {
+        "atr": atr14, "price_close": close_i, "price_high": high_i, "price_low": low_i,
+        "time_open": candle_open, "time_close": candle_close, "age_min": age_min,
+        "horizon_min": horizon_min, "bars_ahead": bars_ahead, "use_live_candle": use_live_candle,
+    }
+    return X, extra
+
+def score_matrix(X: np.ndarray) -> np.ndarray:
+    """p_up de todos los símbolos: un producto matriz-vector y la sigmoide."""
+    return sigmoid(X @ FEATURE_WEIGHTS + BIAS)
+
+def feature_row(X: np.ndarray, extra: dict, k: int) -> dict:
+    """Fila k como el dict de feature_bundle (para build_recommendation y el mensaje)."""
+    feat = {name: float(X[k, j]) for j, name in enumerate(FEATURE_COLS)}
+    for name in ("atr", "price_close", "price_high", "price_low", "age_min"):
+        feat[name] = float(extra[name][k])
+    feat["time_open"] = int(extra["time_open"][k])
+    feat["time_close"] = int(extra["time_close"][k])
+    feat["time"] = feat["time_close"]
+    for name in ("horizon_min", "bars_ahead", "use_live_candle"):
+        feat[name] = extra[name]
+    return feat
+
 # ===========================
 #      DECISIÓN Y MENSAJE
 # ===========================
@@ -267,8 +492,8 @@ def build_recommendation(feat: dict, p_up: float) -> dict:
     }
 
 def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
-    ts_close = str(rec["time"])
-    ts_open  = str(feat.get("time_open"))
+    ts_close = str(local_time(rec["time"]))
+    ts_open  = str(local_time(feat["time_open"]))
     p = rec["p_up"] * 100.0
     horizon = rec.get("horizon_min", HORIZON_MIN_DEFAULT)
     age_min = rec.get("age_min", None)
@@ -340,6 +565,7 @@ def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
 # ===========================
 #      TRADING REAL
 # ===========================
+@serialized
 def has_open_buy_position(symbol: str) -> bool:
     positions = mt5.positions_get(symbol=symbol)
     if positions is None:
@@ -349,11 +575,13 @@ def has_open_buy_position(symbol: str) -> bool:
             return True
     return False
 
+@STAGES.timed("place_buy_order")
+@serialized
 def place_buy_order(symbol: str, sl_price: float, tp_price: float, volume: float):
-    info = mt5.symbol_info(symbol)
-    if info is None:
+    spec = SPECS.get(symbol)
+    if spec is None:
         raise RuntimeError(f"{symbol}: symbol_info() devolvió None")
-    if not info.trade_allowed:
+    if not spec.trade_allowed:
         raise RuntimeError(f"{symbol}: trading no permitido en este símbolo")
 
     tick = mt5.symbol_info_tick(symbol)
@@ -362,7 +590,7 @@ def place_buy_order(symbol: str, sl_price: float, tp_price: float, volume: float
 
     ask = tick.ask
     bid = tick.bid
-    spread_points = (ask - bid) / info.point
+    spread_points = (ask - bid) / spec.point
 
     # Para forex con 5 dígitos: 1 pip ~ 10 puntos
     try:
@@ -372,14 +600,18 @@ def place_buy_order(symbol: str, sl_price: float, tp_price: float, volume: float
     except Exception:
         pass
 
+    lots = spec.normalize_volume(volume)
+    if lots <= 0:
+        raise RuntimeError(f"{symbol}: volumen {volume} por debajo del mínimo {spec.volume_min}")
+
     request = {
         "action": mt5.TRADE_ACTION_DEAL,
         "symbol": symbol,
-        "volume": float(volume),
+        "volume": lots,
         "type": mt5.ORDER_TYPE_BUY,
         "price": float(ask),
-        "sl": float(sl_price) if sl_price is not None else 0.0,
-        "tp": float(tp_price) if tp_price is not None else 0.0,
+        "sl": spec.round_price(sl_price) if sl_price is not None else 0.0,
+        "tp": spec.round_price(tp_price) if tp_price is not None else 0.0,
         "deviation": 20,
         "magic": 123456,
         "comment": "auto-buy p_up>=0.75",
@@ -392,6 +624,7 @@ def place_buy_order(symbol: str, sl_price: float, tp_price: float, volume: float
         raise RuntimeError(f"{symbol}: order_send() devolvió None, error {mt5.last_error()}")
 
     if result.retcode != mt5.TRADE_RETCODE_DONE:
+        SPECS.check(symbol, result.retcode)
         raise RuntimeError(f"{symbol}: order_send fallo retcode={result.retcode} detalles={result}")
 
     return result
@@ -399,17 +632,29 @@ def place_buy_order(symbol: str, sl_price: float, tp_price: float, volume: float
 # ===========================
 #       CICLOS / MAIN
 # ===========================
-def analyze_symbol(symbol: str, horizon_min: int, use_live_candle: bool=False) -> str:
+def analyze_symbol(symbol: str, horizon_min: int, use_live_candle: bool=False) -> Tuple[str, dict]:
     ensure_symbol_ready(symbol)
     log(f"📊 Analizando {symbol} M5…")
-    df = copy_rates(symbol, TIMEFRAME, 600)
-    log(f"📈 Últimas 3 velas {symbol}: {list(df['time'].tail(3))}")
-
-    feat = feature_bundle(df, horizon_min=horizon_min, use_live_candle=use_live_candle)
+    if LEAN_FEATURES:
+        rates = copy_rates_raw(symbol, TIMEFRAME, 600)
+        if DEBUG:
+            log(f"📈 Últimas 3 velas {symbol}: {[str(local_time(t)) for t in rates['time'][-3:]]}")
+        feat = feature_bundle_np(rates, horizon_min=horizon_min, use_live_candle=use_live_candle,
+                                 indicators=indicator_set(symbol))
+    else:
+        df = copy_rates(symbol, TIMEFRAME, 600)
+        if DEBUG:
+            log(f"📈 Últimas 3 velas {symbol}: {[str(local_time(t)) for t in df['time'].tail(3)]}")
+        feat = feature_bundle(df, horizon_min=horizon_min, use_live_candle=use_live_candle,
+                              indicators=indicator_set(symbol))
     if feat["age_min"] > 10 and not use_live_candle:
         log(f"⚠️ {symbol}: datos retrasados {feat['age_min']:.1f} min; revisa conexión/mercado.")
 
     p_up = predict_up_probability(feat)
+    return act_on_prediction(symbol, feat, p_up)
+
+def act_on_prediction(symbol: str, feat: dict, p_up: float) -> Tuple[str, dict]:
+    """Recomendación, mensaje y auto-trade de un símbolo ya evaluado."""
     rec  = build_recommendation(feat, p_up)
 
     message = format_bilingual_message(symbol, rec, feat)
@@ -423,13 +668,15 @@ def analyze_symbol(symbol: str, horizon_min: int, use_live_candle: bool=False) -
                 if rec["decision"] == "buy":
                     sl_price = rec["stop"]
                     tp_price = rec["tp"]
-                    tick_now = mt5.symbol_info_tick(symbol)
+                    with MT5_LOCK:
+                        tick_now = mt5.symbol_info_tick(symbol)
                     if tick_now is not None and sl_price is not None and tp_price is not None:
                         current_ask = tick_now.ask
                         if sl_price < current_ask < tp_price:
                             log(f"🚀 Enviando BUY {symbol} vol={TRADE_VOLUME} SL={sl_price:.3f} TP={tp_price:.3f}")
                             trade_result = place_buy_order(symbol, sl_price, tp_price, TRADE_VOLUME)
                             log(f"✅ Orden enviada {symbol}: retcode={trade_result.retcode}")
+                            rec["auto_trade"] = True
                             message += (
                                 "\n\n[AUTO-TRADE]\n"
                                 f"Se envió BUY {symbol} vol={TRADE_VOLUME} SL={sl_price:.3f} TP={tp_price:.3f}\n"
@@ -446,35 +693,160 @@ def analyze_symbol(symbol: str, horizon_min: int, use_live_candle: bool=False) -
     except Exception as trade_err:
         log(f"❌ Error al intentar operar {symbol}: {trade_err}")
 
-    return message
+    return message, rec
 
-def run_once(horizon_min: int, use_live_candle: bool=False):
+def process_symbol(symbol: str, horizon_min: int, use_live_candle: bool=False, notify: bool=True) -> dict:
+    """Analiza (y si notify, notifica) un símbolo; devuelve mensaje/error y tiempos (ms) por etapa."""
+    out = {"symbol": symbol, "message": None, "rec": None, "error": None, "analyze_ms": 0.0, "telegram_ms": 0.0}
+    t0 = time.perf_counter()
     try:
-        init_mt5()
-        for symbol in SYMBOLS:
+        out["message"], out["rec"] = analyze_symbol(symbol, horizon_min=horizon_min, use_live_candle=use_live_candle)
+        t1 = time.perf_counter()
+        out["analyze_ms"] = (t1 - t0) * 1000.0
+        if notify:
+            send_telegram(out["message"])
+        out["telegram_ms"] = (time.perf_counter() - t1) * 1000.0
+    except Exception as e_symbol:
+        out["error"] = e_symbol
+        out["analyze_ms"] = (time.perf_counter() - t0) * 1000.0
+    out["total_ms"] = out["analyze_ms"] + out["telegram_ms"]
+    return out
+
+def process_batch(symbols, horizon_min: int, use_live_candle: bool=False, notify: bool=True,
+                  workers: int=ANALYSIS_WORKERS) -> list:
+    """
+    Como process_symbol para todos los símbolos, pero con el modelo evaluado en lote:
+    velas cacheadas de cada símbolo (en el pool), rasgos y p_up de todos en una pasada NumPy a lo
+    largo del eje temporal, y después
+    decisión/mensaje/auto-trade por símbolo. analyze_ms = descarga + decisión del símbolo.
+    """
+    ok, rates, errors, fetch_ms = stack_rates(symbols, TIMEFRAME, 600, workers=workers)
+    index = {symbol: k for k, symbol in enumerate(ok)}
+    if ok:
+        t0 = time.perf_counter()
+        X, extra = feature_matrix(rates, horizon_min=horizon_min, use_live_candle=use_live_candle)
+        p_up = score_matrix(X)
+        log(f"🧮 Modelo en lote: {X.shape[0]} símbolo(s) × {X.shape[1]} rasgos en {(time.perf_counter() - t0) * 1000.0:.2f} ms")
+
+    results = []
+    for symbol in symbols:
+        out = {"symbol": symbol, "message": None, "rec": None, "error": errors.get(symbol),
+               "analyze_ms": fetch_ms.get(symbol, 0.0), "telegram_ms": 0.0}
+        if symbol in index:
+            t0 = time.perf_counter()
             try:
-                msg = analyze_symbol(symbol, horizon_min=horizon_min, use_live_candle=use_live_candle)
-                print(msg)
-                send_telegram(msg)
+                feat = feature_row(X, extra, index[symbol])
+                if feat["age_min"] > 10 and not use_live_candle:
+                    log(f"⚠️ {symbol}: datos retrasados {feat['age_min']:.1f} min; revisa conexión/mercado.")
+                out["message"], out["rec"] = act_on_prediction(symbol, feat, float(p_up[index[symbol]]))
+                t1 = time.perf_counter()
+                out["analyze_ms"] += (t1 - t0) * 1000.0
+                if notify:
+                    send_telegram(out["message"])
+                out["telegram_ms"] = (time.perf_counter() - t1) * 1000.0
             except Exception as e_symbol:
-                log(f"❌ Error con {symbol}: {e_symbol}")
+                out["error"] = e_symbol
+        out["total_ms"] = out["analyze_ms"] + out["telegram_ms"]
+        results.append(out)
+    return results
+
+def check_batch_parity(horizon_min: int, use_live_candle: bool=False) -> float:
+    """Compara p_up del modelo en lote con feature_bundle + predict_up_probability (pandas); devuelve el error máximo."""
+    try:
+        init_mt5()
+        ok, rates, errors, _ = stack_rates(SYMBOLS, TIMEFRAME, 600)
+        X, extra = feature_matrix(rates, horizon_min=horizon_min, use_live_candle=use_live_candle)
+        p_batch = score_matrix(X)
+        worst = 0.0
+        for k, symbol in enumerate(ok):
+            feat = feature_bundle(copy_rates(symbol, TIMEFRAME, 600), horizon_min=horizon_min,
+                                  use_live_candle=use_live_candle)
+            diff = abs(predict_up_probability(feat) - p_batch[k])
+            worst = max(worst, diff)
+            log(f"🔎 {symbol}: p_up lote={p_batch[k]:.6f} por símbolo={predict_up_probability(feat):.6f} Δ={diff:.2e}")
+        for symbol, e in errors.items():
+            log(f"❌ {symbol}: {e}")
+        log(f"✅ Paridad lote vs por símbolo: {len(ok)} símbolo(s), error máximo {worst:.2e}")
+        return worst
     finally:
         shutdown_mt5()
 
-def run_loop(every_minutes: int, horizon_min: int, use_live_candle: bool=False):
-    sleep_seconds = max(1, int(every_minutes * 60))
-    log(f"♻️ LOOP: comprobación cada {every_minutes} minuto(s). Horizonte={horizon_min}m. Live={use_live_candle}.")
-    while True:
-        start_ts = time.time()
-        try:
-            run_once(horizon_min=horizon_min, use_live_candle=use_live_candle)
-        except Exception as e:
-            log(f"❌ Error en iteración global: {e}")
+def send_batched_alerts(results: list, only_changed: bool=ALERT_ONLY_ON_CHANGE) -> int:
+    """Envía en el mínimo de mensajes las alertas del ciclo (solo cambios de decisión si only_changed)."""
+    parts = []
+    for r in results:
+        if r["error"] is not None:
+            continue
+        decision = r["rec"]["decision"]
+        changed = LAST_DECISIONS.get(r["symbol"]) != decision
+        if changed or r["rec"].get("auto_trade") or not only_changed:
+            parts.append(r["message"])
+        LAST_DECISIONS[r["symbol"]] = decision
+    batches = pack_messages(parts)
+    for text in batches:
+        send_telegram(text)
+    log(f"📦 Alertas agrupadas: {len(parts)}/{len(results)} símbolo(s) en {len(batches)} mensaje(s)")
+    return len(batches)
+
+def run_once(horizon_min: int, use_live_candle: bool=False, keep_session: bool=False,
+             workers: int=ANALYSIS_WORKERS, batch: bool=BATCH_ALERTS, batch_model: Optional[bool]=None):
+    if batch_model is None:
+        batch_model = BATCH_MODEL
+    STAGES.begin_cycle()
+    try:
+        init_mt5()
+        t0 = time.perf_counter()
+        notify = not batch
+        if batch_model:
+            results = process_batch(SYMBOLS, horizon_min=horizon_min, use_live_candle=use_live_candle, notify=notify,
+                                    workers=workers)
+        elif workers > 1:
+            # Descarga (serializada por MT5_LOCK), cálculo y Telegram de cada símbolo se solapan;
+            # pool.map conserva el orden de SYMBOLS al recoger los resultados.
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sym") as pool:
+                results = list(pool.map(
+                    lambda s: process_symbol(s, horizon_min=horizon_min, use_live_candle=use_live_candle,
+                                             notify=notify),
+                    SYMBOLS))
+        else:
+            results = [process_symbol(s, horizon_min=horizon_min, use_live_candle=use_live_candle, notify=notify)
+                       for s in SYMBOLS]
+        cycle_ms = (time.perf_counter() - t0) * 1000.0
+
+        for r in results:
+            if r["error"] is not None:
+                log(f"❌ Error con {r['symbol']}: {r['error']}")
+            else:
+                print(r["message"])
+            log(f"⏱️ {r['symbol']}: análisis {r['analyze_ms']:.0f} ms | Telegram {r['telegram_ms']:.0f} ms")
+        if results:
+            slowest = max(results, key=lambda r: r["total_ms"])
+            mode = f"modelo en lote, {workers} hilo(s)" if batch_model else f"{workers} hilo(s)"
+            log(f"⏱️ Ciclo {cycle_ms:.0f} ms con {mode} | suma por símbolo "
+                f"{sum(r['total_ms'] for r in results):.0f} ms | más lento {slowest['symbol']} {slowest['total_ms']:.0f} ms")
+        if batch:
+            send_batched_alerts(results)
+    finally:
+        STAGES.end_cycle()
+        if not keep_session:
             shutdown_mt5()
-        elapsed = time.time() - start_ts
-        remaining = max(0, sleep_seconds - int(elapsed))
-        log(f"⏳ Siguiente comprobación en ~{remaining} s.")
-        time.sleep(remaining)
+
+def run_loop(every_minutes: int, horizon_min: int, use_live_candle: bool=False,
+             workers: int=ANALYSIS_WORKERS, batch: bool=BATCH_ALERTS, batch_model: Optional[bool]=None):
+    scheduler = BarCloseScheduler(every_minutes * 60, offset_ms=WAKE_AFTER_CLOSE_MS, timeframe=TIMEFRAME, log=log)
+    log(f"♻️ LOOP: comprobación cada {every_minutes} minuto(s). Horizonte={horizon_min}m. Live={use_live_candle}.")
+    try:
+        while True:
+            try:
+                # La sesión MT5 se mantiene entre iteraciones; SESSION.ensure() reconecta si se cae.
+                run_once(horizon_min=horizon_min, use_live_candle=use_live_candle, keep_session=True,
+                         workers=workers, batch=batch, batch_model=batch_model)
+            except Exception as e:
+                log(f"❌ Error en iteración global: {e}")
+            log(f"ℹ️ Sesión: {SESSION.stats()} Velas: {CANDLES.stats()} Specs: {SPECS.stats()} Planificador: {scheduler.stats()}")
+            scheduler.wait()
+    finally:
+        shutdown_mt5()
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -488,11 +860,28 @@ def parse_args():
                         help="Usar la última vela en formación (más reactivo, más ruido).")
     parser.add_argument("--once", action="store_true",
                         help="Ejecuta una sola vez y termina.")
+    parser.add_argument("--workers", type=int, default=ANALYSIS_WORKERS,
+                        help=f"Símbolos analizados en paralelo (por defecto: {ANALYSIS_WORKERS}; 1 = secuencial).")
+    parser.add_argument("--no-batch", action="store_true",
+                        help="Un mensaje de Telegram por símbolo y ciclo (sin agrupar ni filtrar cambios).")
+    parser.add_argument("--per-symbol", action="store_true",
+                        help="Evalúa el modelo símbolo a símbolo (DataFrame + feature_bundle) en lugar de en lote.")
+    parser.add_argument("--no-stage-timing", action="store_true",
+                        help="Sin medición por etapa ni línea resumen de tiempos por ciclo.")
+    parser.add_argument("--check-batch", action="store_true",
+                        help="Compara p_up del modelo en lote con el cálculo por símbolo y termina.")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
-    if args.once:
-        run_once(horizon_min=args.horizon_min, use_live_candle=args.use_live_candle)
+    batch_model = False if args.per_symbol else None   # None: BATCH_MODEL en cada llamada
+    if args.no_stage_timing:
+        STAGES.enabled = False
+    if args.check_batch:
+        check_batch_parity(horizon_min=args.horizon_min, use_live_candle=args.use_live_candle)
+    elif args.once:
+        run_once(horizon_min=args.horizon_min, use_live_candle=args.use_live_candle, workers=args.workers,
+                 batch=not args.no_batch, batch_model=batch_model)
     else:
-        run_loop(args.every_min, horizon_min=args.horizon_min, use_live_candle=args.use_live_candle)
+        run_loop(args.every_min, horizon_min=args.horizon_min, use_live_candle=args.use_live_candle,
+                 workers=args.workers, batch=not args.no_batch, batch_model=batch_model)
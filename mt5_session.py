@@ -0,0 +1,136 @@
+import functools
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+# La API de MT5 no admite llamadas concurrentes: un único lock por proceso para todo
+# lo que habla con el terminal (scripts, hilos de órdenes, llenados y riesgo, supervisor).
+TERMINAL_LOCK = threading.RLock()
+
+class LockedAPI:
+    """
+    El módulo MetaTrader5 con cada función llamada bajo terminal_lock; las constantes
+    (ORDER_TYPE_BUY, TIMEFRAME_M5…) se devuelven tal cual. El supervisor lo pone como `mt5`
+    de cada plug-in, así sus llamadas sueltas no se cruzan con los hilos de llenados y riesgo.
+    """
+
+    def __init__(self, api, terminal_lock=TERMINAL_LOCK):
+        self._api = api
+        self._lock = terminal_lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked
+
+# ===========================
+#      SESIÓN MT5 PERSISTENTE
+# ===========================
+class MT5Session:
+    """
+    Mantiene el terminal MT5 conectado entre iteraciones de run_loop.
+    - ensure(): comprobación barata (terminal_info/account_info); solo hace
+      initialize + login + symbol_select si el enlace no está sano.
+    - Reconexión con backoff exponencial cuando la conexión se cae.
+    - Expone la latencia de conexión de cada ciclo (last_connect_ms) y totales.
+    """
+
+    def __init__(self, api, login: int, password: str, server: str,
+                 path: Optional[str] = None, symbols: Iterable[str] = (),
+                 retries: int = 5, backoff_s: float = 1.0, max_backoff_s: float = 30.0,
+                 log: Callable[[str], None] = print, terminal_lock=TERMINAL_LOCK):
+        self.api = api
+        self.login = login
+        self.password = password
+        self.server = server
+        self.path = path
+        self.symbols = list(symbols)
+        self.retries = max(1, int(retries))
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.log = log
+        self.terminal_lock = terminal_lock
+
+        self.connected = False
+        self.connects = 0
+        self.reuses = 0
+        self.last_connect_ms = 0.0
+        self.total_connect_ms = 0.0
+
+    def is_healthy(self) -> bool:
+        if not self.connected:
+            return False
+        try:
+            term = self.api.terminal_info()
+            if term is None or not getattr(term, "connected", True):
+                return False
+            acc = self.api.account_info()
+            return acc is not None and acc.login == self.login
+        except Exception:
+            return False
+
+    def _connect(self):
+        api = self.api
+        self.log("🔌 Inicializando MetaTrader 5...")
+        ok = api.initialize(self.path) if self.path else api.initialize()
+        if not ok:
+            raise RuntimeError(f"MT5 init error: {api.last_error()}")
+        if not api.login(login=self.login, password=self.password, server=self.server):
+            raise RuntimeError(f"Login error: {api.last_error()}")
+        for symbol in self.symbols:
+            if not api.symbol_select(symbol, True):
+                raise RuntimeError(f"No se pudo suscribir a {symbol}")
+        self.connected = True
+
+    def _drop(self):
+        self.connected = False
+        try:
+            self.api.shutdown()
+        except Exception:
+            pass
+
+    def ensure(self) -> float:
+        """Garantiza una sesión válida. Devuelve la latencia de conexión del ciclo (ms)."""
+        t0 = time.perf_counter()
+        with self.terminal_lock:
+            if self.is_healthy():
+                self.reuses += 1
+            else:
+                if self.connected:
+                    self.log("⚠️ Conexión MT5 caída; reconectando...")
+                self._drop()
+                delay = self.backoff_s
+                for attempt in range(1, self.retries + 1):
+                    try:
+                        self._connect()
+                        break
+                    except Exception as e:
+                        self._drop()
+                        if attempt == self.retries:
+                            raise
+                        self.log(f"⚠️ Intento {attempt}/{self.retries} fallido: {e}. Reintento en {delay:.1f} s.")
+                        time.sleep(delay)
+                        delay = min(delay * 2, self.max_backoff_s)
+                self.connects += 1
+        self.last_connect_ms = (time.perf_counter() - t0) * 1000.0
+        self.total_connect_ms += self.last_connect_ms
+        return self.last_connect_ms
+
+    def close(self):
+        with self.terminal_lock:
+            self._drop()
+
+    def stats(self) -> dict:
+        cycles = self.connects + self.reuses
+        return {
+            "connects": self.connects,
+            "reuses": self.reuses,
+            "last_connect_ms": self.last_connect_ms,
+            "avg_connect_ms": self.total_connect_ms / cycles if cycles else 0.0,
+        }
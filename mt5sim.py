@@ -0,0 +1,920 @@
+import argparse
+import contextlib
+import fnmatch
+import importlib
+import inspect
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Optional
+
+import numpy as np
+
+from bar_store import RATE_DTYPE, BarStore
+from scheduler import timeframe_seconds
+
+# ===========================
+#      CONSTANTES (mismos valores que el paquete MetaTrader5)
+# ===========================
+TIMEFRAME_M1 = 1
+TIMEFRAME_M5 = 5
+TIMEFRAME_M15 = 15
+TIMEFRAME_M30 = 30
+TIMEFRAME_H1 = 0x4000 | 1
+TIMEFRAME_H4 = 0x4000 | 4
+TIMEFRAME_D1 = 0x4000 | 24
+TIMEFRAME_W1 = 0x8000 | 1
+
+ORDER_TYPE_BUY = 0
+ORDER_TYPE_SELL = 1
+ORDER_TYPE_BUY_LIMIT = 2
+ORDER_TYPE_SELL_LIMIT = 3
+ORDER_TYPE_BUY_STOP = 4
+ORDER_TYPE_SELL_STOP = 5
+
+POSITION_TYPE_BUY = 0
+POSITION_TYPE_SELL = 1
+
+DEAL_TYPE_BUY = 0
+DEAL_TYPE_SELL = 1
+DEAL_ENTRY_IN = 0
+DEAL_ENTRY_OUT = 1
+
+TRADE_ACTION_DEAL = 1
+TRADE_ACTION_PENDING = 5
+TRADE_ACTION_SLTP = 6
+TRADE_ACTION_REMOVE = 8
+
+ORDER_FILLING_FOK = 0
+ORDER_FILLING_IOC = 1
+ORDER_FILLING_RETURN = 2
+ORDER_TIME_GTC = 0
+
+TRADE_RETCODE_DONE = 10009
+TRADE_RETCODE_INVALID = 10013
+TRADE_RETCODE_INVALID_VOLUME = 10014
+TRADE_RETCODE_INVALID_PRICE = 10015
+TRADE_RETCODE_INVALID_STOPS = 10016
+TRADE_RETCODE_PRICE_OFF = 10021
+
+COPY_TICKS_ALL = -1
+
+# Mismo layout que el array que devuelve copy_ticks_from
+TICK_DTYPE = np.dtype([
+    ("time", "<i8"),
+    ("bid", "<f8"),
+    ("ask", "<f8"),
+    ("last", "<f8"),
+    ("volume", "<u8"),
+    ("time_msc", "<i8"),
+    ("flags", "<u4"),
+    ("volume_real", "<f8"),
+])
+
+SYMBOLS_FILE = "symbols.json"
+SYMBOL_FIELDS = ("digits", "point", "trade_contract_size", "volume_min", "volume_max", "volume_step",
+                 "trade_stops_level", "trade_tick_size", "trade_tick_value", "currency_profit")
+SYNTH_DAYS = 30          # histórico sintético (M1) hacia atrás desde el inicio de la reproducción
+SYNTH_AHEAD_DAYS = 3     # velas "futuras" que se van revelando al avanzar el reloj
+
+# ===========================
+#      RELOJ DE REPRODUCCIÓN
+# ===========================
+class SimClock:
+    """
+    Hora simulada (epoch, s). speed=1 avanza como el reloj real, speed=0 solo con advance().
+    """
+
+    def __init__(self, start: float, speed: float = 1.0):
+        self.start = float(start)
+        self.speed = speed
+        self._offset = 0.0
+        self._t0 = time.monotonic()
+
+    def now(self) -> float:
+        return self.start + self._offset + self.speed * (time.monotonic() - self._t0)
+
+    def advance(self, seconds: float):
+        self._offset += seconds
+
+# ===========================
+#      DATOS GRABADOS / SINTÉTICOS
+# ===========================
+def _default_spec(symbol: str) -> dict:
+    name = symbol.upper()
+    if "JPY" in name:
+        digits, contract = 3, 100000.0
+    elif name.startswith(("XAU", "XAG")):
+        digits, contract = 2, 100.0
+    elif len(name) == 6 and name.isalpha() and name.isupper():
+        digits, contract = 5, 100000.0
+    else:
+        digits, contract = 2, 1.0
+    return {
+        "digits": digits,
+        "point": 10.0 ** -digits,
+        "trade_contract_size": contract,
+        "volume_min": 0.01,
+        "volume_max": 100.0,
+        "volume_step": 0.01,
+        "trade_stops_level": 0,
+        "trade_tick_size": 10.0 ** -digits,
+        "trade_tick_value": 1.0,
+        "currency_profit": name[3:6] if contract == 100000.0 else "USD",
+    }
+
+def _synthetic_bars(symbol: str, start: int, end: int, spec: dict) -> np.ndarray:
+    """Paseo aleatorio M1 determinista por símbolo entre start y end (epoch, múltiplos de 60)."""
+    name = symbol.upper()
+    base = 150.0 if "JPY" in name else 2400.0 if name.startswith("XAU") else \
+        60000.0 if name.startswith("BTC") else 1.10 if spec["digits"] == 5 else 100.0
+    rng = np.random.default_rng(zlib.crc32(symbol.encode()))
+    n = (end - start) // 60 + 1
+    close = base * np.exp(np.cumsum(rng.normal(0.0, 0.0003, n)))
+    open_ = np.concatenate([[base], close[:-1]])
+    wick = np.abs(rng.normal(0.0, 0.0002, (2, n))) * close
+    bars = np.zeros(n, dtype=RATE_DTYPE)
+    bars["time"] = start + 60 * np.arange(n)
+    bars["open"] = open_
+    bars["high"] = np.maximum(open_, close) + wick[0]
+    bars["low"] = np.minimum(open_, close) - wick[1]
+    bars["close"] = close
+    bars["tick_volume"] = rng.integers(20, 400, n)
+    bars["spread"] = 10 if spec["digits"] >= 3 else 30
+    for field in ("open", "high", "low", "close"):
+        bars[field] = np.round(bars[field], spec["digits"])
+    return bars
+
+def _resample(bars: np.ndarray, period_s: int) -> np.ndarray:
+    """Agrega velas finas a un timeframe mayor (OHLC + volúmenes) con reduceat."""
+    keys = bars["time"] // period_s
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    ends = np.concatenate([starts[1:], [len(bars)]]) - 1
+    out = np.zeros(len(starts), dtype=RATE_DTYPE)
+    out["time"] = keys[starts] * period_s
+    out["open"] = bars["open"][starts]
+    out["high"] = np.maximum.reduceat(bars["high"], starts)
+    out["low"] = np.minimum.reduceat(bars["low"], starts)
+    out["close"] = bars["close"][ends]
+    out["tick_volume"] = np.add.reduceat(bars["tick_volume"], starts)
+    out["spread"] = np.minimum.reduceat(bars["spread"], starts)
+    out["real_volume"] = np.add.reduceat(bars["real_volume"], starts)
+    return out
+
+def _epoch(value) -> float:
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+# ===========================
+#      SIMULADOR
+# ===========================
+class Simulator:
+    """
+    Terminal MT5 simulado sobre velas/ticks grabados (formato BarStore + .ticks) o sintéticos.
+    - Solo es visible lo que existe a la hora del reloj (la última vela es la "en formación").
+    - Timeframes no grabados se agregan desde el más fino disponible.
+    - Órdenes a mercado, stops pendientes y SL/TP se ejecutan contra el rango de precios
+      recorrido desde la última llamada; el P/L se expresa en la divisa de la cuenta (aprox. FX).
+    - latency_ms (+ jitter_ms aleatorio) se inyecta en cada llamada; per_call permite fijarla por función.
+    """
+
+    def __init__(self, root: Optional[str] = None, start: Optional[float] = None, speed: float = 1.0,
+                 rebase: bool = True, synthetic: bool = True, latency_ms: float = 0.0,
+                 jitter_ms: float = 0.0, per_call: Optional[dict] = None, serialize: bool = True,
+                 balance: float = 10000.0, currency: str = "USD", seed: int = 0):
+        self.root = root
+        self.synthetic = synthetic
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.per_call = dict(per_call or {})
+        self.serialize = serialize
+        self.currency = currency
+        self._rng = random.Random(seed)
+        self._lock = threading.RLock()
+
+        self._bars = {}      # símbolo -> {timeframe: array}
+        self._ticks = {}     # símbolo -> array TICK_DTYPE
+        self._specs = {}
+        self._load()
+
+        now = time.time() // 60 * 60
+        if start is None:
+            ends = [int(a["time"][-1]) for tfs in self._bars.values() for a in tfs.values()]
+            start = max(ends) - 86400 if ends else now
+        self._shift = int(now - start) // 60 * 60 if rebase else 0
+        if self._shift:
+            for tfs in self._bars.values():
+                for bars in tfs.values():
+                    bars["time"] += self._shift
+            for ticks in self._ticks.values():
+                ticks["time"] += self._shift
+                ticks["time_msc"] += self._shift * 1000
+        self.clock = SimClock(start + self._shift, speed=speed)
+        self._synth_start = int(self.clock.start) // 60 * 60 - SYNTH_DAYS * 86400
+        self._synth_end = int(self.clock.start) // 60 * 60 + SYNTH_AHEAD_DAYS * 86400
+
+        self.connected = False
+        self.login_id = 0
+        self.server = ""
+        self.balance = float(balance)
+        self._tickets = itertools.count(1000001)
+        self._positions = {}
+        self._orders = {}
+        self._deals = []
+        self._last_sync = self.clock.now()
+        self._last_error = (1, "Success")
+        self.calls = {}
+        self.injected_ms = 0.0
+        self.trace_alloc = False    # benchmark(trace_alloc=True): excluir del pico lo que asigna el simulador
+        self.script_peak = 0
+
+    # ---------- carga ----------
+    def _load(self):
+        if not self.root or not os.path.isdir(self.root):
+            return
+        store = BarStore(self.root)
+        for fname in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, fname)
+            if fname.endswith(".bars"):
+                symbol, _, tf = fname[:-5].rpartition("_")
+                bars = store.read(symbol, int(tf))
+                if bars is not None:
+                    self._bars.setdefault(symbol, {})[int(tf)] = np.array(bars)
+            elif fname.endswith(".ticks"):
+                self._ticks[fname[:-6]] = np.fromfile(path, dtype=TICK_DTYPE)
+        specs_path = os.path.join(self.root, SYMBOLS_FILE)
+        if os.path.exists(specs_path):
+            with open(specs_path, "r", encoding="utf-8") as f:
+                self._specs = json.load(f)
+
+    def _known(self, symbol: str) -> bool:
+        if symbol in self._bars:
+            return True
+        if not self.synthetic:
+            return False
+        spec = self.spec(symbol)
+        self._bars[symbol] = {TIMEFRAME_M1: _synthetic_bars(symbol, self._synth_start, self._synth_end, spec)}
+        return True
+
+    def spec(self, symbol: str) -> dict:
+        spec = _default_spec(symbol)
+        spec.update(self._specs.get(symbol, {}))
+        return spec
+
+    def _rates(self, symbol: str, timeframe: int) -> Optional[np.ndarray]:
+        if not self._known(symbol):
+            return None
+        tfs = self._bars[symbol]
+        if timeframe not in tfs:
+            period = timeframe_seconds(timeframe)
+            finer = [tf for tf in tfs if period % timeframe_seconds(tf) == 0]
+            if not finer:
+                return None
+            tfs[timeframe] = _resample(tfs[min(finer, key=timeframe_seconds)], period)
+        return tfs[timeframe]
+
+    def _visible(self, symbol: str, timeframe: int) -> Optional[np.ndarray]:
+        bars = self._rates(symbol, timeframe)
+        if bars is None:
+            return None
+        return bars[:int(np.searchsorted(bars["time"], self.clock.now(), side="right"))]
+
+    # ---------- precios ----------
+    def _finest(self, symbol: str):
+        tfs = self._bars[symbol]
+        tf = min(tfs, key=timeframe_seconds)
+        return tfs[tf], timeframe_seconds(tf)
+
+    def _tick_at(self, symbol: str, t: float):
+        if not self._known(symbol):
+            return None
+        point = self.spec(symbol)["point"]
+        ticks = self._ticks.get(symbol)
+        if ticks is not None and len(ticks):
+            k = int(np.searchsorted(ticks["time_msc"], int(t * 1000), side="right")) - 1
+            if k < 0:
+                return None
+            return ticks[k]
+        bars, period = self._finest(symbol)
+        k = int(np.searchsorted(bars["time"], t, side="right")) - 1
+        if k < 0:
+            return None
+        bar = bars[k]
+        # Ticks OHLC sintéticos: apertura, extremo, extremo opuesto y cierre a lo largo de la vela
+        up = bar["close"] >= bar["open"]
+        path = (bar["open"], bar["low"] if up else bar["high"], bar["high"] if up else bar["low"], bar["close"])
+        phase = min(3, int(4 * (t - bar["time"]) / period))
+        bid = float(path[phase])
+        tick = np.zeros((), dtype=TICK_DTYPE)
+        tick["time"] = int(t)
+        tick["time_msc"] = int(t * 1000)
+        tick["bid"] = bid
+        tick["ask"] = round(bid + int(bar["spread"]) * point, 10)
+        tick["last"] = bid
+        tick["volume"] = 1
+        return tick
+
+    def _range(self, symbol: str, t0: float, t1: float):
+        """(bid mínimo, ask máximo) recorridos en (t0, t1]; None si no hubo precios."""
+        ticks = self._ticks.get(symbol)
+        if ticks is not None and len(ticks):
+            a, b = np.searchsorted(ticks["time_msc"], [int(t0 * 1000), int(t1 * 1000)], side="right")
+            if a == b:
+                return None
+            return float(ticks["bid"][a:b].min()), float(ticks["ask"][a:b].max())
+        bars, period = self._finest(symbol)
+        a, b = np.searchsorted(bars["time"], [t0 - period + 1, t1], side="right")
+        if a >= b:
+            return None
+        spread = float(bars["spread"][a:b].max()) * self.spec(symbol)["point"]
+        return float(bars["low"][a:b].min()), float(bars["high"][a:b].max()) + spread
+
+    def _to_account(self, symbol: str, amount: float, price: float) -> float:
+        spec = self.spec(symbol)
+        if spec["currency_profit"] != self.currency and symbol.upper().startswith(self.currency) and price:
+            return amount / price
+        return amount
+
+    def _profit(self, pos: dict, price: float) -> float:
+        sign = 1.0 if pos["type"] == POSITION_TYPE_BUY else -1.0
+        raw = sign * (price - pos["price_open"]) * pos["volume"] * self.spec(pos["symbol"])["trade_contract_size"]
+        return self._to_account(pos["symbol"], raw, price)
+
+    # ---------- motor de órdenes ----------
+    def _sync(self):
+        """Ejecuta stops pendientes y SL/TP contra el rango de precios desde la última llamada."""
+        now = self.clock.now()
+        t0, self._last_sync = self._last_sync, now
+        if now <= t0:
+            return
+        for symbol in {o["symbol"] for o in self._orders.values()} | {p["symbol"] for p in self._positions.values()}:
+            rng = self._range(symbol, t0, now)
+            if rng is None:
+                continue
+            low, high = rng
+            for ticket, order in list(self._orders.items()):
+                if order["symbol"] != symbol:
+                    continue
+                hit = (order["type"] == ORDER_TYPE_BUY_STOP and high >= order["price_open"]) or \
+                      (order["type"] == ORDER_TYPE_SELL_STOP and low <= order["price_open"]) or \
+                      (order["type"] == ORDER_TYPE_BUY_LIMIT and high <= order["price_open"]) or \
+                      (order["type"] == ORDER_TYPE_SELL_LIMIT and low >= order["price_open"])
+                if hit:
+                    del self._orders[ticket]
+                    side = POSITION_TYPE_BUY if order["type"] in (ORDER_TYPE_BUY_STOP, ORDER_TYPE_BUY_LIMIT) \
+                        else POSITION_TYPE_SELL
+                    self._open(symbol, side, order["volume_current"], order["price_open"], order["sl"],
+                               order["tp"], order["magic"], order["comment"], order_ticket=ticket)
+            for ticket, pos in list(self._positions.items()):
+                if pos["symbol"] != symbol:
+                    continue
+                buy = pos["type"] == POSITION_TYPE_BUY
+                # Si SL y TP caen en el mismo intervalo se asume el SL (conservador)
+                if pos["sl"] and ((buy and low <= pos["sl"]) or (not buy and high >= pos["sl"])):
+                    self._close(ticket, pos["volume"], pos["sl"], "[sl]")
+                elif pos["tp"] and ((buy and low >= pos["tp"]) or (not buy and high <= pos["tp"])):
+                    self._close(ticket, pos["volume"], pos["tp"], "[tp]")
+
+    def _deal(self, symbol, deal_type, entry, volume, price, position_id, order, magic, comment, profit=0.0):
+        t = self.clock.now()
+        deal = {
+            "ticket": next(self._tickets), "order": order, "time": int(t), "time_msc": int(t * 1000),
+            "type": deal_type, "entry": entry, "magic": magic, "position_id": position_id,
+            "reason": 0, "volume": volume, "price": price, "commission": 0.0, "swap": 0.0,
+            "profit": profit, "fee": 0.0, "symbol": symbol, "comment": comment, "external_id": "",
+        }
+        self._deals.append(deal)
+        return deal
+
+    def _open(self, symbol, side, volume, price, sl, tp, magic, comment, order_ticket=None):
+        order_ticket = order_ticket or next(self._tickets)
+        t = self.clock.now()
+        pos = {
+            "ticket": order_ticket, "time": int(t), "time_msc": int(t * 1000), "type": side,
+            "magic": magic, "identifier": order_ticket, "volume": volume, "price_open": price,
+            "sl": sl, "tp": tp, "swap": 0.0, "symbol": symbol, "comment": comment,
+        }
+        self._positions[order_ticket] = pos
+        deal_type = DEAL_TYPE_BUY if side == POSITION_TYPE_BUY else DEAL_TYPE_SELL
+        return self._deal(symbol, deal_type, DEAL_ENTRY_IN, volume, price, order_ticket, order_ticket, magic, comment)
+
+    def _close(self, ticket, volume, price, comment):
+        pos = self._positions[ticket]
+        volume = min(volume, pos["volume"])
+        part = dict(pos, volume=volume)
+        profit = self._profit(part, price)
+        self.balance += profit
+        pos["volume"] = round(pos["volume"] - volume, 8)
+        if pos["volume"] <= 0:
+            del self._positions[ticket]
+        deal_type = DEAL_TYPE_SELL if pos["type"] == POSITION_TYPE_BUY else DEAL_TYPE_BUY
+        return self._deal(pos["symbol"], deal_type, DEAL_ENTRY_OUT, volume, price, ticket,
+                          next(self._tickets), pos["magic"], comment, profit)
+
+    def _result(self, retcode, request, deal=0, order=0, volume=0.0, price=0.0, comment=""):
+        tick = self._tick_at(request.get("symbol", ""), self.clock.now()) if request.get("symbol") else None
+        return SimpleNamespace(
+            retcode=retcode, deal=deal, order=order, volume=volume, price=price,
+            bid=float(tick["bid"]) if tick is not None else 0.0, ask=float(tick["ask"]) if tick is not None else 0.0,
+            comment=comment or ("Request executed" if retcode == TRADE_RETCODE_DONE else "Invalid request"),
+            request_id=0, retcode_external=0, request=SimpleNamespace(**request),
+        )
+
+    def _valid_volume(self, symbol: str, volume: float) -> bool:
+        spec = self.spec(symbol)
+        steps = volume / spec["volume_step"]
+        return spec["volume_min"] <= volume <= spec["volume_max"] and abs(steps - round(steps)) < 1e-6
+
+    def order_send(self, request: dict):
+        action = request.get("action")
+        symbol = request.get("symbol", "")
+        if action == TRADE_ACTION_REMOVE:
+            order = self._orders.pop(request.get("order"), None)
+            if order is None:
+                return self._result(TRADE_RETCODE_INVALID, request)
+            return self._result(TRADE_RETCODE_DONE, request, order=order["ticket"])
+        if action == TRADE_ACTION_SLTP:
+            pos = self._positions.get(request.get("position"))
+            if pos is None:
+                return self._result(TRADE_RETCODE_INVALID, request)
+            pos["sl"], pos["tp"] = float(request.get("sl", 0.0)), float(request.get("tp", 0.0))
+            return self._result(TRADE_RETCODE_DONE, request, order=pos["ticket"])
+
+        if not self._known(symbol):
+            return self._result(TRADE_RETCODE_INVALID, request)
+        tick = self._tick_at(symbol, self.clock.now())
+        if tick is None:
+            return self._result(TRADE_RETCODE_PRICE_OFF, request)
+        volume = float(request.get("volume", 0.0))
+        order_type = request.get("type")
+        sl, tp = float(request.get("sl", 0.0) or 0.0), float(request.get("tp", 0.0) or 0.0)
+        magic, comment = int(request.get("magic", 0)), request.get("comment", "")
+
+        if action == TRADE_ACTION_DEAL:
+            price = float(tick["ask"] if order_type == ORDER_TYPE_BUY else tick["bid"])
+            ticket = request.get("position")
+            if ticket:
+                if ticket not in self._positions:
+                    return self._result(TRADE_RETCODE_INVALID, request)
+                deal = self._close(ticket, volume, price, comment)
+                return self._result(TRADE_RETCODE_DONE, request, deal["ticket"], deal["order"], volume, price)
+            if not self._valid_volume(symbol, volume):
+                return self._result(TRADE_RETCODE_INVALID_VOLUME, request)
+            buy = order_type == ORDER_TYPE_BUY
+            if (sl and (sl >= price if buy else sl <= price)) or (tp and (tp <= price if buy else tp >= price)):
+                return self._result(TRADE_RETCODE_INVALID_STOPS, request)
+            side = POSITION_TYPE_BUY if buy else POSITION_TYPE_SELL
+            deal = self._open(symbol, side, volume, price, sl, tp, magic, comment)
+            return self._result(TRADE_RETCODE_DONE, request, deal["ticket"], deal["order"], volume, price)
+
+        if action == TRADE_ACTION_PENDING:
+            if not self._valid_volume(symbol, volume):
+                return self._result(TRADE_RETCODE_INVALID_VOLUME, request)
+            price = float(request.get("price", 0.0))
+            ok = {ORDER_TYPE_BUY_STOP: price > tick["ask"], ORDER_TYPE_SELL_STOP: price < tick["bid"],
+                  ORDER_TYPE_BUY_LIMIT: price < tick["ask"], ORDER_TYPE_SELL_LIMIT: price > tick["bid"]}
+            if not ok.get(order_type, False):
+                return self._result(TRADE_RETCODE_INVALID_PRICE, request)
+            t = self.clock.now()
+            ticket = next(self._tickets)
+            self._orders[ticket] = {
+                "ticket": ticket, "time_setup": int(t), "time_setup_msc": int(t * 1000), "type": order_type,
+                "magic": magic, "volume_initial": volume, "volume_current": volume, "price_open": price,
+                "sl": sl, "tp": tp, "symbol": symbol, "comment": comment,
+                "type_time": request.get("type_time", ORDER_TIME_GTC),
+                "type_filling": request.get("type_filling", ORDER_FILLING_RETURN),
+            }
+            return self._result(TRADE_RETCODE_DONE, request, order=ticket, volume=volume, price=price)
+
+        return self._result(TRADE_RETCODE_INVALID, request)
+
+    # ---------- consultas ----------
+    def position_view(self, pos: dict):
+        tick = self._tick_at(pos["symbol"], self.clock.now())
+        buy = pos["type"] == POSITION_TYPE_BUY
+        price = float(tick["bid"] if buy else tick["ask"]) if tick is not None else pos["price_open"]
+        return SimpleNamespace(**pos, price_current=price, profit=self._profit(pos, price))
+
+    def account(self):
+        equity = self.balance + sum(self.position_view(p).profit for p in self._positions.values())
+        return SimpleNamespace(login=self.login_id, server=self.server, currency=self.currency,
+                               balance=self.balance, equity=equity, profit=equity - self.balance,
+                               margin=0.0, margin_free=equity, leverage=100, trade_allowed=True,
+                               name="mt5sim")
+
+    def symbol_info(self, symbol: str):
+        if not self._known(symbol):
+            return None
+        tick = self._tick_at(symbol, self.clock.now())
+        spec = self.spec(symbol)
+        bid = float(tick["bid"]) if tick is not None else 0.0
+        ask = float(tick["ask"]) if tick is not None else 0.0
+        return SimpleNamespace(name=symbol, visible=True, select=True, trade_allowed=True,
+                               trade_mode=4, filling_mode=3, bid=bid, ask=ask,
+                               spread=int(round((ask - bid) / spec["point"])), **spec)
+
+    def deals(self, date_from=None, date_to=None, group=None, ticket=None, position=None):
+        out = self._deals
+        if ticket is not None:
+            out = [d for d in out if d["order"] == ticket]
+        elif position is not None:
+            out = [d for d in out if d["position_id"] == position]
+        else:
+            lo = _epoch(date_from) if date_from is not None else 0
+            hi = _epoch(date_to) if date_to is not None else float("inf")
+            out = [d for d in out if lo <= d["time"] <= hi]
+        if group:
+            out = [d for d in out if _group_match(d["symbol"], group)]
+        return tuple(SimpleNamespace(**d) for d in out)
+
+    # ---------- latencia ----------
+    def call(self, name: str, fn, *args, **kwargs):
+        if self.trace_alloc:
+            self.script_peak = max(self.script_peak, tracemalloc.get_traced_memory()[1])
+            try:
+                return self._call(name, fn, *args, **kwargs)
+            finally:
+                tracemalloc.reset_peak()
+        return self._call(name, fn, *args, **kwargs)
+
+    def _call(self, name: str, fn, *args, **kwargs):
+        delay_ms = self.per_call.get(name, self.latency_ms)
+        if self.jitter_ms:
+            delay_ms += self._rng.uniform(0.0, self.jitter_ms)
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.injected_ms += delay_ms
+        if delay_ms > 0 and not self.serialize:
+            time.sleep(delay_ms / 1000.0)
+        with self._lock:
+            if delay_ms > 0 and self.serialize:
+                # Un único canal con el terminal, como la IPC real del paquete MT5
+                time.sleep(delay_ms / 1000.0)
+            self._sync()
+            return fn(*args, **kwargs)
+
+    def stats(self) -> dict:
+        return {"calls": dict(sorted(self.calls.items(), key=lambda kv: -kv[1])),
+                "total_calls": sum(self.calls.values()), "injected_ms": round(self.injected_ms, 1),
+                "positions": len(self._positions), "orders": len(self._orders), "deals": len(self._deals),
+                "balance": round(self.balance, 2)}
+
+def _group_match(symbol: str, group: str) -> bool:
+    """Filtro group= de MT5: patrones separados por comas, '!' excluye."""
+    return any(fnmatch.fnmatch(symbol, g) for g in group.split(",") if not g.startswith("!")) and \
+        not any(fnmatch.fnmatch(symbol, g[1:]) for g in group.split(",") if g.startswith("!"))
+
+# ===========================
+#      API COMPATIBLE CON MetaTrader5
+# ===========================
+_SIM: Optional[Simulator] = None
+
+def _sim() -> Simulator:
+    global _SIM
+    if _SIM is None:
+        _SIM = Simulator()
+    return _SIM
+
+def install(root: Optional[str] = None, **kwargs) -> Simulator:
+    """Crea el simulador y lo registra como sys.modules["MetaTrader5"] (antes de importar los scripts)."""
+    global _SIM
+    _SIM = Simulator(root, **kwargs)
+    sys.modules["MetaTrader5"] = sys.modules[__name__]
+    return _SIM
+
+def simulator() -> Simulator:
+    return _sim()
+
+def initialize(path: Optional[str] = None, **kwargs) -> bool:
+    sim = _sim()
+    def _init():
+        sim.connected = True
+        if "login" in kwargs:
+            sim.login_id, sim.server = int(kwargs["login"]), kwargs.get("server", "")
+        return True
+    return sim.call("initialize", _init)
+
+def login(login: int, password: str = "", server: str = "", timeout: int = 60000) -> bool:
+    sim = _sim()
+    def _login():
+        if not sim.connected:
+            sim._last_error = (-10004, "No IPC connection")
+            return False
+        sim.login_id, sim.server = int(login), server
+        return True
+    return sim.call("login", _login)
+
+def shutdown():
+    sim = _sim()
+    def _shutdown():
+        sim.connected = False
+    return sim.call("shutdown", _shutdown)
+
+def last_error():
+    return _sim()._last_error
+
+def version():
+    return (500, 4000, "mt5sim")
+
+def terminal_info():
+    sim = _sim()
+    return sim.call("terminal_info", lambda: SimpleNamespace(
+        connected=sim.connected, trade_allowed=True, name="mt5sim", company="mt5sim", path="",
+    ) if sim.connected else None)
+
+def account_info():
+    sim = _sim()
+    return sim.call("account_info", lambda: sim.account() if sim.connected and sim.login_id else None)
+
+def symbol_select(symbol: str, enable: bool = True) -> bool:
+    sim = _sim()
+    def _select():
+        if sim._known(symbol):
+            return True
+        sim._last_error = (-1, f"Unknown symbol {symbol}")
+        return False
+    return sim.call("symbol_select", _select)
+
+def symbol_info(symbol: str):
+    sim = _sim()
+    return sim.call("symbol_info", sim.symbol_info, symbol)
+
+def symbol_info_tick(symbol: str):
+    sim = _sim()
+    def _tick():
+        tick = sim._tick_at(symbol, sim.clock.now())
+        if tick is None:
+            return None
+        return SimpleNamespace(**{name: tick[name].item() for name in TICK_DTYPE.names})
+    return sim.call("symbol_info_tick", _tick)
+
+def copy_rates_from_pos(symbol: str, timeframe: int, start_pos: int, count: int):
+    sim = _sim()
+    def _copy():
+        bars = sim._visible(symbol, timeframe)
+        if bars is None:
+            return None
+        end = len(bars) - start_pos
+        return bars[max(0, end - count):max(0, end)].copy()
+    return sim.call("copy_rates_from_pos", _copy)
+
+def copy_rates_from(symbol: str, timeframe: int, date_from, count: int):
+    sim = _sim()
+    def _copy():
+        bars = sim._visible(symbol, timeframe)
+        if bars is None:
+            return None
+        end = int(np.searchsorted(bars["time"], _epoch(date_from), side="right"))
+        return bars[max(0, end - count):end].copy()
+    return sim.call("copy_rates_from", _copy)
+
+def copy_rates_range(symbol: str, timeframe: int, date_from, date_to):
+    sim = _sim()
+    def _copy():
+        bars = sim._visible(symbol, timeframe)
+        if bars is None:
+            return None
+        a = int(np.searchsorted(bars["time"], _epoch(date_from), side="left"))
+        b = int(np.searchsorted(bars["time"], _epoch(date_to), side="right"))
+        return bars[a:b].copy()
+    return sim.call("copy_rates_range", _copy)
+
+def copy_ticks_from(symbol: str, date_from, count: int, flags: int = COPY_TICKS_ALL):
+    sim = _sim()
+    def _copy():
+        ticks = sim._ticks.get(symbol)
+        if ticks is None:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        a = int(np.searchsorted(ticks["time_msc"], int(_epoch(date_from) * 1000), side="left"))
+        b = int(np.searchsorted(ticks["time_msc"], int(sim.clock.now() * 1000), side="right"))
+        return ticks[a:min(b, a + count)].copy()
+    return sim.call("copy_ticks_from", _copy)
+
+def positions_get(symbol: Optional[str] = None, group: Optional[str] = None, ticket: Optional[int] = None):
+    sim = _sim()
+    def _get():
+        out = []
+        for pos in sim._positions.values():
+            if (symbol is None or pos["symbol"] == symbol) and (ticket is None or pos["ticket"] == ticket) \
+                    and (group is None or _group_match(pos["symbol"], group)):
+                out.append(sim.position_view(pos))
+        return tuple(out)
+    return sim.call("positions_get", _get)
+
+def positions_total() -> int:
+    sim = _sim()
+    return sim.call("positions_total", lambda: len(sim._positions))
+
+def orders_get(symbol: Optional[str] = None, group: Optional[str] = None, ticket: Optional[int] = None):
+    sim = _sim()
+    def _get():
+        return tuple(SimpleNamespace(**o) for o in sim._orders.values()
+                     if (symbol is None or o["symbol"] == symbol) and (ticket is None or o["ticket"] == ticket)
+                     and (group is None or _group_match(o["symbol"], group)))
+    return sim.call("orders_get", _get)
+
+def orders_total() -> int:
+    sim = _sim()
+    return sim.call("orders_total", lambda: len(sim._orders))
+
+def order_send(request: dict):
+    sim = _sim()
+    return sim.call("order_send", sim.order_send, dict(request))
+
+def history_deals_get(date_from=None, date_to=None, group: Optional[str] = None,
+                      ticket: Optional[int] = None, position: Optional[int] = None):
+    sim = _sim()
+    return sim.call("history_deals_get", sim.deals, date_from, date_to, group, ticket, position)
+
+def history_deals_total(date_from, date_to) -> int:
+    return len(history_deals_get(date_from, date_to))
+
+# ===========================
+#      GRABACIÓN (en Windows, con el terminal real)
+# ===========================
+def record(api, root: str, symbols, timeframes, bars: int = 20000, tick_hours: float = 24.0, log=print):
+    """Vuelca velas, ticks y especificaciones del terminal real al formato que lee el simulador."""
+    store = BarStore(root)
+    os.makedirs(root, exist_ok=True)
+    specs = {}
+    for symbol in symbols:
+        if not api.symbol_select(symbol, True):
+            log(f"⚠️ {symbol}: no disponible en el terminal.")
+            continue
+        for tf in timeframes:
+            rates = api.copy_rates_from_pos(symbol, tf, 0, bars)
+            if rates is not None and len(rates) > 1:
+                # La última vela está en formación: solo se graban las cerradas
+                written = store.append(symbol, tf, rates[:-1])
+                log(f"💾 {symbol} tf={tf}: {written} velas.")
+        if tick_hours:
+            since = datetime.fromtimestamp(time.time() - tick_hours * 3600)
+            ticks = api.copy_ticks_from(symbol, since, 10_000_000, api.COPY_TICKS_ALL)
+            if ticks is not None and len(ticks):
+                np.asarray(ticks).astype(TICK_DTYPE).tofile(os.path.join(root, f"{symbol}.ticks"))
+                log(f"💾 {symbol}: {len(ticks)} ticks.")
+        info = api.symbol_info(symbol)
+        if info is not None:
+            specs[symbol] = {k: getattr(info, k) for k in SYMBOL_FIELDS if hasattr(info, k)}
+    with open(os.path.join(root, SYMBOLS_FILE), "w", encoding="utf-8") as f:
+        json.dump(specs, f, indent=2)
+
+# ===========================
+#      BENCHMARK DE EXTREMO A EXTREMO
+# ===========================
+def benchmark(names, root: Optional[str] = None, cycles: int = 10, step_min: float = 5.0,
+              latency_ms: float = 0.0, jitter_ms: float = 0.0, serialize: bool = True,
+              quiet: bool = True, trace_alloc: bool = False, overrides: Optional[dict] = None,
+              log=print) -> dict:
+    """
+    Ejecuta run_once(keep_session=True) de cada script `cycles` veces sobre el simulador,
+    avanzando el reloj step_min entre ciclos. Los scripts sin sesión persistente (run_once sin
+    keep_session, sin SESSION) se ejecutan tal cual: conectan y cierran en cada ciclo. Telegram queda desactivado (se cuentan los mensajes).
+    Los ficheros que escriben los scripts (bars/, estado) van a un directorio temporal.
+    - trace_alloc: mide con tracemalloc el pico de memoria asignada por ciclo por el script (lo que
+      asigna el simulador dentro de cada llamada no cuenta). Ralentiza: compara tiempos sin esta opción.
+    - overrides: {"modulo.CONSTANTE": valor} aplicados tras importar cada script; también
+      atributos de objetos del módulo ("mt5.STAGES.enabled": False).
+    Al final, para los scripts con STAGES, p50/p95/p99 por etapa.
+    """
+    root = os.path.abspath(root) if root else None
+    sim = install(root, speed=0.0, latency_ms=latency_ms, jitter_ms=jitter_ms, serialize=serialize)
+    from supervisor import STRATEGIES
+
+    results, modules, allocs = {}, {}, {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="mt5sim_") as tmp:
+        os.chdir(tmp)
+        try:
+            for name in names:
+                modules[name] = importlib.import_module(name)
+            for key, value in (overrides or {}).items():
+                name, *path, attr = key.split(".")
+                target = modules[name]
+                for part in path:
+                    target = getattr(target, part)
+                setattr(target, attr, value)
+            sent = {name: 0 for name in names}
+            for name, module in modules.items():
+                def _collect(message, _name=name):
+                    sent[_name] += 1
+                module.send_telegram = _collect
+                results[name] = []
+                allocs[name] = []
+
+            if trace_alloc:
+                tracemalloc.start()
+                sim.trace_alloc = True
+            for cycle in range(cycles):
+                for name, module in modules.items():
+                    kwargs = dict(STRATEGIES.get(name, (5, {}))[1])
+                    if "keep_session" in inspect.signature(module.run_once).parameters:
+                        kwargs["keep_session"] = True
+                    out = io.StringIO()
+                    if trace_alloc:
+                        tracemalloc.reset_peak()
+                        sim.script_peak = 0
+                        base = tracemalloc.get_traced_memory()[0]
+                    t0 = time.perf_counter()
+                    try:
+                        with contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext():
+                            module.run_once(**kwargs)
+                    except Exception as e:
+                        log(f"❌ [{name}] ciclo {cycle}: {e}")
+                    results[name].append((time.perf_counter() - t0) * 1000.0)
+                    if trace_alloc:
+                        peak = max(sim.script_peak, tracemalloc.get_traced_memory()[1])
+                        allocs[name].append((peak - base) / 1024.0)
+                sim.clock.advance(step_min * 60)
+        finally:
+            if trace_alloc:
+                sim.trace_alloc = False
+                tracemalloc.stop()
+            for module in modules.values():
+                if hasattr(module, "SESSION"):
+                    module.SESSION.close()
+            os.chdir(cwd)
+
+    report = {}
+    for name, times in results.items():
+        t = np.asarray(times)
+        report[name] = {"first_ms": float(t[0]), "p50_ms": float(np.percentile(t, 50)),
+                        "p95_ms": float(np.percentile(t, 95)), "max_ms": float(t.max()),
+                        "telegram": sent[name]}
+        log(f"⏱️ {name:<14} 1º={t[0]:8.1f} ms  p50={report[name]['p50_ms']:8.1f} ms  "
+            f"p95={report[name]['p95_ms']:8.1f} ms  máx={t.max():8.1f} ms  mensajes={sent[name]}")
+        if allocs[name]:
+            kb = np.asarray(allocs[name])
+            report[name].update({"alloc_first_kb": float(kb[0]), "alloc_p50_kb": float(np.percentile(kb, 50))})
+            log(f"🧠 {name:<14} pico asignado por ciclo: 1º={kb[0]:8.1f} KB  p50={np.percentile(kb, 50):8.1f} KB  "
+                f"máx={kb.max():8.1f} KB")
+        stages = getattr(modules[name], "STAGES", None)
+        if stages is not None and stages.enabled:
+            report[name]["stages"] = stages.stats()
+            log(f"🧩 {name:<14} {stages.report()}")
+    log(f"ℹ️ Simulador: {sim.stats()}")
+    return report
+
+def parse_overrides(items) -> dict:
+    """["bot3.LEAN_FEATURES=False", ...] -> {"bot3.LEAN_FEATURES": False}; el valor se evalúa como JSON si puede."""
+    out = {}
+    for item in items:
+        key, _, raw = item.partition("=")
+        lowered = {"true": "true", "false": "false", "none": "null"}.get(raw.strip().lower(), raw)
+        try:
+            out[key.strip()] = json.loads(lowered)
+        except ValueError:
+            out[key.strip()] = raw
+    return out
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulador local de MetaTrader5 (reproducción de datos grabados).")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    bench = sub.add_parser("bench", help="Benchmark de run_once de los scripts sobre el simulador.")
+    bench.add_argument("scripts", nargs="+", help="Módulos a ejecutar (p. ej. mt5 martingala bot3).")
+    bench.add_argument("--root", default=None, help="Directorio con datos grabados (si no, sintéticos).")
+    bench.add_argument("--cycles", type=int, default=10, help="Ciclos por script (por defecto: 10).")
+    bench.add_argument("--step-min", type=float, default=5.0, help="Avance del reloj entre ciclos (min).")
+    bench.add_argument("--latency-ms", type=float, default=0.0, help="Latencia inyectada por llamada.")
+    bench.add_argument("--jitter-ms", type=float, default=0.0, help="Jitter aleatorio añadido a la latencia.")
+    bench.add_argument("--parallel-ipc", action="store_true",
+                       help="No serializar las llamadas (por defecto un único canal, como el terminal real).")
+    bench.add_argument("--verbose", action="store_true", help="Mostrar la salida de los scripts.")
+    bench.add_argument("--trace-alloc", action="store_true",
+                       help="Mide el pico de memoria asignada por ciclo (tracemalloc; los tiempos salen inflados).")
+    bench.add_argument("--set", action="append", default=[], metavar="MODULO.NOMBRE=VALOR",
+                       help="Sobrescribe una constante de un script (p. ej. bot3.LEAN_FEATURES=False).")
+
+    rec = sub.add_parser("record", help="Graba velas/ticks del terminal real (requiere MetaTrader5).")
+    rec.add_argument("symbols", nargs="+")
+    rec.add_argument("--root", default="simdata")
+    rec.add_argument("--timeframes", nargs="+", default=["M1"], help="Timeframes a grabar (M1 M5 M15 H1...).")
+    rec.add_argument("--bars", type=int, default=20000)
+    rec.add_argument("--tick-hours", type=float, default=24.0)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.cmd == "bench":
+        benchmark(args.scripts, root=args.root, cycles=args.cycles, step_min=args.step_min,
+                  latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, serialize=not args.parallel_ipc,
+                  quiet=not args.verbose, trace_alloc=args.trace_alloc, overrides=parse_overrides(args.set))
+    else:
+        import MetaTrader5 as real_mt5
+        if not real_mt5.initialize():
+            raise SystemExit(f"MT5 init error: {real_mt5.last_error()}")
+        try:
+            tfs = [getattr(real_mt5, f"TIMEFRAME_{tf}") for tf in args.timeframes]
+            record(real_mt5, args.root, args.symbols, tfs, bars=args.bars, tick_hours=args.tick_hours)
+        finally:
+            real_mt5.shutdown()
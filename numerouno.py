@@ -6,6 +6,8 @@ import time
 import argparse
 from zoneinfo import ZoneInfo
 from typing import Optional
+from indicators import rolling_max, rolling_min
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES (TU SCRIPT)
@@ -29,6 +31,7 @@ BARS_AHEAD = max(1, HORIZON_MIN // 5)  # 6
 # Zona horaria y verbosidad
 TZ = ZoneInfo("Europe/Madrid")
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa y p50/p95/p99 en el log de cada ciclo; False = sin coste
 
 # Gestión de riesgo (para SL/TP si hay compra)
 ATR_LEN = 14
@@ -42,6 +45,9 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+STAGES = StageTimer("numerouno", enabled=STAGE_TIMING, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
     """Envía mensaje a Telegram con las credenciales provistas."""
     try:
@@ -56,6 +62,7 @@ def send_telegram(message: str):
     except Exception as e:
         log(f"❌ Telegram error: {e}")
 
+@STAGES.timed("init_mt5")
 def init_mt5():
     log("🔌 Inicializando MetaTrader 5...")
     ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
@@ -76,13 +83,17 @@ def shutdown_mt5():
         pass
     log("🔚 MT5 cerrado.")
 
+@STAGES.timed("copy_rates")
 def copy_rates(symbol, timeframe, n=1000):
     data = mt5.copy_rates_from_pos(symbol, timeframe, 0, n)
     if data is None or len(data) == 0:
         raise RuntimeError("No se pudieron obtener datos de velas")
-    df = pd.DataFrame(data)
-    df["time"] = pd.to_datetime(df["time"], unit="s", utc=True).dt.tz_convert(TZ)
-    return df
+    # "time" queda en epoch (s, UTC): se convierte a TZ solo al formatear
+    return pd.DataFrame(data)
+
+def local_time(epoch) -> pd.Timestamp:
+    """Epoch (s, UTC) de MT5 -> hora local TZ (mensajes y logs)."""
+    return pd.Timestamp(int(epoch), unit="s", tz="UTC").tz_convert(TZ)
 
 # ===========================
 #      INDICADORES
@@ -111,6 +122,7 @@ def atr(df: pd.DataFrame, length=14):
 # ===========================
 #      MODELO HEURÍSTICO
 # ===========================
+@STAGES.timed("feature_bundle")
 def feature_bundle(df: pd.DataFrame) -> dict:
     """Calcula features en la ÚLTIMA VELA CERRADA (idx = -2)."""
     if len(df) < 100:
@@ -122,8 +134,8 @@ def feature_bundle(df: pd.DataFrame) -> dict:
     df["rsi14"] = rsi(df["close"], 14)
     df["atr14"] = atr(df, ATR_LEN)
     df["ret_6"] = df["close"] / df["close"].shift(6) - 1.0
-    df["hh_12"] = df["high"].rolling(12).max()
-    df["ll_12"] = df["low"].rolling(12).min()
+    df["hh_12"] = rolling_max(df["high"].to_numpy(), 12)
+    df["ll_12"] = rolling_min(df["low"].to_numpy(), 12)
 
     i = df.index[-2]  # última vela CERRADA
 
@@ -156,7 +168,7 @@ def feature_bundle(df: pd.DataFrame) -> dict:
         "price_close": float(close_i),
         "price_high": float(high_i),
         "price_low": float(low_i),
-        "time": df.loc[i, "time"],
+        "time": int(df.loc[i, "time"]),
     }
 
 def sigmoid(x: float) -> float:
@@ -220,7 +232,7 @@ def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
     """
     Mensaje ES + RU (solo para compra). Incluye niveles y condición.
     """
-    ts = str(rec["time"])
+    ts = str(local_time(rec["time"]))
     p = rec["p_up"] * 100.0
 
     es = (
@@ -254,11 +266,13 @@ def format_bilingual_message(symbol: str, rec: dict, feat: dict) -> str:
 #       CICLOS / MAIN
 # ===========================
 def run_once():
+    STAGES.begin_cycle()
     try:
         init_mt5()
         log(f"📊 Analizando {SYMBOL} M5…")
         df = copy_rates(SYMBOL, TIMEFRAME, 600)  # ~50h de datos
-        log(f"📈 Últimas 3 velas: {list(df['time'].tail(3))}")
+        if DEBUG:
+            log(f"📈 Últimas 3 velas: {[str(local_time(t)) for t in df['time'].tail(3)]}")
 
         feat = feature_bundle(df)
         p_up = predict_up_probability(feat)
@@ -272,6 +286,7 @@ def run_once():
             log(f"🔕 Sin envío: decisión = {rec['decision']} (p_up={rec['p_up']:.2f})")
 
     finally:
+        STAGES.end_cycle()
         shutdown_mt5()
 
 def run_loop(every_minutes: int):
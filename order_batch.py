@@ -0,0 +1,234 @@
+import threading
+import time
+from typing import Callable, Optional
+from mt5_session import TERMINAL_LOCK
+
+# Retcodes de order_send (valores de la API MetaTrader5)
+RETCODE_REQUOTE = 10004
+RETCODE_PLACED = 10008
+RETCODE_DONE = 10009
+RETCODE_DONE_PARTIAL = 10010
+RETCODE_TIMEOUT = 10012
+RETCODE_PRICE_CHANGED = 10020
+RETCODE_PRICE_OFF = 10021
+RETCODE_TOO_MANY_REQUESTS = 10024
+RETCODE_CONNECTION = 10031
+
+OK_RETCODES = {RETCODE_PLACED, RETCODE_DONE, RETCODE_DONE_PARTIAL}
+# Transitorios: se reintentan (las órdenes a mercado con precio nuevo)
+RETRY_RETCODES = {RETCODE_REQUOTE, RETCODE_TIMEOUT, RETCODE_PRICE_CHANGED, RETCODE_PRICE_OFF,
+                  RETCODE_TOO_MANY_REQUESTS, RETCODE_CONNECTION}
+
+def is_transient(result: dict) -> bool:
+    """
+    Fallo de envío que puede salir bien al repetir (requote, precio cambiado, timeout, sin respuesta).
+    Las peticiones que no pasaron validate() y los rechazos definitivos del bróker no lo son.
+    """
+    if result["error"] is None or result["attempts"] == 0:
+        return False
+    return result["retcode"] is None or result["retcode"] in RETRY_RETCODES
+
+# ===========================
+#      LOTE DE ÓRDENES
+# ===========================
+class OrderBatch:
+    """
+    Envía un lote de peticiones order_send de una vez:
+    1) validate(): comprueba todas las peticiones antes de enviar nada (volumen, lado
+       del precio respecto al tick, distancia mínima de stops). Las inválidas no se envían.
+    2) submit(): envía en secuencia, recoge los retcodes y reintenta requotes/timeouts
+       (las órdenes a mercado con el precio del tick nuevo).
+    3) reconcile(): contrasta el resultado con orders_get/positions_get.
+    Cada resultado es un dict: request, retcode, ticket, attempts, error, confirmed (y filled en pendientes).
+    Toda llamada al terminal pasa por `terminal_lock` (TERMINAL_LOCK): la API no admite dos
+    order_send a la vez, así que el lote se envía en un solo hilo.
+    """
+
+    def __init__(self, api, specs=None, retries: int = 2, retry_delay_s: float = 0.05,
+                 log: Optional[Callable[[str], None]] = None, terminal_lock=TERMINAL_LOCK):
+        self.api = api
+        self.specs = specs
+        self.retries = max(0, int(retries))
+        self.retry_delay_s = retry_delay_s
+        self.log = log
+        self.terminal_lock = terminal_lock
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.sent = 0
+        self.retried = 0
+        self.rejected = 0
+        self.failed = 0
+        self.last_ms = 0.0
+
+    # ---------- validación ----------
+    def _check(self, request: dict, ticks: dict) -> Optional[str]:
+        api = self.api
+        action = request.get("action")
+        if action == api.TRADE_ACTION_REMOVE:
+            return None if request.get("order") else "sin ticket de orden"
+        symbol = request.get("symbol")
+        spec = self.specs.get(symbol) if self.specs is not None else None
+        if self.specs is not None and spec is None:
+            return "símbolo desconocido"
+        volume = float(request.get("volume", 0.0))
+        if spec is not None:
+            if not spec.trade_allowed:
+                return "trading no permitido"
+            if abs(volume - spec.normalize_volume(volume)) > 1e-9:
+                return f"volumen {volume} fuera de min/max/paso"
+        elif volume <= 0:
+            return f"volumen {volume} inválido"
+        if action == api.TRADE_ACTION_DEAL:
+            return None
+        if action != api.TRADE_ACTION_PENDING:
+            return None
+        if symbol not in ticks:
+            with self.terminal_lock:
+                ticks[symbol] = api.symbol_info_tick(symbol)
+        tick = ticks[symbol]
+        if tick is None:
+            return "sin tick"
+        price = float(request.get("price", 0.0))
+        gap = spec.min_stop_distance() if spec is not None else 0.0
+        order_type = request.get("type")
+        valid = {
+            api.ORDER_TYPE_BUY_STOP: price > tick.ask + gap,
+            api.ORDER_TYPE_SELL_STOP: price < tick.bid - gap,
+            api.ORDER_TYPE_BUY_LIMIT: price < tick.ask - gap,
+            api.ORDER_TYPE_SELL_LIMIT: price > tick.bid + gap,
+        }
+        if not valid.get(order_type, False):
+            return f"precio {price} en el lado equivocado del mercado (bid={tick.bid} ask={tick.ask})"
+        return None
+
+    def validate(self, requests: list, ticks: Optional[dict] = None) -> list:
+        """
+        Lista de errores (None = válida), una entrada por petición.
+        Un solo tick por símbolo; ticks permite pasar los ya leídos en el ciclo.
+        """
+        ticks = dict(ticks or {})
+        return [self._check(request, ticks) for request in requests]
+
+    # ---------- envío ----------
+    def _reprice(self, request: dict) -> dict:
+        api = self.api
+        if request.get("action") != api.TRADE_ACTION_DEAL:
+            return request
+        with self.terminal_lock:
+            tick = api.symbol_info_tick(request["symbol"])
+        if tick is None:
+            return request
+        price = tick.ask if request.get("type") == api.ORDER_TYPE_BUY else tick.bid
+        return dict(request, price=price)
+
+    def _send(self, request: dict) -> dict:
+        out = {"request": request, "retcode": None, "ticket": 0, "attempts": 0, "error": None, "confirmed": False}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay_s)
+                request = self._reprice(request)
+                with self._lock:
+                    self.retried += 1
+            out["attempts"] += 1
+            with self.terminal_lock:
+                res = self.api.order_send(request)
+                error = self.api.last_error() if res is None else None
+            if res is None:
+                out["retcode"], out["error"] = None, f"order_send None {error}"
+                continue
+            out["retcode"] = res.retcode
+            if res.retcode in OK_RETCODES:
+                out["ticket"] = res.order or res.deal
+                out["error"] = None
+                return out
+            out["error"] = f"retcode={res.retcode} {getattr(res, 'comment', '')}".strip()
+            if res.retcode not in RETRY_RETCODES:
+                break
+        if self.specs is not None and request.get("symbol"):
+            self.specs.check(request["symbol"], out["retcode"])
+        return out
+
+    def submit(self, requests: list, validate: bool = True, ticks: Optional[dict] = None) -> list:
+        t0 = time.perf_counter()
+        errors = self.validate(requests, ticks) if validate else [None] * len(requests)
+        results = [None] * len(requests)
+        todo = []
+        for k, (request, error) in enumerate(zip(requests, errors)):
+            if error is None:
+                todo.append(k)
+            else:
+                results[k] = {"request": request, "retcode": None, "ticket": 0, "attempts": 0,
+                              "error": f"inválida: {error}", "confirmed": False}
+        sent = [self._send(requests[k]) for k in todo]
+        for k, res in zip(todo, sent):
+            results[k] = res
+
+        self.batches += 1
+        self.sent += len(todo)
+        self.rejected += len(requests) - len(todo)
+        self.failed += sum(1 for res in sent if res["error"])
+        self.last_ms = (time.perf_counter() - t0) * 1000.0
+        if self.log and any(res["error"] for res in results):
+            bad = [res["error"] for res in results if res["error"]]
+            self.log(f"⚠️ Lote de órdenes: {len(bad)}/{len(requests)} fallidas ({bad[0]}).")
+        return results
+
+    # ---------- conciliación ----------
+    def reconcile(self, symbol: str, results: list) -> dict:
+        """
+        Confirma cada resultado contra el estado del terminal:
+        - pendientes colocadas: su ticket aparece en orders_get o, si ya se llenó entre el envío
+          y la lectura, en positions_get (identifier) o en el historial de deals (filled=True);
+        - borrados: el ticket ya no está en orders_get;
+        - cierres (DEAL con position): la posición ya no está en positions_get.
+        Devuelve también las listas leídas (para reutilizarlas en el ciclo).
+        """
+        api = self.api
+        need_orders = any(res["request"].get("action") in (api.TRADE_ACTION_PENDING, api.TRADE_ACTION_REMOVE)
+                          for res in results)
+        need_positions = any(res["request"].get("position") for res in results)
+        with self.terminal_lock:
+            orders = list(api.orders_get(symbol=symbol) or []) if need_orders else None
+            positions = list(api.positions_get(symbol=symbol) or []) if need_positions else None
+        live_orders = {o.ticket for o in orders} if orders is not None else set()
+        live_positions = {p.ticket for p in positions} if positions is not None else set()
+
+        # Pendientes aceptadas que ya no están en orders_get: pueden haberse llenado ya
+        gone = {res["ticket"] for res in results if res["request"].get("action") == api.TRADE_ACTION_PENDING
+                and res["ticket"] and res["ticket"] not in live_orders}
+        filled = set()
+        if gone:
+            with self.terminal_lock:
+                if positions is None:
+                    positions = list(api.positions_get(symbol=symbol) or [])
+                filled = gone & {getattr(p, "identifier", p.ticket) for p in positions}
+                for ticket in gone - filled:
+                    if api.history_deals_get(position=ticket):
+                        filled.add(ticket)
+            live_positions = {p.ticket for p in positions}
+
+        missing = []
+        for k, res in enumerate(results):
+            request = res["request"]
+            action = request.get("action")
+            if action == api.TRADE_ACTION_PENDING:
+                res["filled"] = res["ticket"] in filled
+                res["confirmed"] = bool(res["ticket"]) and (res["ticket"] in live_orders or res["filled"])
+            elif action == api.TRADE_ACTION_REMOVE:
+                res["confirmed"] = request.get("order") not in live_orders
+            elif request.get("position"):
+                res["confirmed"] = request["position"] not in live_positions
+            else:
+                res["confirmed"] = res["error"] is None
+            if not res["confirmed"]:
+                missing.append(k)
+        return {"ok": not missing, "missing": missing, "orders": orders, "positions": positions}
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "sent": self.sent, "retried": self.retried, "rejected": self.rejected,
+                "failed": self.failed, "last_ms": self.last_ms}
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+    
\ No newline at end of file
@@ -4,6 +4,14 @@ import numpy as np
 import time
 import argparse
 from zoneinfo import ZoneInfo
+from typing import Optional
+from mt5_session import MT5Session, TERMINAL_LOCK
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender, pack_messages
+from candle_cache import CandleCache
+from bar_store import BarStore
+from indicators import IndicatorSet, rolling_max, rolling_min
+from stage_timing import StageTimer
 
 # ===========================
 #      CREDENCIALES (TU SCRIPT)
@@ -29,14 +37,29 @@ SYMBOLS = [
 TIMEFRAME = mt5.TIMEFRAME_M15
 LOOKBACK_BARS = 220       # ~55 horas con M15
 SWING_LOOKBACK = 96       # ~24 horas con M15
+HISTORY_BARS = max(LOOKBACK_BARS, SWING_LOOKBACK) + 10  # velas pedidas: lo que exige feature_bundle
 MOM_SHORT = 3             # 45 min
 MOM_LONG = 6              # 90 min
 
 TZ = ZoneInfo("Europe/Madrid")
 DEBUG = True
+STAGE_TIMING = True        # ms por etapa y p50/p95/p99 en el log de cada ciclo; False = sin coste
+
+# Histórico local de velas cerradas (memmap); evita re-descargar al reiniciar
+BARS_DIR = "bars"
+
+# Planificador: despertar X ms despues de cada cierre de vela (reloj monotonico)
+WAKE_AFTER_CLOSE_MS = 1000
 
 ATR_LEN = 14
 
+# Features sobre el array de MT5 (False = DataFrame + feature_bundle, la version de referencia)
+LEAN_FEATURES = True
+
+# Alertas Telegram
+BATCH_ALERTS         = True  # agrupa las alertas del ciclo en el minimo de mensajes (<= 4096 caracteres)
+ALERT_ONLY_ON_CHANGE = True  # en modo agrupado: solo simbolos cuya decision cambio desde el ciclo anterior
+
 # ===========================
 #      UTILIDADES
 # ===========================
@@ -44,49 +67,54 @@ def log(msg: str):
     if DEBUG:
         print(msg, flush=True)
 
+STAGES = StageTimer("pronosticos", enabled=STAGE_TIMING, log=log)
+
+TELEGRAM = TelegramSender(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, log=log)
+
+@STAGES.timed("send_telegram")
 def send_telegram(message: str):
-    """Envia mensaje a Telegram con las credenciales provistas."""
-    try:
-        import requests
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
-        r = requests.post(url, data=data, timeout=15)
-        if r.status_code != 200:
-            log(f"Telegram {r.status_code}: {r.text}")
-        else:
-            log("Telegram OK")
-    except Exception as e:
-        log(f"Telegram error: {e}")
+    """Encola el mensaje; el hilo de TELEGRAM lo entrega sin bloquear el ciclo."""
+    TELEGRAM.send(message)
+
+SESSION = MT5Session(mt5, MT5_LOGIN, MT5_PASSWORD, MT5_SERVER, path=PATH_TO_TERMINAL, log=log)
+CANDLES = CandleCache(mt5, store=BarStore(BARS_DIR))
+INDICATORS = {}  # simbolo -> IndicatorSet (estado streaming por simbolo)
+LAST_DECISIONS = {}  # simbolo -> ultima decision notificada (modo agrupado)
 
+@STAGES.timed("init_mt5")
 def init_mt5():
-    log("Inicializando MetaTrader 5...")
-    ok = mt5.initialize(PATH_TO_TERMINAL) if PATH_TO_TERMINAL else mt5.initialize()
-    if not ok:
-        raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
-    if not mt5.login(login=MT5_LOGIN, password=MT5_PASSWORD, server=MT5_SERVER):
-        raise RuntimeError(f"Login error: {mt5.last_error()}")
+    connect_ms = SESSION.ensure()
+    log(f"Sesion MT5 lista ({connect_ms:.1f} ms)")
 
 def shutdown_mt5():
-    try:
-        mt5.shutdown()
-    except Exception:
-        pass
+    SESSION.close()
     log("MT5 cerrado.")
 
+@STAGES.timed("ensure_symbol_ready")
 def ensure_symbol_ready(symbol: str):
-    if not mt5.symbol_select(symbol, True):
+    with TERMINAL_LOCK:
+        selected = mt5.symbol_select(symbol, True)
+        tick = mt5.symbol_info_tick(symbol) if selected else None
+    if not selected:
         raise RuntimeError(f"No se pudo suscribir a {symbol}")
-    tick = mt5.symbol_info_tick(symbol)
     if tick is None:
         raise RuntimeError(f"Sin tick para {symbol}")
 
-def copy_rates(symbol, timeframe, n=1000):
-    data = mt5.copy_rates_from_pos(symbol, timeframe, 0, n)
+@STAGES.timed("copy_rates")
+def copy_rates_raw(symbol, timeframe, n=1000) -> np.ndarray:
+    """Array estructurado de MT5 tal cual (time en epoch s), sin DataFrame."""
+    data = CANDLES.get(symbol, timeframe, n)
     if data is None or len(data) == 0:
         raise RuntimeError(f"No se pudieron obtener datos para {symbol}")
-    df = pd.DataFrame(data)
-    df["time"] = pd.to_datetime(df["time"], unit="s", utc=True).dt.tz_convert(TZ)
-    return df
+    return data
+
+def copy_rates(symbol, timeframe, n=1000):
+    """DataFrame de velas; "time" queda en epoch (s, UTC): se convierte a TZ solo al formatear."""
+    return pd.DataFrame(copy_rates_raw(symbol, timeframe, n))
+
+def local_time(epoch) -> pd.Timestamp:
+    """Epoch (s, UTC) de MT5 -> hora local TZ (mensajes)."""
+    return pd.Timestamp(int(epoch), unit="s", tz="UTC").tz_convert(TZ)
 
 def clamp01(x: float) -> float:
     return max(0.0, min(1.0, x))
@@ -115,33 +143,72 @@ def atr(df: pd.DataFrame, length=14):
     ], axis=1).max(axis=1)
     return tr.rolling(length).mean()
 
+def indicator_set(symbol: str) -> IndicatorSet:
+    if symbol not in INDICATORS:
+        INDICATORS[symbol] = IndicatorSet(ATR_LEN)
+    return INDICATORS[symbol]
+
 # ===========================
 #      HEURISTICA REBOTE
 # ===========================
-def feature_bundle(df: pd.DataFrame) -> dict:
-    if len(df) < max(LOOKBACK_BARS, SWING_LOOKBACK) + 10:
+@STAGES.timed("feature_bundle")
+def feature_bundle(df: pd.DataFrame, indicators: Optional[IndicatorSet]=None) -> dict:
+    if len(df) < HISTORY_BARS:
         raise ValueError("Historico insuficiente.")
 
     df = df.copy()
-    df["ema20"] = ema(df["close"], 20)
-    df["ema50"] = ema(df["close"], 50)
-    df["rsi14"] = rsi(df["close"], 14)
-    df["atr14"] = atr(df, ATR_LEN)
+    if indicators is None:
+        df["ema20"] = ema(df["close"], 20)
+        df["ema50"] = ema(df["close"], 50)
+        df["rsi14"] = rsi(df["close"], 14)
+        df["atr14"] = atr(df, ATR_LEN)
     df["mom3"] = df["close"] / df["close"].shift(MOM_SHORT) - 1.0
     df["mom6"] = df["close"] / df["close"].shift(MOM_LONG) - 1.0
-    df["hh"] = df["high"].rolling(SWING_LOOKBACK).max()
-    df["ll"] = df["low"].rolling(SWING_LOOKBACK).min()
+    if indicators is None:
+        df["hh"] = rolling_max(df["high"].to_numpy(), SWING_LOOKBACK)
+        df["ll"] = rolling_min(df["low"].to_numpy(), SWING_LOOKBACK)
 
     i = df.index[-2]  # ultima vela cerrada
+    if indicators is None:
+        ind = df.loc[i, ["ema20", "ema50", "rsi14", "atr14"]]
+    else:
+        # Motor streaming: solo procesa las velas cerradas nuevas desde el ciclo anterior
+        ind = indicators.evaluate(df["time"].values, df["high"].values, df["low"].values,
+                                  df["close"].values, lookbacks=(SWING_LOOKBACK,))
+
+    hh = df.loc[i, "hh"] if indicators is None else ind[f"hh{SWING_LOOKBACK}"]
+    ll = df.loc[i, "ll"] if indicators is None else ind[f"ll{SWING_LOOKBACK}"]
+    return rebound_features(int(df.loc[i, "time"]), df.loc[i, "close"], ind, df.loc[i, "mom3"], df.loc[i, "mom6"], hh, ll)
+
+@STAGES.timed("feature_bundle")
+def feature_bundle_np(rates: np.ndarray, indicators: Optional[IndicatorSet]=None) -> dict:
+    """feature_bundle sobre el array de copy_rates_raw: sin copiar el DataFrame ni crear columnas completas."""
+    n = len(rates)
+    if n < HISTORY_BARS:
+        raise ValueError("Historico insuficiente.")
 
-    close_i = float(df.loc[i, "close"])
-    rsi_i = float(df.loc[i, "rsi14"])
-    atr_i = float(df.loc[i, "atr14"])
-    ema_spread = float((df.loc[i, "ema20"] - df.loc[i, "ema50"]) / (atr_i + 1e-8))
-    mom3 = float(df.loc[i, "mom3"])
-    mom6 = float(df.loc[i, "mom6"])
-    hh = float(df.loc[i, "hh"])
-    ll = float(df.loc[i, "ll"])
+    if indicators is None:
+        indicators = IndicatorSet(ATR_LEN)
+    close = rates["close"]
+    ind = indicators.evaluate(rates["time"], rates["high"], rates["low"], close, lookbacks=(SWING_LOOKBACK,))
+
+    i = n - 2  # ultima vela cerrada
+    close_i = float(close[i])
+    mom3 = close_i / float(close[i - MOM_SHORT]) - 1.0
+    mom6 = close_i / float(close[i - MOM_LONG]) - 1.0
+    t = int(rates["time"][i])
+    return rebound_features(t, close_i, ind, mom3, mom6, ind[f"hh{SWING_LOOKBACK}"], ind[f"ll{SWING_LOOKBACK}"])
+
+def rebound_features(t, close_i, ind, mom3, mom6, hh, ll) -> dict:
+    """Probabilidades de rebote/caida a partir de los valores en la vela evaluada."""
+    close_i = float(close_i)
+    rsi_i = float(ind["rsi14"])
+    atr_i = float(ind["atr14"])
+    ema_spread = float((ind["ema20"] - ind["ema50"]) / (atr_i + 1e-8))
+    mom3 = float(mom3)
+    mom6 = float(mom6)
+    hh = float(hh)
+    ll = float(ll)
 
     drawdown = (hh - close_i) / hh if hh > 0 else 0.0
     dist_low = (close_i - ll) / ll if ll > 0 else 0.0
@@ -173,7 +240,7 @@ def feature_bundle(df: pd.DataFrame) -> dict:
         state = "lateral"
 
     return {
-        "time": df.loc[i, "time"],
+        "time": t,
         "close": close_i,
         "rsi": rsi_i,
         "atr": atr_i,
@@ -212,7 +279,7 @@ def build_recommendation(feat: dict) -> dict:
     }
 
 def format_message(symbol: str, rec: dict, feat: dict) -> str:
-    ts = str(feat["time"])
+    ts = str(local_time(feat["time"]))
     p_reb = rec["p_rebound"] * 100.0
     p_down = rec["p_down"] * 100.0
     drawdown = feat["drawdown"] * 100.0
@@ -233,36 +300,52 @@ def format_message(symbol: str, rec: dict, feat: dict) -> str:
 # ===========================
 #       CICLOS / MAIN
 # ===========================
-def run_once():
+def run_once(keep_session: bool=False, batch: bool=BATCH_ALERTS):
+    STAGES.begin_cycle()
     try:
         init_mt5()
+        pending = []
         for symbol in SYMBOLS:
             try:
                 ensure_symbol_ready(symbol)
-                df = copy_rates(symbol, TIMEFRAME, LOOKBACK_BARS)
-                feat = feature_bundle(df)
+                if LEAN_FEATURES:
+                    feat = feature_bundle_np(copy_rates_raw(symbol, TIMEFRAME, HISTORY_BARS),
+                                             indicators=indicator_set(symbol))
+                else:
+                    feat = feature_bundle(copy_rates(symbol, TIMEFRAME, HISTORY_BARS),
+                                          indicators=indicator_set(symbol))
                 rec = build_recommendation(feat)
                 message = format_message(symbol, rec, feat)
                 print(message)
-                send_telegram(message)
+                if not batch:
+                    send_telegram(message)
+                elif not ALERT_ONLY_ON_CHANGE or LAST_DECISIONS.get(symbol) != rec["decision"]:
+                    pending.append(message)
+                LAST_DECISIONS[symbol] = rec["decision"]
             except Exception as e:
                 log(f"{symbol}: error {e}")
+        if batch:
+            batches = pack_messages(pending)
+            for text in batches:
+                send_telegram(text)
+            log(f"Alertas agrupadas: {len(pending)}/{len(SYMBOLS)} simbolo(s) en {len(batches)} mensaje(s)")
     finally:
-        shutdown_mt5()
+        STAGES.end_cycle()
+        if not keep_session:
+            shutdown_mt5()
 
-def run_loop(every_minutes: int):
-    sleep_seconds = max(1, int(every_minutes * 60))
+def run_loop(every_minutes: int, batch: bool=BATCH_ALERTS):
+    scheduler = BarCloseScheduler(every_minutes * 60, offset_ms=WAKE_AFTER_CLOSE_MS, timeframe=TIMEFRAME, log=log)
     log(f"LOOP: comprobacion cada {every_minutes} minuto(s).")
-    while True:
-        start_ts = time.time()
-        try:
-            run_once()
-        except Exception as e:
-            log(f"Error en iteracion: {e}")
-            shutdown_mt5()
-        elapsed = time.time() - start_ts
-        remaining = max(0, sleep_seconds - int(elapsed))
-        time.sleep(remaining)
+    try:
+        while True:
+            try:
+                run_once(keep_session=True, batch=batch)
+            except Exception as e:
+                log(f"Error en iteracion: {e}")
+            scheduler.wait()
+    finally:
+        shutdown_mt5()
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -272,11 +355,13 @@ def parse_args():
                         help="Intervalo de comprobacion en minutos (por defecto: 5).")
     parser.add_argument("--once", action="store_true",
                         help="Ejecuta una sola vez y termina.")
+    parser.add_argument("--no-batch", action="store_true",
+                        help="Un mensaje de Telegram por simbolo y ciclo (sin agrupar ni filtrar cambios).")
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_args()
     if args.once:
-        run_once()
+        run_once(batch=not args.no_batch)
     else:
-        run_loop(args.every_min)
+        run_loop(args.every_min, batch=not args.no_batch)
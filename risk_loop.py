@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+from mt5_session import TERMINAL_LOCK
+from stage_timing import percentile
+
+LATENCY_WINDOW = 1000       # últimas N mediciones para percentiles
+
+# ===========================
+#      BUCLE RÁPIDO DE RIESGO
+# ===========================
+class TickRiskLoop:
+    """
+    Vigila symbol_info_tick cada interval_s (sub-segundo) y recalcula el P/L flotante
+    con las posiciones cacheadas (sin positions_get por tick).
+    - update(positions, orders, account): el ciclo normal le pasa el estado leído.
+    - check(pl, equity, balance) -> motivo o None: la regla de riesgo del script.
+      equity = account_info().equity del último update() + la variación del P/L de este
+      símbolo desde entonces (lo de otros símbolos se da por constante entre updates).
+    - on_trigger(motivo, tick, pl, balance, positions, orders): acción (cerrar todo, etc.).
+    - refresh(): si el tick cruza una pendiente cacheada, el estado puede haber
+      cambiado (llenado) y se pide al script que vuelva a llamar a update().
+    Mide la latencia desde que se ve el tick hasta que on_trigger termina de enviar.
+    """
+
+    def __init__(self, api, symbol: str, specs, check: Callable, on_trigger: Callable,
+                 refresh: Optional[Callable[[], None]] = None, interval_s: float = 0.1,
+                 retrigger_s: float = 1.0, log: Callable[[str], None] = print, terminal_lock=TERMINAL_LOCK):
+        self.api = api
+        self.symbol = symbol
+        self.specs = specs
+        self.check = check
+        self.on_trigger = on_trigger
+        self.refresh = refresh
+        self.interval_s = interval_s
+        self.retrigger_s = retrigger_s
+        self.log = log
+        self.terminal_lock = terminal_lock
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._legs = ()             # (signo, precio apertura, volumen) por posición
+        self._positions = []
+        self._orders = []
+        self._stops = ()            # (es_compra, precio) de las pendientes stop
+        self._balance = None
+        self._equity = None
+        self._base_pl = 0.0         # P/L del símbolo (profit de MT5) cuando se leyó la equity
+        self._currency = None
+        self._factor = 1.0          # conversión calibrada (divisa de beneficio -> cuenta)
+        self._last_msc = None
+        self._last_trigger = 0.0
+        self.ticks = 0
+        self.refreshes = 0
+        self.triggers = 0
+        self.errors = 0
+        self.last_pl = 0.0
+        self.last_equity = None
+        self.decide_us = deque(maxlen=LATENCY_WINDOW)
+        self.close_ms = deque(maxlen=LATENCY_WINDOW)
+
+    # ---------- estado cacheado ----------
+    def update(self, positions, orders=(), account=None):
+        api = self.api
+        legs = []
+        raw_total = 0.0
+        profit_total = 0.0
+        spec = self.specs.get(self.symbol)
+        cs = spec.contract_size if spec is not None else 1.0
+        for p in positions:
+            if p.symbol != self.symbol:
+                continue
+            sign = 1.0 if p.type == api.POSITION_TYPE_BUY else -1.0
+            legs.append((sign, float(p.price_open), float(p.volume) * cs))
+            raw_total += sign * (float(p.price_current) - float(p.price_open)) * float(p.volume) * cs
+            profit_total += float(p.profit)
+        stops = tuple((o.type == api.ORDER_TYPE_BUY_STOP, float(o.price_open)) for o in orders
+                      if o.symbol == self.symbol and o.type in (api.ORDER_TYPE_BUY_STOP, api.ORDER_TYPE_SELL_STOP))
+        with self._lock:
+            self._legs = tuple(legs)
+            self._positions = list(positions)
+            self._orders = list(orders)
+            self._stops = stops
+            if account is not None:
+                self._balance = float(account.balance)
+                self._equity = float(account.equity)
+                self._base_pl = profit_total
+                self._currency = account.currency
+            if abs(raw_total) > 1e-9:
+                self._factor = profit_total / raw_total
+
+    def _to_account(self, raw: float, price: float) -> float:
+        spec = self.specs.get(self.symbol)
+        if spec is None or self._currency is None or spec.currency_profit == self._currency:
+            return raw
+        if spec.currency_base == self._currency and price:
+            return raw / price
+        return raw * self._factor
+
+    def floating_pl(self, tick) -> float:
+        """P/L como lo valora MT5: compras a bid, ventas a ask."""
+        with self._lock:
+            legs = self._legs
+        raw = 0.0
+        for sign, open_price, units in legs:
+            raw += sign * ((tick.bid if sign > 0 else tick.ask) - open_price) * units
+        return self._to_account(raw, (tick.bid + tick.ask) / 2.0)
+
+    def _crossed_stop(self, tick) -> bool:
+        for is_buy, price in self._stops:
+            if (is_buy and tick.ask >= price) or (not is_buy and tick.bid <= price):
+                return True
+        return False
+
+    # ---------- un paso ----------
+    def poll_once(self) -> Optional[str]:
+        with self.terminal_lock:
+            tick = self.api.symbol_info_tick(self.symbol)
+        t_seen = time.perf_counter()
+        if tick is None or tick.time_msc == self._last_msc:
+            return None
+        self._last_msc = tick.time_msc
+        self.ticks += 1
+        if self.refresh is not None and self._crossed_stop(tick):
+            # Una pendiente se ha podido llenar: el conjunto de posiciones ya no vale
+            self.refreshes += 1
+            self.refresh()
+        with self._lock:
+            balance, equity, base_pl = self._balance, self._equity, self._base_pl
+            has_legs = bool(self._legs)
+        if balance is None or not has_legs:
+            return None
+        pl = self.floating_pl(tick)
+        self.last_pl = pl
+        self.last_equity = equity + (pl - base_pl)
+        reason = self.check(pl, self.last_equity, balance)
+        self.decide_us.append((time.perf_counter() - t_seen) * 1e6)
+        if reason is None or time.monotonic() - self._last_trigger < self.retrigger_s:
+            return None
+        self._last_trigger = time.monotonic()
+        self.triggers += 1
+        with self._lock:
+            positions, orders = list(self._positions), list(self._orders)
+        self.on_trigger(reason, tick, pl, balance, positions, orders)
+        self.close_ms.append((time.perf_counter() - t_seen) * 1000.0)
+        self.log(f"⚡ Riesgo [{reason}] tick→cierre {self.close_ms[-1]:.1f} ms (P/L {pl:.2f})")
+        return reason
+
+    # ---------- hilo ----------
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                self.errors += 1
+                self.log(f"⚠️ Bucle de riesgo: {e}")
+            self._stop.wait(self.interval_s)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="risk-loop", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(1.0, 2 * self.interval_s))
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "ticks": self.ticks, "triggers": self.triggers, "refreshes": self.refreshes, "errors": self.errors,
+            "decide_us_p50": percentile(self.decide_us, 50), "decide_us_p99": percentile(self.decide_us, 99),
+            "close_ms_p50": percentile(self.close_ms, 50), "close_ms_p95": percentile(self.close_ms, 95),
+            "close_ms_max": max(self.close_ms, default=0.0),
+        }
@@ -0,0 +1,90 @@
+import math
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import numpy as np
+
+# ===========================
+#      TIMEFRAMES MT5
+# ===========================
+def timeframe_seconds(timeframe: int) -> int:
+    """Duración en segundos de una constante TIMEFRAME_* de MT5 (M1=1 ... H1=0x4001, W1=0x8001, MN1=0xC001)."""
+    if timeframe & 0xC000 == 0xC000:
+        return (timeframe & 0x3FFF) * 30 * 86400
+    if timeframe & 0x8000:
+        return (timeframe & 0x3FFF) * 7 * 86400
+    if timeframe & 0x4000:
+        return (timeframe & 0x3FFF) * 3600
+    return timeframe * 60
+
+# ===========================
+#      PLANIFICADOR ALINEADO A CIERRES DE VELA
+# ===========================
+class BarCloseScheduler:
+    """
+    Sustituye el sleep fijo de run_loop: despierta offset_ms después de cada múltiplo de
+    period_s (cierres de vela M5/M15/H1 si el periodo coincide con el timeframe).
+    - Plazos medidos con reloj monotónico (sin deriva ni truncado a segundos).
+    - Si un ciclo se alarga y se pasa algún turno, se salta al siguiente en vez de encadenarlos.
+    - Registra el jitter de cada despertar (ms de retraso sobre el instante objetivo).
+    """
+
+    def __init__(self, period_s: float, offset_ms: float = 1000.0, timeframe: Optional[int] = None,
+                 server_offset_s: float = 0.0, log: Callable[[str], None] = print):
+        self.period_s = float(period_s)
+        self.offset_s = offset_ms / 1000.0
+        self.server_offset_s = server_offset_s
+        self.log = log
+        self.last_slot = None
+        self.wakeups = 0
+        self.skipped = 0
+        self.jitter_ms = deque(maxlen=500)
+        if timeframe is not None:
+            tf_s = timeframe_seconds(timeframe)
+            if self.period_s % tf_s and tf_s % self.period_s:
+                log(f"⚠️ Periodo {self.period_s:.0f} s no alineado con el timeframe ({tf_s} s).")
+
+    def next_slot(self, now: Optional[float] = None) -> float:
+        """Siguiente instante (epoch) de cierre de vela + offset estrictamente posterior a now."""
+        now = time.time() if now is None else now
+        base = self.offset_s + self.server_offset_s
+        k = math.floor((now - base) / self.period_s) + 1
+        return k * self.period_s + base
+
+    def wait(self) -> dict:
+        now_wall, now_mono = time.time(), time.monotonic()
+        target = self.next_slot(now_wall)
+        missed = 0
+        if self.last_slot is not None:
+            missed = max(0, int(round((target - self.last_slot) / self.period_s)) - 1)
+            if missed:
+                self.skipped += missed
+                self.log(f"⚠️ Ciclo más largo que el periodo: se omiten {missed} turno(s).")
+
+        deadline = now_mono + (target - now_wall)
+        self.log(f"⏳ Siguiente comprobación a las {time.strftime('%H:%M:%S', time.localtime(target))} "
+                 f"(~{target - now_wall:.1f} s).")
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(remaining)
+
+        jitter = (time.monotonic() - deadline) * 1000.0
+        self.jitter_ms.append(jitter)
+        self.wakeups += 1
+        self.last_slot = target
+        return {"slot": target, "jitter_ms": jitter, "missed": missed}
+
+    def stats(self) -> dict:
+        if not self.jitter_ms:
+            return {"wakeups": self.wakeups, "skipped": self.skipped}
+        j = np.fromiter(self.jitter_ms, dtype=float)
+        return {
+            "wakeups": self.wakeups,
+            "skipped": self.skipped,
+            "jitter_p50_ms": float(np.percentile(j, 50)),
+            "jitter_p95_ms": float(np.percentile(j, 95)),
+            "jitter_max_ms": float(j.max()),
+        }
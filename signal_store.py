@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+# Señales recordadas por (estrategia, símbolo, timeframe); las más antiguas se podan.
+KEEP_PER_KEY = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signals (
+    strategy   TEXT    NOT NULL,
+    symbol     TEXT    NOT NULL,
+    timeframe  INTEGER NOT NULL,
+    signal_key TEXT    NOT NULL,
+    sent_at    REAL    NOT NULL,
+    PRIMARY KEY (strategy, symbol, timeframe, signal_key)
+) WITHOUT ROWID
+"""
+
+# ===========================
+#      ESTADO DE SEÑALES ENVIADAS
+# ===========================
+class SignalStore:
+    """
+    Registro de señales ya enviadas, compartido por varios scripts/procesos:
+    - SQLite en modo WAL: cada mark_sent es una transacción atómica (un fallo a
+      mitad de escritura no corrompe nada) y los lectores no bloquean al escritor.
+    - Clave (estrategia, símbolo, timeframe, señal): cada estrategia tiene su espacio.
+    - Caché en memoria por (símbolo, timeframe): already_sent no toca el disco
+      tras la primera lectura de esa clave.
+    """
+
+    def __init__(self, path: str = "signals.db", strategy: str = "default",
+                 keep_per_key: int = KEEP_PER_KEY, log: Optional[Callable[[str], None]] = None):
+        self.path = path
+        self.strategy = strategy
+        self.keep_per_key = keep_per_key
+        self.log = log
+        self._lock = threading.Lock()
+        self._conn = None
+        self._cache = {}
+        self.reads = 0
+        self.writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _keys(self, symbol: str, timeframe: int) -> set:
+        key = (symbol, int(timeframe))
+        if key not in self._cache:
+            rows = self._db().execute(
+                "SELECT signal_key FROM signals WHERE strategy=? AND symbol=? AND timeframe=?",
+                (self.strategy, symbol, int(timeframe)),
+            ).fetchall()
+            self.reads += 1
+            self._cache[key] = {row[0] for row in rows}
+        return self._cache[key]
+
+    def already_sent(self, symbol: str, timeframe: int, signal) -> bool:
+        with self._lock:
+            return str(signal) in self._keys(symbol, timeframe)
+
+    def mark_sent(self, symbol: str, timeframe: int, signal):
+        self.mark_many(symbol, timeframe, [signal])
+
+    def seed(self, symbol: str, timeframe: int, signals: Iterable) -> int:
+        """
+        Migración: registra señales de un estado anterior solo si (símbolo, timeframe) aún no
+        tiene ninguna en esta estrategia. Devuelve cuántas se registraron.
+        """
+        with self._lock:
+            if self._keys(symbol, int(timeframe)):
+                return 0
+        values = [str(s) for s in signals]
+        self.mark_many(symbol, timeframe, values)
+        return len(values)
+
+    def mark_many(self, symbol: str, timeframe: int, signals: Iterable):
+        """Varias señales del mismo ciclo en una sola transacción."""
+        values = [str(s) for s in signals]
+        if not values:
+            return
+        now = time.time()
+        tf = int(timeframe)
+        with self._lock:
+            keys = self._keys(symbol, tf)
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "INSERT OR REPLACE INTO signals (strategy, symbol, timeframe, signal_key, sent_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(self.strategy, symbol, tf, v, now) for v in values],
+                )
+                db.execute(
+                    "DELETE FROM signals WHERE strategy=? AND symbol=? AND timeframe=? AND signal_key NOT IN "
+                    "(SELECT signal_key FROM signals WHERE strategy=? AND symbol=? AND timeframe=? "
+                    "ORDER BY sent_at DESC LIMIT ?)",
+                    (self.strategy, symbol, tf, self.strategy, symbol, tf, self.keep_per_key),
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            keys.update(values)
+            self.writes += 1
+            if len(keys) > self.keep_per_key:
+                # La poda borró las más antiguas: la caché se recarga en la próxima lectura
+                self._cache.pop((symbol, tf), None)
+
+    def stats(self) -> dict:
+        return {"keys": sum(len(v) for v in self._cache.values()), "reads": self.reads, "writes": self.writes}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,145 @@
+import functools
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Callable, Optional
+
+STAGE_WINDOW = 1000         # últimas N mediciones por etapa para percentiles
+REPORT_EVERY = 12           # ciclos entre líneas de percentiles (12 × M5 ≈ 1 h)
+CYCLE_STAGE = "ciclo"
+
+_NO_SPAN = nullcontext()
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+class _Span:
+    __slots__ = ("timer", "stage", "t0")
+
+    def __init__(self, timer, stage: str):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.stage, (time.perf_counter() - self.t0) * 1000.0)
+        return False
+
+# ===========================
+#      LATENCIA POR ETAPA
+# ===========================
+class StageTimer:
+    """
+    Tiempos por etapa del ciclo (init_mt5, copy_rates, features, telegram, order…) con reloj monotónico:
+    - span(etapa): context manager; timed(etapa): decorador. Varias llamadas de la misma etapa
+      en un ciclo (un símbolo cada una, también desde hilos) se suman.
+    - begin_cycle()/end_cycle(): una línea por ciclo con los ms de cada etapa y el total;
+      cada report_every ciclos, otra con p50/p95/p99 por etapa.
+    - stats(): p50/p95/p99/máx por etapa sobre las últimas `window` mediciones.
+    Desactivado, span() devuelve un contexto nulo compartido (sin reloj ni lock), timed()
+    deja la función sin envolver y begin/end_cycle no hacen nada.
+    """
+
+    def __init__(self, name: str = "", enabled: bool = True, window: int = STAGE_WINDOW,
+                 report_every: int = REPORT_EVERY, log: Callable[[str], None] = print):
+        self.name = name
+        self.enabled = enabled
+        self.window = window
+        self.report_every = report_every
+        self.log = log
+        self._lock = threading.Lock()
+        self._samples = {}          # etapa -> deque de ms (una muestra por ciclo)
+        self._cycle = {}            # etapa -> [ms acumulados, llamadas] del ciclo en curso
+        self._t_cycle = None
+        self.cycles = 0
+
+    # ---------- medición ----------
+    def span(self, stage: str):
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, stage)
+
+    def timed(self, stage: str):
+        """Decorador: mide cada llamada como la etapa `stage`."""
+        def decorate(fn):
+            if not self.enabled:
+                return fn
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Span(self, stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def record(self, stage: str, ms: float):
+        with self._lock:
+            acc = self._cycle.get(stage)
+            if acc is None:
+                self._cycle[stage] = [ms, 1]
+            else:
+                acc[0] += ms
+                acc[1] += 1
+
+    # ---------- ciclo ----------
+    def begin_cycle(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._cycle = {}
+            self._t_cycle = time.perf_counter()
+
+    def end_cycle(self) -> Optional[dict]:
+        """Cierra el ciclo: guarda una muestra por etapa, emite la línea resumen y devuelve {etapa: ms}."""
+        if not self.enabled or self._t_cycle is None:
+            return None
+        total_ms = (time.perf_counter() - self._t_cycle) * 1000.0
+        with self._lock:
+            cycle, self._cycle, self._t_cycle = self._cycle, {}, None
+            for stage, (ms, _) in cycle.items():
+                self._series(stage).append(ms)
+            self._series(CYCLE_STAGE).append(total_ms)
+            self.cycles += 1
+            report = self.report_every > 0 and self.cycles % self.report_every == 0
+        parts = [f"{stage} {ms:.1f}" + (f" ×{calls}" if calls > 1 else "") for stage, (ms, calls) in cycle.items()]
+        prefix = f"⏱️ Etapas {self.name}" if self.name else "⏱️ Etapas"
+        self.log(f"{prefix} (ms): {' | '.join(parts) or '—'} → {CYCLE_STAGE} {total_ms:.1f}")
+        if report:
+            self.log(f"📊 {self.report()}")
+        out = {stage: ms for stage, (ms, _) in cycle.items()}
+        out[CYCLE_STAGE] = total_ms
+        return out
+
+    def _series(self, stage: str) -> deque:
+        series = self._samples.get(stage)
+        if series is None:
+            series = self._samples[stage] = deque(maxlen=self.window)
+        return series
+
+    # ---------- resumen ----------
+    def stats(self) -> dict:
+        with self._lock:
+            samples = {stage: list(series) for stage, series in self._samples.items()}
+        return {stage: {"n": len(v), "p50_ms": percentile(v, 50), "p95_ms": percentile(v, 95),
+                        "p99_ms": percentile(v, 99), "max_ms": max(v) if v else 0.0}
+                for stage, v in samples.items()}
+
+    def report(self) -> str:
+        """Una línea: p50/p95/p99 (ms) por etapa, de la más lenta (p95) a la más rápida."""
+        stats = self.stats()
+        cycle = stats.pop(CYCLE_STAGE, None)
+        ordered = sorted(stats.items(), key=lambda kv: kv[1]["p95_ms"], reverse=True)
+        if cycle is not None:
+            ordered.append((CYCLE_STAGE, cycle))
+        parts = [f"{stage} {s['p50_ms']:.1f}/{s['p95_ms']:.1f}/{s['p99_ms']:.1f}" for stage, s in ordered]
+        head = f"Etapas {self.name}" if self.name else "Etapas"
+        return f"{head} p50/p95/p99 (ms, {self.cycles} ciclo(s)): {' | '.join(parts) or '—'}"
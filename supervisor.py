@@ -0,0 +1,244 @@
+import MetaTrader5 as mt5
+import argparse
+import heapq
+import importlib
+import time
+from typing import Optional
+from mt5_session import MT5Session, LockedAPI
+from scheduler import BarCloseScheduler
+from telegram_queue import TelegramSender
+from candle_cache import CandleCache
+from bar_store import BarStore
+from indicators import IndicatorSet, IndicatorCache
+from symbol_specs import SymbolSpecCache
+
+# ===========================
+#      ESTRATEGIAS (PLUG-INS)
+# ===========================
+# Cada script se importa como módulo y se ejecuta su run_once(keep_session=True) con su propio periodo.
+# nombre -> (minutos entre comprobaciones, argumentos extra de run_once)
+STRATEGIES = {
+    "mt5":           (5, {"horizon_min": 5}),
+    "bot3":          (5, {"horizon_min": 5}),
+    "estocastic":    (5, {}),
+    "gold_forecast": (5, {}),
+    "martingala":    (1, {}),
+    "pronosticos":   (5, {}),
+}
+
+BARS_DIR = "bars"
+WAKE_AFTER_CLOSE_MS = 1000
+STATS_EVERY_MIN = 60
+DEBUG = True
+
+# ===========================
+#      UTILIDADES
+# ===========================
+def log(msg: str):
+    if DEBUG:
+        print(msg, flush=True)
+
+class Strategy:
+    """Un script cargado como plug-in: su módulo, su run_once y su propio planificador."""
+
+    def __init__(self, name: str, module, every_min: float, kwargs: dict):
+        self.name = name
+        self.module = module
+        self.kwargs = dict(kwargs)
+        timeframe = getattr(module, "TIMEFRAME_SIGNAL", getattr(module, "TIMEFRAME", None))
+        self.scheduler = BarCloseScheduler(every_min * 60, offset_ms=WAKE_AFTER_CLOSE_MS,
+                                           timeframe=timeframe, log=log)
+        self.runs = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+        self.max_lag_ms = 0.0
+
+    def symbols(self) -> list:
+        if hasattr(self.module, "SYMBOLS"):
+            return list(self.module.SYMBOLS)
+        return [self.module.SYMBOL]
+
+    def run(self, slot: Optional[float] = None):
+        if slot is not None:
+            # Retraso sobre el instante previsto (otras estrategias vencidas a la vez van antes)
+            lag_ms = (time.time() - slot) * 1000.0
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            log(f"▶️ [{self.name}] (retraso {lag_ms:.0f} ms)")
+        else:
+            log(f"▶️ [{self.name}]")
+        t0 = time.perf_counter()
+        try:
+            self.module.run_once(keep_session=True, **self.kwargs)
+        except Exception as e:
+            self.errors += 1
+            log(f"❌ [{self.name}] Error en iteración: {e}")
+        self.runs += 1
+        self.last_ms = (time.perf_counter() - t0) * 1000.0
+        self.total_ms += self.last_ms
+
+    def watchers(self) -> list:
+        """Hilos vigilantes del plug-in (llenados, riesgo por tick), si los tiene."""
+        out = []
+        if hasattr(self.module, "FILLS"):
+            out.append(self.module.FILLS)
+        if getattr(self.module, "FAST_RISK", False) and hasattr(self.module, "RISK"):
+            out.append(self.module.RISK)
+        return out
+
+    def start_watchers(self):
+        # Tras el primer run(): la sesión ya está abierta. Los hilos llaman a MT5 mientras corren
+        # otros plug-ins: requiere que todos usen TERMINAL_LOCK (Supervisor._attach les da LockedAPI).
+        for watcher in self.watchers():
+            watcher.start()
+
+    def stop_watchers(self):
+        for watcher in self.watchers():
+            watcher.stop()
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "errors": self.errors, "last_ms": self.last_ms,
+                "avg_ms": self.total_ms / self.runs if self.runs else 0.0, "max_lag_ms": self.max_lag_ms}
+
+# ===========================
+#      SUPERVISOR
+# ===========================
+class Supervisor:
+    """
+    Aloja varias estrategias en un solo proceso sobre recursos compartidos:
+    - Una única sesión MT5 (un login; suscribe la unión de los símbolos).
+    - Una única caché de velas (memoria + BarStore), de indicadores streaming y de especificaciones de símbolo.
+    - Un único emisor de Telegram (mismo token/chat => un solo límite de envío).
+    - Un único `mt5` con lock (LockedAPI) para todos: los hilos vigilantes de un plug-in
+      (llenados, riesgo) corren a la vez que los ciclos de los demás.
+    Cada estrategia conserva su periodo; las que vencen a la vez se ejecutan en secuencia.
+    """
+
+    def __init__(self, specs: dict):
+        self.strategies = []
+        modules = []
+        for name in specs:
+            modules.append(importlib.import_module(name))
+        first = modules[0]
+
+        creds = (first.MT5_LOGIN, first.MT5_PASSWORD, first.MT5_SERVER)
+        for name, module in zip(specs, modules):
+            if (module.MT5_LOGIN, module.MT5_PASSWORD, module.MT5_SERVER) != creds:
+                # El paquete MetaTrader5 maneja un único terminal/login por proceso
+                raise RuntimeError(f"{name}: credenciales MT5 distintas; ejecútalo en un proceso aparte.")
+
+        self.api = LockedAPI(mt5)
+        self.session = MT5Session(mt5, *creds, path=getattr(first, "PATH_TO_TERMINAL", None), log=log)
+        self.candles = CandleCache(mt5, store=BarStore(BARS_DIR))
+        self.indicators = IndicatorCache()
+        self.specs = SymbolSpecCache(mt5, log=log)
+        self.telegram = TelegramSender(first.TELEGRAM_BOT_TOKEN, first.TELEGRAM_CHAT_ID, log=log)
+
+        for name, module in zip(specs, modules):
+            every_min, kwargs = specs[name]
+            self._attach(module)
+            strategy = Strategy(name, module, every_min, kwargs)
+            for symbol in strategy.symbols():
+                if symbol not in self.session.symbols:
+                    self.session.symbols.append(symbol)
+            self.strategies.append(strategy)
+
+    def _attach(self, module):
+        """Sustituye los recursos por-script del módulo por los compartidos."""
+        module.mt5 = self.api
+        module.SESSION = self.session
+        if hasattr(module, "CANDLES"):
+            module.CANDLES = self.candles
+        if hasattr(module, "SPECS"):
+            module.SPECS = self.specs
+            for name in ("ORDERS", "RISK"):
+                if hasattr(module, name):
+                    getattr(module, name).specs = self.specs
+        if (module.TELEGRAM_BOT_TOKEN, module.TELEGRAM_CHAT_ID) == (self.telegram.token, self.telegram.chat_id):
+            module.TELEGRAM = self.telegram
+        if isinstance(getattr(module, "INDICATORS", None), IndicatorSet):
+            module.INDICATORS = self.indicators.get(module.SYMBOL, module.TIMEFRAME, module.ATR_LEN)
+        if hasattr(module, "indicator_set"):
+            module.indicator_set = lambda symbol, m=module: self.indicators.get(symbol, m.TIMEFRAME, m.ATR_LEN)
+
+    def run_once(self):
+        for strategy in self.strategies:
+            strategy.run()
+
+    def log_stats(self):
+        log(f"ℹ️ Sesión: {self.session.stats()} Velas: {self.candles.stats()} "
+            f"Indicadores: {self.indicators.stats()} Specs: {self.specs.stats()} Telegram: {self.telegram.stats()}")
+        for strategy in self.strategies:
+            log(f"ℹ️ [{strategy.name}] {strategy.stats()}")
+
+    def run_loop(self):
+        names = ", ".join(f"{s.name}/{s.scheduler.period_s / 60:g}m" for s in self.strategies)
+        log(f"♻️ SUPERVISOR: {len(self.strategies)} estrategia(s): {names}.")
+        # Cola de vencimientos (epoch objetivo, índice); el primer ciclo se ejecuta ya
+        now = time.time()
+        due = [(now, k) for k in range(len(self.strategies))]
+        heapq.heapify(due)
+        next_stats = time.monotonic() + STATS_EVERY_MIN * 60
+        try:
+            while True:
+                target = due[0][0]
+                deadline = time.monotonic() + (target - time.time())
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    time.sleep(remaining)
+
+                # Todas las estrategias vencidas en este instante, en orden de registro
+                ready = []
+                while due and due[0][0] <= target:
+                    ready.append(heapq.heappop(due)[1])
+                for k in sorted(ready):
+                    self.strategies[k].run(slot=target)
+                    self.strategies[k].start_watchers()
+                for k in ready:
+                    # Si el ciclo se alargó, next_slot salta los turnos ya perdidos
+                    heapq.heappush(due, (self.strategies[k].scheduler.next_slot(), k))
+
+                if time.monotonic() >= next_stats:
+                    self.log_stats()
+                    next_stats = time.monotonic() + STATS_EVERY_MIN * 60
+        finally:
+            for strategy in self.strategies:
+                strategy.stop_watchers()
+            self.session.close()
+            log("🔚 MT5 cerrado.")
+
+    def close(self):
+        self.session.close()
+        self.telegram.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Ejecuta varias estrategias en un solo proceso con una sesión MT5 y una caché de velas compartidas."
+    )
+    parser.add_argument("strategies", nargs="*", default=list(STRATEGIES),
+                        help="Estrategias a cargar, opcionalmente con periodo: nombre[:minutos] "
+                             f"(por defecto: {' '.join(STRATEGIES)}).")
+    parser.add_argument("--once", action="store_true",
+                        help="Ejecuta una vez cada estrategia y termina.")
+    return parser.parse_args()
+
+def build_specs(items) -> dict:
+    specs = {}
+    for item in items:
+        name, _, minutes = item.partition(":")
+        every_min, kwargs = STRATEGIES.get(name, (5, {}))
+        specs[name] = (float(minutes) if minutes else every_min, kwargs)
+    return specs
+
+if __name__ == "__main__":
+    args = parse_args()
+    supervisor = Supervisor(build_specs(args.strategies))
+    if args.once:
+        try:
+            supervisor.run_once()
+        finally:
+            supervisor.close()
+    else:
+        supervisor.run_loop()
@@ -0,0 +1,252 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import os
+import random
+import time
+from multiprocessing import Pool, shared_memory
+from typing import Optional
+
+import numpy as np
+
+import backtest
+from backtest import DEFAULT_PARAMS, feature_matrix
+
+# Columnas del bloque compartido (una fila por columna, símbolos concatenados: columnas contiguas)
+COLUMNS = ("open", "high", "low", "close", "ema_spread", "mom_h", "rsi_pos", "breakout_up", "breakout_dn", "atr")
+FEATURE_CACHE_DIR = "features"
+RESULTS_FILE = "sweep_results.csv"
+METRICS = ("total_r", "avg_r", "profit_factor", "win_rate", "hit_rate_h")
+DEBUG = True
+
+def log(msg: str):
+    if DEBUG:
+        print(msg, flush=True)
+
+# ===========================
+#      ESPACIO DE BÚSQUEDA
+# ===========================
+def parse_space(items) -> dict:
+    """
+    name=a,b,c -> valores discretos (rejilla); name=lo:hi -> rango uniforme (búsqueda aleatoria).
+    Solo se admiten claves de backtest.DEFAULT_PARAMS.
+    """
+    space = {}
+    for item in items:
+        name, _, spec = item.partition("=")
+        if name not in DEFAULT_PARAMS:
+            raise ValueError(f"Parámetro desconocido: {name} (válidos: {', '.join(DEFAULT_PARAMS)})")
+        if ":" in spec:
+            lo, hi = spec.split(":")
+            space[name] = (float(lo), float(hi))
+        else:
+            space[name] = [float(v) for v in spec.split(",")]
+    return space
+
+def grid(space: dict) -> list:
+    if any(isinstance(v, tuple) for v in space.values()):
+        raise ValueError("La rejilla solo admite listas de valores (name=a,b,c); usa --random N para rangos.")
+    names = list(space)
+    return [dict(zip(names, combo)) for combo in itertools.product(*(space[n] for n in names))]
+
+def random_search(space: dict, n: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        out.append({name: round(rng.uniform(*v), 4) if isinstance(v, tuple) else rng.choice(v)
+                    for name, v in space.items()})
+    return out
+
+# ===========================
+#      FEATURES: CACHÉ EN DISCO + MEMORIA COMPARTIDA
+# ===========================
+def _cache_path(cache_dir: str, symbol: str, bars, horizon_min: int) -> str:
+    key = f"{symbol}|{len(bars)}|{int(bars['time'][0])}|{int(bars['time'][-1])}|{horizon_min}|{','.join(COLUMNS)}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{symbol}_{digest}.npy")
+
+def symbol_columns(symbol: str, bars, horizon_min: int, cache_dir: Optional[str]) -> np.ndarray:
+    """Matriz (COLUMNS x velas) del símbolo; se reutiliza de disco si las velas no cambiaron."""
+    path = _cache_path(cache_dir, symbol, bars, horizon_min) if cache_dir else None
+    if path and os.path.exists(path):
+        return np.load(path, mmap_mode="r")
+    feat = feature_matrix(bars, horizon_min)
+    cols = np.empty((len(COLUMNS), len(bars)))
+    for k, name in enumerate(COLUMNS):
+        cols[k] = bars[name] if name in ("open", "high", "low", "close") else feat[name]
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(path, cols)
+    return cols
+
+class SharedFeatures:
+    """
+    Bloque de memoria compartida con las columnas de todos los símbolos.
+    Los procesos del pool se adjuntan por nombre: nada se serializa salvo los parámetros.
+    """
+
+    def __init__(self, series: dict, horizon_min: int, cache_dir: Optional[str] = FEATURE_CACHE_DIR):
+        mats = {s: symbol_columns(s, bars, horizon_min, cache_dir) for s, bars in series.items()}
+        rows = sum(m.shape[1] for m in mats.values())
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, rows * len(COLUMNS) * 8))
+        block = np.ndarray((len(COLUMNS), rows), dtype=float, buffer=self.shm.buf)
+        self.layout = {}
+        start = 0
+        for symbol, mat in mats.items():
+            n = mat.shape[1]
+            block[:, start:start + n] = mat
+            self.layout[symbol] = (start, start + n)
+            start += n
+        self.shape = block.shape
+        self.bars_ahead = max(1, horizon_min // backtest.TF_MIN)
+        del block
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+# Estado por proceso del pool
+_SHM = None
+_VIEWS = {}
+_OPTS = {}
+
+def _attach(shm_name: str, shape, layout: dict, bars_ahead: int, opts: dict):
+    global _SHM
+    _SHM = shared_memory.SharedMemory(name=shm_name)
+    block = np.ndarray(shape, dtype=float, buffer=_SHM.buf)
+    _VIEWS.clear()
+    for symbol, (a, b) in layout.items():
+        cols = {name: block[k, a:b] for k, name in enumerate(COLUMNS)}
+        cols["bars_ahead"] = bars_ahead
+        _VIEWS[symbol] = cols
+    _OPTS.clear()
+    _OPTS.update(opts)
+
+def _detach():
+    global _SHM
+    _VIEWS.clear()
+    if _SHM is not None:
+        _SHM.close()
+        _SHM = None
+
+def _aggregate(per_symbol: list, group: str) -> dict:
+    stats = [rep[group] for rep in per_symbol]
+    trades = sum(s.get("trades", 0) for s in stats)
+    signals = sum(s["signals"] for s in stats)
+    gains = sum(s.get("gains_r", 0.0) for s in stats)
+    losses = sum(s.get("losses_r", 0.0) for s in stats)
+    total = sum(s.get("total_r", 0.0) for s in stats)
+    hits = [(s["hit_rate_h"], s["signals"]) for s in stats if s["signals"] and not np.isnan(s["hit_rate_h"])]
+    return {
+        "signals": signals,
+        "trades": trades,
+        "win_rate": sum(s.get("wins", 0) for s in stats) / trades if trades else 0.0,
+        "total_r": total,
+        "avg_r": total / trades if trades else 0.0,
+        "profit_factor": gains / losses if losses > 0 else (float("inf") if gains > 0 else 0.0),
+        "max_dd_r": max((s.get("max_dd_r", 0.0) for s in stats), default=0.0),
+        "hit_rate_h": sum(h * n for h, n in hits) / sum(n for _, n in hits) if hits else float("nan"),
+    }
+
+def evaluate(params: dict) -> dict:
+    """Backtest de una combinación sobre todos los símbolos (se ejecuta dentro del pool)."""
+    t0 = time.perf_counter()
+    per_symbol = [backtest.backtest(cols, entry_bars=_OPTS["entry_bars"], max_hold=_OPTS["max_hold"],
+                                    params=params, feat=cols)
+                  for cols in _VIEWS.values()]
+    result = _aggregate(per_symbol, _OPTS["group"])
+    result["eval_s"] = time.perf_counter() - t0
+    return {**params, **result}
+
+# ===========================
+#      EJECUCIÓN
+# ===========================
+def run_sweep(series: dict, combos: list, horizon_min: int = 5, group: str = "trade", metric: str = "total_r",
+              min_trades: int = 30, workers: Optional[int] = None, entry_bars: int = backtest.ENTRY_BARS_DEFAULT,
+              max_hold: int = backtest.MAX_HOLD_BARS, cache_dir: Optional[str] = FEATURE_CACHE_DIR,
+              out_path: Optional[str] = RESULTS_FILE) -> list:
+    t0 = time.perf_counter()
+    shared = SharedFeatures(series, horizon_min, cache_dir)
+    t_feat = time.perf_counter() - t0
+    opts = {"group": group, "entry_bars": entry_bars, "max_hold": max_hold}
+    workers = workers or os.cpu_count() or 1
+    log(f"🧮 {len(combos)} combinación(es) x {len(series)} símbolo(s), {shared.shape[1]} velas; "
+        f"features en {t_feat:.2f} s; {workers} proceso(s).")
+    try:
+        t1 = time.perf_counter()
+        initargs = (shared.shm.name, shared.shape, shared.layout, shared.bars_ahead, opts)
+        if workers == 1:
+            _attach(*initargs)
+            try:
+                rows = [evaluate(c) for c in combos]
+            finally:
+                _detach()
+        else:
+            with Pool(workers, initializer=_attach, initargs=initargs) as pool:
+                rows = pool.map(evaluate, combos, chunksize=1)
+        elapsed = time.perf_counter() - t1
+    finally:
+        shared.close()
+
+    # Ranking: primero las combinaciones con suficientes operaciones
+    rows.sort(key=lambda r: (r["trades"] >= min_trades, np.nan_to_num(r[metric], nan=-np.inf)), reverse=True)
+    for rank, row in enumerate(rows, 1):
+        row["rank"] = rank
+    log(f"⏱️ {len(combos)} evaluaciones en {elapsed:.2f} s ({elapsed / max(len(combos), 1):.2f} s/comb.)")
+
+    if out_path:
+        fields = ["rank"] + list(DEFAULT_PARAMS) + ["signals", "trades", "win_rate", "total_r", "avg_r",
+                                                    "profit_factor", "max_dd_r", "hit_rate_h", "eval_s"]
+        with open(out_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({k: row.get(k, DEFAULT_PARAMS.get(k)) for k in fields})
+        log(f"💾 Resultados ordenados por {metric} ({group}) en {out_path}")
+    return rows
+
+def print_top(rows: list, space: dict, k: int = 10):
+    for row in rows[:k]:
+        params = " ".join(f"{n}={row[n]:g}" for n in space)
+        log(f"#{row['rank']:<3} {params}  ops={row['trades']:>7}  win={row['win_rate'] * 100:5.1f}%  "
+            f"R={row['total_r']:+9.1f}  R/op={row['avg_r']:+.3f}  PF={row['profit_factor']:.2f}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Barrido paralelo de pesos/umbrales del modelo heurístico (rejilla o aleatorio).")
+    parser.add_argument("space", nargs="+",
+                        help="Espacio: name=a,b,c (rejilla) o name=lo:hi (con --random). "
+                             f"Parámetros: {', '.join(DEFAULT_PARAMS)}.")
+    parser.add_argument("--random", type=int, default=0, metavar="N", help="N combinaciones aleatorias.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--root", default="bars", help="Directorio del BarStore (por defecto: bars).")
+    parser.add_argument("--symbols", nargs="*", default=None)
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N", help="N símbolos sintéticos.")
+    parser.add_argument("--years", type=float, default=3.0, help="Años de M5 por símbolo sintético.")
+    parser.add_argument("--horizon-min", type=int, default=5)
+    parser.add_argument("--group", choices=("buy", "trade", "sell"), default="trade",
+                        help="Grupo de señales a optimizar (por defecto: trade = auto-BUY p>=prob_trade_th).")
+    parser.add_argument("--metric", choices=METRICS, default="total_r")
+    parser.add_argument("--min-trades", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=None, help="Procesos (por defecto: núcleos).")
+    parser.add_argument("--no-cache", action="store_true", help="No leer/guardar features en disco.")
+    parser.add_argument("--out", default=RESULTS_FILE)
+    parser.add_argument("--top", type=int, default=10)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    space = parse_space(args.space)
+    combos = random_search(space, args.random, args.seed) if args.random else grid(space)
+    if args.synthetic:
+        n = int(args.years * 365 * 24 * 12)
+        series = {f"SYN{k:02d}": backtest.synthetic_bars(n, seed=k) for k in range(args.synthetic)}
+    else:
+        series = backtest.load_symbols(args.root, symbols=args.symbols)
+        if not series:
+            raise SystemExit(f"No hay velas M5 en {args.root}/ (usa --synthetic N para un benchmark).")
+    rows = run_sweep(series, combos, horizon_min=args.horizon_min, group=args.group, metric=args.metric,
+                     min_trades=args.min_trades, workers=args.workers,
+                     cache_dir=None if args.no_cache else FEATURE_CACHE_DIR, out_path=args.out)
+    print_top(rows, space, args.top)
@@ -0,0 +1,132 @@
+import threading
+import time
+from typing import Callable, NamedTuple, Optional
+from mt5_session import TERMINAL_LOCK
+
+# Retcodes de order_send que suelen indicar especificación desactualizada
+# (volumen/stops/llenado/modo de trading cambiados por el bróker).
+STALE_SPEC_RETCODES = {
+    10014,  # TRADE_RETCODE_INVALID_VOLUME
+    10016,  # TRADE_RETCODE_INVALID_STOPS
+    10017,  # TRADE_RETCODE_TRADE_DISABLED
+    10018,  # TRADE_RETCODE_MARKET_CLOSED
+    10030,  # TRADE_RETCODE_INVALID_FILL
+}
+
+# ===========================
+#      ESPECIFICACIÓN DE SÍMBOLO
+# ===========================
+class SymbolSpec(NamedTuple):
+    """Campos de symbol_info() que necesita el código que construye órdenes y valora posiciones."""
+    symbol: str
+    point: float
+    digits: int
+    pip: float              # 1 pip = 10 * point (FX de 5/3 dígitos)
+    volume_min: float
+    volume_max: float
+    volume_step: float
+    stops_level: int        # distancia mínima de SL/TP/pendientes, en puntos
+    trade_mode: int
+    filling_mode: int
+    trade_allowed: bool
+    contract_size: float
+    currency_base: str
+    currency_profit: str
+
+    def round_price(self, price: float) -> float:
+        return round(float(price), self.digits)
+
+    def normalize_volume(self, volume: float) -> float:
+        """
+        Ajusta al paso de volumen del símbolo y lo limita a volume_max. Por debajo de volume_min
+        devuelve 0.0 (no operable) en lugar de subirlo al mínimo: quien llama decide rechazar.
+        """
+        step = self.volume_step or 0.01
+        vol = round(round(float(volume) / step) * step, 8)
+        if vol < self.volume_min:
+            return 0.0
+        return min(vol, self.volume_max)
+
+    def min_stop_distance(self) -> float:
+        return self.stops_level * self.point
+
+def spec_from_info(info) -> SymbolSpec:
+    point = float(info.point)
+    return SymbolSpec(
+        symbol=info.name,
+        point=point,
+        digits=int(info.digits),
+        pip=10 * point,
+        volume_min=float(getattr(info, "volume_min", 0.01)),
+        volume_max=float(getattr(info, "volume_max", 100.0)),
+        volume_step=float(getattr(info, "volume_step", 0.01)),
+        stops_level=int(getattr(info, "trade_stops_level", 0)),
+        trade_mode=int(getattr(info, "trade_mode", 4)),
+        filling_mode=int(getattr(info, "filling_mode", 0)),
+        trade_allowed=bool(getattr(info, "trade_allowed", True)),
+        contract_size=float(getattr(info, "trade_contract_size", 100000.0)),
+        currency_base=getattr(info, "currency_base", info.name[:3]),
+        currency_profit=getattr(info, "currency_profit", info.name[3:6]),
+    )
+
+# ===========================
+#      CACHÉ CON TTL
+# ===========================
+class SymbolSpecCache:
+    """
+    Caché de SymbolSpec por símbolo: symbol_info() se pide una vez y se reutiliza
+    durante ttl_s segundos (reloj monotónico).
+    - refresh(symbol) / refresh(): fuerza la relectura (p. ej. tras reconectar).
+    - check(symbol, retcode): refresca si order_send devolvió un retcode de
+      especificación desactualizada.
+    Con lock: varios hilos (mt5.py) o plug-ins (supervisor) comparten la misma caché.
+    """
+
+    def __init__(self, api, ttl_s: float = 3600.0, log: Optional[Callable[[str], None]] = None,
+                 terminal_lock=TERMINAL_LOCK):
+        self.api = api
+        self.ttl_s = ttl_s
+        self.log = log
+        self.terminal_lock = terminal_lock
+        self._specs = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, symbol: str) -> Optional[SymbolSpec]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._specs.get(symbol)
+            if entry is not None and now - entry[0] < self.ttl_s:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Fuera de self._lock: quien ya tiene el terminal puede pedir specs sin invertir el orden de locks
+        with self.terminal_lock:
+            info = self.api.symbol_info(symbol)
+        if info is None:
+            return None
+        spec = spec_from_info(info)
+        with self._lock:
+            self._specs[symbol] = (now, spec)
+        return spec
+
+    def refresh(self, symbol: Optional[str] = None):
+        with self._lock:
+            if symbol is None:
+                self._specs.clear()
+            else:
+                self._specs.pop(symbol, None)
+            self.refreshes += 1
+
+    def check(self, symbol: str, retcode: Optional[int]) -> bool:
+        if retcode in STALE_SPEC_RETCODES:
+            if self.log:
+                self.log(f"♻️ {symbol}: retcode={retcode}, se relee la especificación del símbolo.")
+            self.refresh(symbol)
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {"symbols": len(self._specs), "hits": self.hits, "misses": self.misses, "refreshes": self.refreshes}
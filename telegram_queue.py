@@ -0,0 +1,340 @@
+import atexit
+import queue
+import threading
+import time
+from typing import Callable, Optional
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+TELEGRAM_MAX_RETRIES = 4
+TELEGRAM_MAX_CHARS = 4096
+BATCH_SEPARATOR = "\n\n" + "─" * 20 + "\n\n"
+
+_STOP = object()
+
+# ===========================
+#      ENVÍO TELEGRAM EN SEGUNDO PLANO
+# ===========================
+class TelegramSender:
+    """
+    Cola acotada + hilo de envío para Telegram; send() no bloquea la lógica de señales/órdenes.
+    - Reutiliza una requests.Session (conexión keep-alive).
+    - Respeta el límite por chat (~1 msg/s en privados, ~20 msg/min en grupos) y los 429 (retry_after).
+    - Reintenta con backoff exponencial ante errores de red o 5xx.
+    - close()/atexit vacían la cola antes de terminar el proceso.
+    """
+
+    def __init__(self, token: str, chat_id: str, maxsize: int = 100,
+                 min_interval_s: Optional[float] = None, retries: int = TELEGRAM_MAX_RETRIES,
+                 backoff_s: float = 1.0, timeout: float = 15.0, base_url: str = TELEGRAM_API_URL,
+                 log: Callable[[str], None] = print):
+        self.token = token
+        self.chat_id = chat_id
+        if min_interval_s is None:
+            # chat_id negativo = grupo: Telegram limita a ~20 mensajes/minuto
+            min_interval_s = 3.0 if str(chat_id).startswith("-") else 1.0
+        self.min_interval_s = min_interval_s
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.timeout = timeout
+        self.url = f"{base_url}/bot{token}/sendMessage"
+        self.log = log
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._atexit = False
+        self._last_sent = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="telegram", daemon=True)
+                self._thread.start()
+                if not self._atexit:
+                    atexit.register(self.close)
+                    self._atexit = True
+
+    def send(self, message: str) -> bool:
+        """Encola el mensaje. Devuelve False si la cola está llena (el mensaje se descarta)."""
+        self.start()
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self.log("⚠️ Cola de Telegram llena; mensaje descartado.")
+            return False
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Espera a que se entreguen (o descarten) los mensajes encolados."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout: float = 30.0):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self.flush(timeout)
+        try:
+            self._queue.put(_STOP, timeout=1.0)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=5.0)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "failed": self.failed, "dropped": self.dropped,
+                "retried": self.retried, "pending": self._queue.qsize()}
+
+    def _run(self):
+        import requests
+        session = requests.Session()
+        while True:
+            message = self._queue.get()
+            try:
+                if message is _STOP:
+                    return
+                self._deliver(session, message)
+            except Exception as e:
+                self.failed += 1
+                self.log(f"❌ Telegram error: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, session, message: str):
+        data = {"chat_id": self.chat_id, "text": message}
+        delay = self.backoff_s
+        for attempt in range(self.retries + 1):
+            wait = self._last_sent + self.min_interval_s - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            retry_after = None
+            try:
+                r = session.post(self.url, data=data, timeout=self.timeout)
+                self._last_sent = time.monotonic()
+                if r.status_code == 200:
+                    self.sent += 1
+                    self.log("📨 Telegram OK")
+                    return
+                if r.status_code == 429:
+                    try:
+                        retry_after = float(r.json()["parameters"]["retry_after"])
+                    except Exception:
+                        retry_after = None
+                elif r.status_code < 500:
+                    # 4xx distinto de 429: reintentar no lo arreglará
+                    self.failed += 1
+                    self.log(f"⚠️ Telegram {r.status_code}: {r.text}")
+                    return
+                reason = f"HTTP {r.status_code}"
+            except Exception as e:
+                self._last_sent = time.monotonic()
+                reason = str(e)
+            if attempt == self.retries:
+                break
+            self.retried += 1
+            pause = retry_after if retry_after is not None else delay
+            self.log(f"⚠️ Telegram reintento {attempt + 1}/{self.retries} en {pause:.1f} s ({reason})")
+            time.sleep(pause)
+            delay = min(delay * 2, 60.0)
+        self.failed += 1
+        self.log(f"❌ Telegram: mensaje no entregado tras {self.retries + 1} intentos ({reason})")
+
+# ===========================
+#      AGRUPACIÓN DE MENSAJES
+# ===========================
+def telegram_len(text: str) -> int:
+    """Longitud tal y como la cuenta Telegram (unidades UTF-16: los emojis ocupan 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def _split_long(text: str, limit: int) -> list:
+    """Parte un texto que no cabe en un mensaje, por líneas (y a la fuerza si una línea no cabe)."""
+    if telegram_len(text) <= limit:
+        return [text]
+    pieces, cur = [], ""
+    for line in text.split("\n"):
+        while telegram_len(line) > limit:
+            cut = limit
+            while telegram_len(line[:cut]) > limit:
+                cut -= 1
+            if cur:
+                pieces.append(cur)
+                cur = ""
+            pieces.append(line[:cut])
+            line = line[cut:]
+        candidate = line if not cur else cur + "\n" + line
+        if telegram_len(candidate) <= limit:
+            cur = candidate
+        else:
+            pieces.append(cur)
+            cur = line
+    if cur:
+        pieces.append(cur)
+    return pieces
+
+def pack_messages(parts, limit: int = TELEGRAM_MAX_CHARS, sep: str = BATCH_SEPARATOR) -> list:
+    """Agrupa los textos (en orden) en el menor número de mensajes de como mucho `limit` caracteres."""
+    batches, cur = [], ""
+    for part in parts:
+        for piece in _split_long(part, limit):
+            if not cur:
+                cur = piece
+            elif telegram_len(cur) + telegram_len(sep) + telegram_len(piece) <= limit:
+                cur += sep + piece
+            else:
+                batches.append(cur)
+                cur = piece
+    if cur:
+        batches.append(cur)
+    return batches
+
+# ===========================
+#      AUTOCOMPROBACIÓN (SERVIDOR LOCAL)
+# ===========================
+class _StandIn:
+    """
+    Sustituto local de api.telegram.org (http.server en 127.0.0.1): registra cada POST
+    (instante monotonic, texto) y responde lo que diga reply(n) -> (status, cuerpo JSON).
+    """
+
+    def __init__(self, reply=None):
+        import http.server
+        import json
+        import urllib.parse
+
+        self.requests = []
+        self.reply = reply or (lambda n: (200, {"ok": True}))
+        self.received = threading.Event()
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                text = urllib.parse.parse_qs(body).get("text", [""])[0]
+                stand_in.requests.append((time.monotonic(), text))
+                stand_in.received.set()
+                status, payload = stand_in.reply(len(stand_in.requests))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def texts(self) -> list:
+        return [text for _, text in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def _sender(stand_in: _StandIn, **kwargs) -> TelegramSender:
+    kwargs.setdefault("min_interval_s", 0.0)
+    kwargs.setdefault("backoff_s", 0.05)
+    return TelegramSender("TOKEN", "42", base_url=stand_in.base_url, log=lambda msg: None, **kwargs)
+
+def _check_retry_after(retry_after: float = 0.3) -> float:
+    """Un 429 con parameters.retry_after: se espera eso (no el backoff) y se reintenta el mismo mensaje."""
+    stand_in = _StandIn(lambda n: (429, {"ok": False, "parameters": {"retry_after": retry_after}}) if n == 1
+                        else (200, {"ok": True}))
+    sender = _sender(stand_in)
+    try:
+        sender.send("hola")
+        sender.flush(10.0)
+        times = [t for t, _ in stand_in.requests]
+        if stand_in.texts() != ["hola", "hola"] or sender.sent != 1 or sender.retried != 1:
+            raise AssertionError(f"429: peticiones {stand_in.texts()} stats {sender.stats()}")
+        gap = times[1] - times[0]
+        if gap < retry_after * 0.95:
+            raise AssertionError(f"429: reintento a los {gap:.3f} s, retry_after={retry_after}")
+        return gap
+    finally:
+        sender.close()
+        stand_in.close()
+
+def _check_pacing(min_interval_s: float = 0.2, n: int = 4) -> float:
+    """Límite por chat: entre dos envíos pasan al menos min_interval_s, y se conserva el orden."""
+    stand_in = _StandIn()
+    sender = _sender(stand_in, min_interval_s=min_interval_s)
+    try:
+        for k in range(n):
+            sender.send(f"m{k}")
+        sender.flush(10.0)
+        times = [t for t, _ in stand_in.requests]
+        if stand_in.texts() != [f"m{k}" for k in range(n)]:
+            raise AssertionError(f"Ritmo: orden o número de mensajes incorrecto {stand_in.texts()}")
+        gap = min(b - a for a, b in zip(times, times[1:]))
+        if gap < min_interval_s * 0.95:
+            raise AssertionError(f"Ritmo: dos envíos separados solo {gap:.3f} s (mín {min_interval_s})")
+        return gap
+    finally:
+        sender.close()
+        stand_in.close()
+
+def _check_overflow(maxsize: int = 2, extra: int = 3) -> int:
+    """Cola acotada: con el hilo ocupado y la cola llena, send() devuelve False y cuenta el descarte."""
+    release = threading.Event()
+
+    def reply(n):
+        release.wait(10.0)
+        return 200, {"ok": True}
+
+    stand_in = _StandIn(reply)
+    sender = _sender(stand_in, maxsize=maxsize)
+    try:
+        sender.send("en curso")
+        if not stand_in.received.wait(5.0):
+            raise AssertionError("Desbordamiento: el primer mensaje no llegó al servidor")
+        accepted = [sender.send(f"m{k}") for k in range(maxsize + extra)]
+        if accepted != [True] * maxsize + [False] * extra or sender.dropped != extra:
+            raise AssertionError(f"Desbordamiento: aceptados {accepted} stats {sender.stats()}")
+        release.set()
+        sender.flush(10.0)
+        if stand_in.texts() != ["en curso"] + [f"m{k}" for k in range(maxsize)]:
+            raise AssertionError(f"Desbordamiento: entregados {stand_in.texts()}")
+        return sender.dropped
+    finally:
+        release.set()
+        sender.close()
+        stand_in.close()
+
+def _check_flush_on_exit(n: int = 3) -> int:
+    """Un proceso que encola y termina sin close(): atexit vacía la cola antes de salir."""
+    import os
+    import subprocess
+    import sys
+
+    stand_in = _StandIn()
+    code = (
+        "import telegram_queue as tq\n"
+        f"s = tq.TelegramSender('TOKEN', '42', min_interval_s=0.1, base_url={stand_in.base_url!r}, log=lambda m: None)\n"
+        f"for k in range({n}):\n"
+        "    s.send(f'm{k}')\n"
+    )
+    try:
+        subprocess.run([sys.executable, "-c", code], check=True, timeout=30,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        if stand_in.texts() != [f"m{k}" for k in range(n)]:
+            raise AssertionError(f"Salida: entregados {stand_in.texts()} de {n}")
+        return len(stand_in.requests)
+    finally:
+        stand_in.close()
+
+if __name__ == "__main__":
+    print(f"✅ 429 retry_after respetado (reintento a los {_check_retry_after():.2f} s)")
+    print(f"✅ Ritmo por chat respetado (separación mínima {_check_pacing():.2f} s)")
+    print(f"✅ Cola acotada: {_check_overflow()} mensaje(s) descartado(s) al llenarse")
+    print(f"✅ Cola vaciada al salir: {_check_flush_on_exit()} mensaje(s) entregado(s)")